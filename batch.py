@@ -0,0 +1,236 @@
+"""Пакетная генерация карт и отчётов по списку людей (без Telegram и ограничений бота).
+
+    python batch.py people.csv --out batch_reports --concurrency 8 --gpt-concurrency 6
+
+Вход — CSV с колонками name, date, time, city (дата ДД.ММ.ГГГГ, время ЧЧ:ММ) или JSONL с теми же полями.
+Для каждой строки в каталог --out пишутся краткий PDF (как после расчёта в боте) и подробный отчёт
+(без --summary-only), а в manifest.jsonl — строка с результатом. Manifest служит контрольной точкой:
+при повторном запуске уже готовые строки пропускаются, строки с ошибками обрабатываются заново.
+"""
+import argparse
+import asyncio
+import csv
+import hashlib
+import json
+import logging
+import os
+import time
+
+from dotenv import load_dotenv
+
+import llm
+import natal
+from chart_engine import ChartEngine
+from ephemeris_table import EPHEMERIS_TABLE
+from gazetteer import GAZETTEER
+from geocoding import Geocoder, OPENCAGE_URL
+from interpretations import ASCENDANT, INTERPRETATIONS_DB, InterpretationStore
+from pdf_renderer import ReportRenderer
+from timezones import TimezoneService
+
+FIELDS = ("name", "date", "time", "city")
+MANIFEST = "manifest.jsonl"
+
+
+def row_key(row):
+    """Устойчивый id строки по её данным: не меняется при перестановке строк во входном файле."""
+    raw = "|".join(row[field].strip() for field in FIELDS)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:12]
+
+
+def read_rows(path):
+    """Строки входного файла (CSV или JSONL по расширению) с проверкой обязательных полей."""
+    with open(path, encoding="utf-8-sig") as f:
+        if path.endswith((".jsonl", ".json")):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+    result = []
+    for number, row in enumerate(rows, 1):
+        missing = [field for field in FIELDS if not str(row.get(field) or "").strip()]
+        if missing:
+            logging.warning(f"Row {number} skipped: missing {', '.join(missing)}")
+            continue
+        result.append({field: str(row[field]).strip() for field in FIELDS})
+    return result
+
+
+def load_manifest(path):
+    """Последний результат по каждому id из manifest (записи дописываются, последняя — актуальная)."""
+    entries = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Недописанная строка после прерывания
+                    continue
+                entries[entry["id"]] = entry
+    return entries
+
+
+class BatchRunner:
+    def __init__(self, out_dir, geocoder, timezone_service, chart_engine, interpretation_store, pdf_renderer,
+                 gateway, concurrency=8, detailed=True):
+        self.out_dir = out_dir
+        self.geocoder = geocoder
+        self.timezone_service = timezone_service
+        self.chart_engine = chart_engine
+        self.interpretation_store = interpretation_store
+        self.pdf_renderer = pdf_renderer
+        self.gateway = gateway
+        self.detailed = detailed
+        self.row_semaphore = asyncio.Semaphore(concurrency)
+        self.manifest_path = os.path.join(out_dir, MANIFEST)
+        self._manifest = None
+        self.done = 0
+        self.failed = 0
+
+    def _record(self, entry):
+        self._manifest.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._manifest.flush()
+
+    async def _interpretation(self, body, sign, house=""):
+        return await natal.short_interpretation(
+            self.interpretation_store, self.gateway, body, sign, house, pipeline="batch"
+        )
+
+    async def _section(self, header, title, instruction):
+        try:
+            return await natal.request_report_section(self.gateway, natal.report_prompt(header, instruction))
+        except Exception as e:
+            logging.error(f"Error in {title}: {e}", exc_info=True)
+            return None
+
+    async def _process(self, key, row):
+        birth = await natal.locate(self.geocoder, self.timezone_service, row["date"], row["time"], row["city"], pipeline="batch")
+        chart = await self.chart_engine.chart(birth.dt_utc, birth.lat_str, birth.lon_str)
+        positions = natal.analyze(chart, pipeline="batch")
+        asc_sign = natal.ascendant_sign(chart)
+        *replies, asc_reply = await asyncio.gather(
+            *[self._interpretation(p.body, p.sign, p.house) for p in positions],
+            self._interpretation(ASCENDANT, asc_sign)
+        )
+        summary = [natal.summary_entry(p, reply) for p, reply in zip(positions, replies)]
+        summary.append(natal.ascendant_summary_entry(asc_sign, asc_reply))
+        entry = {
+            "lat": birth.lat,
+            "lon": birth.lon,
+            "timezone": birth.timezone,
+            "dt_utc": birth.dt_utc.isoformat(),
+            "planets": natal.planets_info(positions, asc_sign),
+            "summary_pdf": await self.pdf_renderer.render_to_file(
+                "summary", summary, os.path.join(self.out_dir, f"{key}_summary.pdf")
+            ),
+        }
+        if self.detailed:
+            header = natal.report_header(row["name"], dict(
+                date_str=birth.date_str, time_str=birth.time_str, city=birth.city,
+                dt_utc=birth.dt_utc, lat=birth.lat, lon=birth.lon, planets=entry["planets"]
+            ))
+            contents = await asyncio.gather(*[
+                self._section(header, title, instruction) for title, instruction in natal.REPORT_SECTIONS
+            ])
+            chapters = [(title, content) for (title, _), content in zip(natal.REPORT_SECTIONS, contents) if content]
+            if not chapters:
+                raise RuntimeError("Не удалось подготовить ни одного раздела отчёта")
+            entry["failed_sections"] = [title for (title, _), content in zip(natal.REPORT_SECTIONS, contents) if not content]
+            entry["report_pdf"] = await self.pdf_renderer.render_to_file(
+                "report", chapters, os.path.join(self.out_dir, f"{key}_report.pdf")
+            )
+        return entry
+
+    async def run_row(self, key, row, total):
+        async with self.row_semaphore:
+            started = time.perf_counter()
+            entry = {"id": key, **row}
+            try:
+                entry.update(await self._process(key, row))
+                entry["status"] = "ok"
+                self.done += 1
+            except natal.BirthDataError as e:
+                entry.update(status="error", error=str(e))
+                self.failed += 1
+            except Exception as e:
+                logging.error(f"Batch row {key} error: {e}", exc_info=True)
+                entry.update(status="error", error=f"{type(e).__name__}: {e}")
+                self.failed += 1
+            entry["seconds"] = round(time.perf_counter() - started, 3)
+            self._record(entry)
+            finished = self.done + self.failed
+            if finished % 10 == 0 or finished == total:
+                logging.info(f"Batch progress: {finished}/{total} ({self.failed} failed)")
+
+    async def run(self, rows):
+        os.makedirs(self.out_dir, exist_ok=True)
+        previous = load_manifest(self.manifest_path)
+        todo = {}
+        for row in rows:
+            key = row_key(row)
+            entry = previous.get(key)
+            if entry and entry.get("status") == "ok" and os.path.exists(entry.get("summary_pdf", "")) \
+                    and (not self.detailed or os.path.exists(entry.get("report_pdf", ""))):
+                continue
+            if key in todo:
+                logging.warning(f"Duplicate row {row} skipped")
+                continue
+            todo[key] = row
+        logging.info(f"Batch: {len(rows)} rows, {len(rows) - len(todo)} already done or duplicate, {len(todo)} to process")
+
+        self._manifest = open(self.manifest_path, "a", encoding="utf-8")
+        try:
+            await asyncio.gather(*[self.run_row(key, row, len(todo)) for key, row in todo.items()])
+        finally:
+            self._manifest.close()
+        return self.done, self.failed
+
+
+async def run_batch(args):
+    geocoder = Geocoder(
+        os.getenv("OPENCAGE_API_KEY"), "./geocache.json",
+        url=os.getenv("OPENCAGE_URL", OPENCAGE_URL), gazetteer_path=args.gazetteer
+    )
+    geocoder.load_gazetteer()
+    timezone_service = TimezoneService()
+    chart_engine = ChartEngine(workers=args.chart_workers, ids=natal.CHART_OBJECTS, table_path=args.ephemeris_table)
+    chart_engine.load_table()
+    interpretation_store = InterpretationStore(args.db)
+    pdf_renderer = ReportRenderer(workers=args.pdf_workers)
+    gateway = llm.from_env()
+    gateway.default_concurrency = args.gpt_concurrency
+    try:
+        interpretation_store.load()
+        runner = BatchRunner(
+            args.out, geocoder, timezone_service, chart_engine, interpretation_store, pdf_renderer, gateway,
+            concurrency=args.concurrency, detailed=not args.summary_only
+        )
+        done, failed = await runner.run(read_rows(args.input))
+        logging.info(f"Batch finished: {done} done, {failed} failed; manifest {runner.manifest_path}")
+        return failed
+    finally:
+        await geocoder.close()
+        await gateway.close()
+        interpretation_store.close()
+        pdf_renderer.close()
+        chart_engine.close()
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    parser = argparse.ArgumentParser(description="Пакетная генерация карт и отчётов")
+    parser.add_argument("input", help="CSV или JSONL с полями name, date, time, city")
+    parser.add_argument("--out", default="batch_reports", help="каталог для PDF и manifest.jsonl")
+    parser.add_argument("--concurrency", type=int, default=8, help="строк обрабатывается одновременно")
+    parser.add_argument("--gpt-concurrency", type=int, default=int(os.getenv("GPT_CONCURRENCY", "6")))
+    parser.add_argument("--chart-workers", type=int, default=int(os.getenv("CHART_WORKERS", "2")))
+    parser.add_argument("--pdf-workers", type=int, default=int(os.getenv("PDF_WORKERS", "2")))
+    parser.add_argument("--summary-only", action="store_true", help="только краткий PDF, без подробного отчёта")
+    parser.add_argument("--db", default=os.getenv("INTERPRETATIONS_DB", INTERPRETATIONS_DB))
+    parser.add_argument("--ephemeris-table", default=os.getenv("EPHEMERIS_TABLE", EPHEMERIS_TABLE))
+    parser.add_argument("--gazetteer", default=os.getenv("GAZETTEER", GAZETTEER), help="локальный индекс городов")
+    args = parser.parse_args()
+
+    raise SystemExit(1 if asyncio.run(run_batch(args)) else 0)
@@ -0,0 +1,111 @@
+"""Сравнение векторизованного chart_analytics с прежними get_aspects / get_house_manually.
+
+    python benchmarks/chart_analytics_bench.py --charts 200 --repeat 50
+
+Сначала проверяется, что для пяти планет результаты совпадают, затем замеряется время.
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flatlib import const
+from chart_engine import compute_snapshot
+from chart_analytics import ASPECT_BODIES, chart_aspects, chart_houses
+
+PLANETS = ["Sun", "Moon", "Mercury", "Venus", "Mars"]
+
+
+def legacy_house(chart, lon):
+    """Прежний линейный поиск дома (без логирования)."""
+    for house in chart.houses:
+        start_lon = house.lon
+        end_lon = (house.lon + house.size) % 360
+        if start_lon <= end_lon:
+            if start_lon <= lon <= end_lon:
+                return house.id
+        else:
+            if lon >= start_lon or lon <= end_lon:
+                return house.id
+    return None
+
+
+def legacy_aspects(chart, planet_names, log=False):
+    """Прежний попарный перебор аспектов с орбисом 15° (`log` — со строкой лога на пару, как было в боте)."""
+    aspects = []
+    for i, p1 in enumerate(planet_names):
+        obj1 = chart.get(p1)
+        for p2 in planet_names[i + 1:]:
+            obj2 = chart.get(p2)
+            diff = abs(obj1.lon - obj2.lon)
+            diff = min(diff, 360 - diff)
+            if log:
+                logging.info(f"Angle {p1} ({obj1.lon:.2f}°) - {p2} ({obj2.lon:.2f}°): {diff:.2f}°")
+            for name, angle in (("соединение", 0), ("секстиль", 60), ("квадрат", 90), ("тригон", 120), ("оппозиция", 180)):
+                if abs(diff - angle) <= 15:
+                    aspects.append((p1, p2, diff, name))
+                    break
+    return aspects
+
+
+def random_charts(count, seed):
+    rng = random.Random(seed)
+    charts = []
+    for _ in range(count):
+        lat, lon = rng.uniform(-60, 65), rng.uniform(-180, 180)
+        charts.append(compute_snapshot(
+            f"{rng.randint(1930, 2020)}/{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}",
+            f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}",
+            f"{int(abs(lat))}{'n' if lat >= 0 else 's'}{rng.randint(0, 59):02d}",
+            f"{int(abs(lon))}{'e' if lon >= 0 else 'w'}{rng.randint(0, 59):02d}",
+            ids=const.LIST_OBJECTS
+        ))
+    return charts
+
+
+def check(charts):
+    for chart in charts:
+        houses = chart_houses(chart, PLANETS)
+        for p in PLANETS:
+            assert houses[p] == legacy_house(chart, chart.get(p).lon), (chart, p)
+        assert sorted(chart_aspects(chart, PLANETS)) == sorted(legacy_aspects(chart, PLANETS)), chart
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарк аспектов и домов")
+    parser.add_argument("--charts", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    charts = random_charts(args.charts, args.seed)
+    check(charts)
+    print(f"{len(charts)} charts: results match for {', '.join(PLANETS)}")
+
+    bodies = [body for body in ASPECT_BODIES if charts[0].get(body) is not None]
+    # Логи пишутся в /dev/null: учитывается стоимость форматирования, но не диска
+    logging.basicConfig(level=logging.INFO, stream=open(os.devnull, "w"), format="%(asctime)s - %(levelname)s - %(message)s")
+    cases = {
+        "legacy+log, 5 planets": lambda: [
+            (legacy_aspects(c, PLANETS, log=True), [legacy_house(c, c.get(p).lon) for p in PLANETS]) for c in charts
+        ],
+        "legacy, 5 planets": lambda: [
+            (legacy_aspects(c, PLANETS), [legacy_house(c, c.get(p).lon) for p in PLANETS]) for c in charts
+        ],
+        "numpy, 5 planets": lambda: [(chart_aspects(c, PLANETS), chart_houses(c, PLANETS)) for c in charts],
+        f"legacy, {len(bodies)} bodies": lambda: [
+            (legacy_aspects(c, bodies), [legacy_house(c, c.get(p).lon) for p in bodies]) for c in charts
+        ],
+        f"numpy, {len(bodies)} bodies": lambda: [(chart_aspects(c, bodies), chart_houses(c, bodies)) for c in charts],
+    }
+    for name, func in cases.items():
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print(f"{name:<22} {best / len(charts) * 1e6:8.1f} µs/chart")
+
+
+if __name__ == "__main__":
+    main()
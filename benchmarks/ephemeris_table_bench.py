@@ -0,0 +1,81 @@
+"""Сравнение расчёта карты по таблице эфемерид с полным расчётом flatlib.
+
+    python ephemeris_table.py build --start 1990 --end 2000
+    python benchmarks/ephemeris_table_bench.py --charts 500 --repeat 5
+
+Сначала проверяется, что дома и углы совпадают, а долготы тел расходятся не больше допуска таблицы,
+затем замеряется время одного снимка (без учёта передачи между процессами в ChartEngine).
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flatlib import const
+from chart_engine import compute_snapshot, table_snapshot
+from ephemeris_table import EPHEMERIS_TABLE, LON_TOLERANCE, EphemerisTable, julian_day
+from natal import CHART_OBJECTS
+
+
+def random_keys(table, count, seed):
+    """Случайные (дата, время, широта, долгота) в диапазоне таблицы."""
+    rng = random.Random(seed)
+    first = next(year for year in range(1800, 2400) if julian_day(year) >= table.jd0)
+    last = next(year for year in range(2400, 1800, -1) if julian_day(year + 1) <= table.jd_end)
+    keys = []
+    for _ in range(count):
+        lat, lon = rng.uniform(-60, 65), rng.uniform(-180, 180)
+        keys.append((
+            f"{rng.randint(first, last)}/{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}",
+            f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}",
+            f"{int(abs(lat))}{'n' if lat >= 0 else 's'}{rng.randint(0, 59):02d}",
+            f"{int(abs(lon))}{'e' if lon >= 0 else 'w'}{rng.randint(0, 59):02d}",
+        ))
+    return keys
+
+
+def check(table, keys):
+    """Наибольшие расхождения долгот (градусы) и скоростей (градусы в сутки), число несовпадений знака
+    зодиака и направления движения (ретроградности)."""
+    worst, worst_speed, signs, directions = 0.0, 0.0, 0, 0
+    for key in keys:
+        full = compute_snapshot(*key, ids=CHART_OBJECTS)
+        fast = table_snapshot(table, *key, ids=CHART_OBJECTS)
+        assert full.houses == fast.houses and full.angles == fast.angles, key
+        for a, b in zip(full.objects, fast.objects):
+            worst = max(worst, abs((a.lon - b.lon + 180) % 360 - 180))
+            worst_speed = max(worst_speed, abs(a.lonspeed - b.lonspeed))
+            signs += a.sign != b.sign
+            directions += (a.lonspeed < 0) != (b.lonspeed < 0)
+    return worst, worst_speed, signs, directions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарк таблицы эфемерид")
+    parser.add_argument("--table", default=os.getenv("EPHEMERIS_TABLE", EPHEMERIS_TABLE))
+    parser.add_argument("--charts", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    table = EphemerisTable.open(args.table)
+    keys = random_keys(table, args.charts, args.seed)
+    worst, worst_speed, signs, directions = check(table, keys)
+    print(f"{len(keys)} charts: max longitude error {worst * 3600:.3f}″ (tolerance {LON_TOLERANCE * 3600:.1f}″), "
+          f"max speed error {worst_speed:.4f}°/day, {signs} sign mismatches, {directions} retrograde mismatches")
+
+    cases = {
+        "flatlib, all objects": lambda: [compute_snapshot(*key, ids=const.LIST_OBJECTS) for key in keys],
+        "flatlib, chart objects": lambda: [compute_snapshot(*key, ids=CHART_OBJECTS) for key in keys],
+        "table + houses": lambda: [table_snapshot(table, *key, ids=CHART_OBJECTS) for key in keys],
+    }
+    for name, func in cases.items():
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print(f"{name:<24} {best / len(keys) * 1e6:8.1f} µs/chart")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""Локальные заглушки Bot API, OpenAI chat completions и OpenCage для нагрузочного теста.
+
+У каждой заглушки настраиваются задержка ответа и доля ошибок.
+"""
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+
+class FaultProfile:
+    """Задержка ответа (мс, среднее и разброс) и доля ответов с ошибкой."""
+
+    def __init__(self, latency_ms=50.0, jitter_ms=20.0, error_rate=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+    async def delay(self):
+        latency = max(0.0, self.random.gauss(self.latency_ms, self.jitter_ms))
+        await asyncio.sleep(latency / 1000)
+
+    def fail(self):
+        return self.error_rate > 0 and self.random.random() < self.error_rate
+
+
+class FakeServer:
+    def __init__(self, profile):
+        self.profile = profile
+        self.requests = 0
+        self.errors = 0
+        self._runner = None
+        self.port = None
+
+    def app(self):
+        raise NotImplementedError
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{self.port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def stats(self):
+        return {"requests": self.requests, "injected_errors": self.errors}
+
+
+class FakeTelegram(FakeServer):
+    """Bot API: отвечает на методы, которыми пользуется бот, и записывает исходящие сообщения по чатам."""
+
+    def __init__(self, profile, channel_status="member"):
+        super().__init__(profile)
+        self.channel_status = channel_status
+        self.calls = {}
+        self._message_id = 0
+        self._waiters = []
+
+    def app(self):
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        return app
+
+    def wait_for(self, chat_id, predicate):
+        """Future, который завершится при первом вызове API для чата, подходящем под predicate(method, data)."""
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.append((str(chat_id), predicate, future))
+        return future
+
+    def _notify(self, chat_id, method, data):
+        for waiter in list(self._waiters):
+            waiter_chat, predicate, future = waiter
+            if waiter_chat == chat_id and not future.done() and predicate(method, data):
+                future.set_result((method, data, time.perf_counter()))
+                self._waiters.remove(waiter)
+
+    def _message(self, chat_id, **fields):
+        self._message_id += 1
+        return dict({
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "Bot"},
+        }, **fields)
+
+    async def handle(self, request):
+        self.requests += 1
+        method = request.match_info["method"]
+        data = dict(await request.post()) if request.body_exists else {}
+        await self.profile.delay()
+        if method not in ("getMe", "getWebhookInfo", "deleteWebhook") and self.profile.fail():
+            self.errors += 1
+            if self.profile.random.random() < 0.5:
+                return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                          "parameters": {"retry_after": 1}}, status=429)
+            return web.json_response({"ok": False, "error_code": 500, "description": "Internal Server Error"}, status=500)
+
+        chat_id = str(data.get("chat_id", ""))
+        result = True
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bot", "username": "fake_bot"}
+        elif method == "getWebhookInfo":
+            result = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        elif method == "sendMessage":
+            result = self._message(chat_id, text=data.get("text", ""))
+        elif method == "editMessageText":
+            result = self._message(chat_id, text=data.get("text", ""))
+        elif method == "sendDocument":
+            result = self._message(chat_id, document={"file_id": f"doc{self._message_id}", "file_unique_id": "u"})
+        elif method == "getChatMember":
+            user_id = int(data.get("user_id", 0))
+            result = {"user": {"id": user_id, "is_bot": False, "first_name": "User"}, "status": self.channel_status}
+        self.calls.setdefault(method, 0)
+        self.calls[method] += 1
+        self._notify(chat_id, method, data)
+        return web.json_response({"ok": True, "result": result})
+
+
+class FakeOpenAI(FakeServer):
+    """Chat completions: обычный ответ с usage и потоковый (SSE) с задержкой на фрагмент."""
+
+    def __init__(self, profile, completion_words=120, chunk_delay_ms=5.0):
+        super().__init__(profile)
+        self.completion_words = completion_words
+        self.chunk_delay_ms = chunk_delay_ms
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        return app
+
+    async def handle(self, request):
+        self.requests += 1
+        body = await request.json()
+        await self.profile.delay()
+        if self.profile.fail():
+            self.errors += 1
+            return web.json_response({"error": {"message": "Injected error", "type": "server_error"}}, status=500)
+        model = body.get("model", "gpt-4o")
+        words = ["Тестовая", "интерпретация", "положения", "планеты"] * (self.completion_words // 4)
+        if not body.get("stream"):
+            return web.json_response({
+                "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": " ".join(words[:40])}}],
+                "usage": {"prompt_tokens": 30, "completion_tokens": 40, "total_tokens": 70},
+            })
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for word in words:
+            chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                     "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            await asyncio.sleep(self.chunk_delay_ms / 1000)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+class FakeOpenCage(FakeServer):
+    """Геокодирование: детерминированные координаты по названию города."""
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/geocode/v1/json", self.handle)
+        return app
+
+    async def handle(self, request):
+        self.requests += 1
+        await self.profile.delay()
+        if self.profile.fail():
+            self.errors += 1
+            return web.json_response({"status": {"code": 503, "message": "Injected error"}}, status=503)
+        seed = sum(map(ord, request.query.get("q", "")))
+        return web.json_response({
+            "results": [{"geometry": {"lat": -50 + seed % 110 + 0.123, "lng": -170 + seed * 7 % 340 + 0.456}}],
+            "status": {"code": 200, "message": "OK"},
+        })
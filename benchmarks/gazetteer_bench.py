@@ -0,0 +1,135 @@
+"""Скорость и точность локального геокодера.
+
+    python benchmarks/gazetteer_bench.py --source cities500.txt --admin1 admin1CodesASCII.txt
+    python benchmarks/gazetteer_bench.py --synthetic 200000
+
+Индекс строится во временном каталоге, затем замеряется время открытия и поиска (точное название,
+название с опечаткой, с переставленными соседними буквами, начало названия), а для опечаток — доля
+запросов, где исходное место первое или среди первых пяти. Без выгрузки GeoNames используется
+синтетическая (случайные названия). Напоследок проверяются переставленные буквы в названиях известных
+городов («Мсоква», «Кзаань»), если эти города есть в выгрузке; при промахе скрипт завершается с кодом 1.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gazetteer import ALPHABET, Gazetteer, build, max_distance
+
+SYLLABLES = "ka ra no vo mi le sk ov in ar to pe gr ba ze lu sha chi rya yu".split()
+# Перестановка соседних букв меняет до четырёх триграмм — самая трудная для триграммного отбора опечатка
+TRANSPOSITIONS = {
+    "Мсоква": "Москва", "Моксва": "Москва", "Мосвка": "Москва",
+    "Смаара": "Самара", "Самраа": "Самара", "Кзаань": "Казань",
+}
+
+
+def synthetic_dump(path, places, seed):
+    """Выгрузка в формате GeoNames со случайными названиями и населением по закону Парето."""
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(places):
+            name = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+            fields = [str(i + 1), name, name, "", f"{rng.uniform(40, 70):.4f}", f"{rng.uniform(20, 140):.4f}",
+                      "P", "PPL", rng.choice(["RU", "UA", "KZ", "BY"]), "", "01", "", "", "",
+                      str(int(rng.paretovariate(1.2) * 50)), "", "", "Europe/Moscow", "2020-01-01"]
+            f.write("\t".join(fields) + "\n")
+
+
+def typo(key, rng):
+    """Ключ с допустимым для его длины числом случайных правок (замена, вставка, удаление, перестановка)."""
+    for _ in range(max_distance(key)):
+        i = rng.randrange(len(key) - 1)
+        kind = rng.choice(("replace", "insert", "delete", "swap"))
+        if kind == "replace":
+            key = key[:i] + rng.choice(ALPHABET[1:27]) + key[i + 1:]
+        elif kind == "insert":
+            key = key[:i] + rng.choice(ALPHABET[1:27]) + key[i:]
+        elif kind == "delete":
+            key = key[:i] + key[i + 1:]
+        else:
+            key = key[:i] + key[i + 1] + key[i] + key[i + 2:]
+    return key
+
+
+def transposed(name, rng):
+    """Название с одной перестановкой соседних букв (в том числе первой и последней пары)."""
+    i = rng.randrange(len(name) - 1)
+    return name[:i] + name[i + 1] + name[i] + name[i + 2:]
+
+
+def check_transpositions(gazetteer):
+    """Названия из TRANSPOSITIONS, для которых не найден тот же город, что и по правильному написанию."""
+    checked, missed = 0, []
+    for query, city in TRANSPOSITIONS.items():
+        expected = gazetteer.search(city, 1)
+        if not expected:
+            continue
+        checked += 1
+        found = gazetteer.search(query, 1)
+        if not found or found[0].index != expected[0].index:
+            missed.append(query)
+    return checked, missed
+
+
+def timed(gazetteer, queries):
+    started = time.perf_counter()
+    results = [gazetteer.search(query) for query in queries]
+    return (time.perf_counter() - started) / len(queries), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк локального геокодера")
+    parser.add_argument("--source", help="выгрузка GeoNames")
+    parser.add_argument("--admin1", help="admin1CodesASCII.txt")
+    parser.add_argument("--synthetic", type=int, default=200000, help="мест в синтетической выгрузке")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--min-population", type=int, default=1000, help="население мест для запросов")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        source = args.source
+        if not source:
+            source = os.path.join(workdir, "cities.txt")
+            synthetic_dump(source, args.synthetic, args.seed)
+        path = os.path.join(workdir, "gazetteer.npy")
+        started = time.perf_counter()
+        meta = build(source, path, args.admin1)
+        print(f"build: {time.perf_counter() - started:.1f} s, {meta['places']} places, {meta['names']} names, "
+              f"{os.path.getsize(path) / 2 ** 20:.1f} MiB")
+        started = time.perf_counter()
+        gazetteer = Gazetteer.open(path)
+        print(f"open: {(time.perf_counter() - started) * 1000:.1f} ms")
+
+        rng = random.Random(args.seed)
+        indexes = [i for i in range(len(gazetteer)) if gazetteer.population[i] >= args.min_population]
+        sample = [rng.choice(indexes) for _ in range(args.queries)]
+        keys = [gazetteer.keys[rng.choice(range(len(gazetteer.keys)))] for _ in range(args.queries)]
+        names = [gazetteer.place(i).name for i in sample]
+        typos = [typo(name.lower(), rng) if len(name) > 3 else name for name in names]
+        swaps = [transposed(name.lower(), rng) if len(name) > 3 else name for name in names]
+        prefixes = [key[:max(4, len(key) - 3)] for key in keys]
+
+        for title, queries in (("exact", names), ("typo", typos), ("swap", swaps), ("prefix", prefixes)):
+            seconds, results = timed(gazetteer, queries)
+            line = f"{title:<7} {seconds * 1e6:8.0f} µs/query"
+            if title != "prefix":
+                top1 = sum(1 for i, found in zip(sample, results) if found and found[0].index == i)
+                top5 = sum(1 for i, found in zip(sample, results) if any(place.index == i for place in found))
+                line += f", place first {top1 / len(sample):.1%}, in top 5 {top5 / len(sample):.1%}"
+            print(line)
+
+        checked, missed = check_transpositions(gazetteer)
+        print(f"transposed city names: {checked - len(missed)}/{checked} found"
+              + (f", missed: {', '.join(missed)}" if missed else ""))
+        if missed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
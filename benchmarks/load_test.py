@@ -0,0 +1,337 @@
+"""Нагрузочный тест бота без внешних сервисов.
+
+    python benchmarks/load_test.py --users 50 --output load.json
+
+Запускает локальные заглушки Bot API, OpenAI и OpenCage (fake_servers.py), направляет на них бота
+через TELEGRAM_API_URL, OPENAI_API_BASE и OPENCAGE_URL и прогоняет `--users` пользователей через
+/start, расчёт, проверку подписки и подробный отчёт. Обновления обрабатываются так же, как в режиме
+вебхука (UpdateRouter → dp.process_update). Окончание сценария определяется по вызовам заглушки
+Telegram (ответ «✅ Готово», документ отчёта и т. д.).
+
+Результат — JSON с p50/p95/p99 по сценариям, пропускной способностью и задержкой event loop.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fake_servers import FaultProfile, FakeOpenAI, FakeOpenCage, FakeTelegram
+
+CITIES = ["Москва", "Санкт-Петербург", "Новосибирск", "Екатеринбург", "Казань", "Самара", "Омск", "Ростов-на-Дону"]
+FLOWS = ("start", "calculation", "subscription", "report")
+ERROR_PREFIXES = ("❌", "⚠️", "❗")
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(samples):
+    """count/errors/p50/p95/p99/max (в секундах) по списку (длительность, успех)."""
+    durations = [duration for duration, ok in samples if ok]
+    return {
+        "count": len(samples),
+        "errors": sum(1 for _, ok in samples if not ok),
+        "p50": percentile(durations, 50),
+        "p95": percentile(durations, 95),
+        "p99": percentile(durations, 99),
+        "max": max(durations) if durations else None,
+    }
+
+
+class LoopLagProbe:
+    """Задержка event loop: насколько `asyncio.sleep(interval)` просыпается позже срока."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - started - self.interval))
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    def summary(self):
+        return {
+            "samples": len(self.samples),
+            "p50": percentile(self.samples, 50),
+            "p99": percentile(self.samples, 99),
+            "max": max(self.samples) if self.samples else None,
+        }
+
+
+class SimulatedUser:
+    """Один пользователь: отправляет обновления боту и ждёт реакции в заглушке Telegram."""
+
+    def __init__(self, user_id, harness):
+        self.user_id = user_id
+        self.harness = harness
+        self.rng = random.Random(user_id)
+
+    def _message(self, text):
+        update_id = self.harness.next_update_id()
+        message = {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": self.user_id, "type": "private"},
+            "from": {"id": self.user_id, "is_bot": False, "first_name": "Тест"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": update_id, "message": message}
+
+    def _callback(self, data):
+        update_id = self.harness.next_update_id()
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id),
+            "chat_instance": str(self.user_id),
+            "from": {"id": self.user_id, "is_bot": False, "first_name": "Тест"},
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": self.user_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "Bot"},
+                "text": "✅ Готово! Хотите подробный отчёт? Подпишитесь!",
+            },
+        }}
+
+    async def step(self, flow, update, predicate):
+        """Отправка обновления и ожидание вызова API, для которого predicate вернёт True (успех) или False (ошибка)."""
+        outcome = {}
+
+        def matches(method, data):
+            result = predicate(method, data)
+            if result is not None:
+                outcome["ok"] = result
+                return True
+            return False
+
+        waiter = self.harness.telegram.wait_for(self.user_id, matches)
+        started = time.perf_counter()
+        # Ключ как у webhook.route_key: обновления одного пользователя обрабатываются по очереди
+        self.harness.router.submit(self.user_id, update)
+        try:
+            _, _, finished = await asyncio.wait_for(waiter, self.harness.timeout)
+            ok = outcome["ok"]
+        except asyncio.TimeoutError:
+            finished, ok = time.perf_counter(), False
+            self.harness.timeouts[flow] += 1
+        self.harness.samples[flow].append((finished - started, ok))
+        return ok
+
+    async def run(self):
+        if not await self.step("start", self._message("/start"), start_done):
+            return
+        date = f"{self.rng.randint(1, 28):02d}.{self.rng.randint(1, 12):02d}.{self.rng.randint(1950, 2005)}"
+        text = f"{date}, {self.rng.randint(0, 23):02d}:{self.rng.randint(0, 59):02d}, {self.rng.choice(CITIES)}"
+        if not await self.step("calculation", self._message(text), calculation_done):
+            return
+        if not await self.step("subscription", self._callback("check_subscription"), subscription_done):
+            return
+        await self.step("report", self._message("📝 Заказать подробную натальную карту"), report_done)
+
+
+def _error(text):
+    return text.startswith(ERROR_PREFIXES)
+
+
+def start_done(method, data):
+    if method == "sendMessage":
+        return "Добро пожаловать" in data.get("text", "")
+    return None
+
+
+def calculation_done(method, data):
+    text = data.get("text", "")
+    if method == "sendMessage" and text.startswith("✅ Готово"):
+        return True
+    if method in ("sendMessage", "editMessageText") and _error(text):
+        return False
+    return None
+
+
+def subscription_done(method, data):
+    text = data.get("text", "")
+    if method == "editMessageText":
+        return text.startswith("Теперь нажмите")
+    return None
+
+
+def report_done(method, data):
+    if method == "sendDocument":
+        return True
+    text = data.get("text", "")
+    if method == "sendMessage" and (_error(text) or text.startswith(("Подпишитесь", "⏳ Отчёт уже", "⏳ Подробный"))):
+        return False
+    return None
+
+
+class Harness:
+    def __init__(self, telegram, timeout):
+        self.telegram = telegram
+        self.timeout = timeout
+        self.samples = {flow: [] for flow in FLOWS}
+        self.timeouts = {flow: 0 for flow in FLOWS}
+        self._update_id = 0
+        self.router = None
+
+    def next_update_id(self):
+        self._update_id += 1
+        return self._update_id
+
+
+def configure_environment(args, telegram_url, openai_url, opencage_url, workdir):
+    """Переменные окружения бота; вызывается до импорта main."""
+    os.environ.update({
+        "API_TOKEN": "123456:LOADTEST",
+        "OPENAI_API_KEY": "sk-loadtest",
+        "OPENCAGE_API_KEY": "loadtest",
+        "TELEGRAM_API_URL": telegram_url,
+        "OPENAI_API_BASE": f"{openai_url}/v1",
+        "OPENCAGE_URL": f"{opencage_url}/geocode/v1/json",
+        "RATE_LIMIT_BACKEND": "memory",
+        "METRICS_PORT": "0",
+        "INTERPRETATIONS_DB": os.path.join(workdir, "interpretations.db"),
+        "LOG_LEVEL": args.log_level,
+        "SEND_GLOBAL_RATE": str(args.send_rate),
+    })
+    os.chdir(workdir)
+
+
+async def run(args):
+    telegram = FakeTelegram(FaultProfile(args.telegram_latency, args.jitter, args.telegram_errors, args.seed))
+    openai_server = FakeOpenAI(FaultProfile(args.openai_latency, args.jitter, args.openai_errors, args.seed),
+                               chunk_delay_ms=args.chunk_delay)
+    opencage = FakeOpenCage(FaultProfile(args.geocode_latency, args.jitter, args.geocode_errors, args.seed))
+    urls = [await server.start() for server in (telegram, openai_server, opencage)]
+
+    workdir = tempfile.mkdtemp(prefix="astrobot-load-")
+    configure_environment(args, *urls, workdir)
+    import main
+    import webhook
+    from aiogram import Bot, Dispatcher, types
+
+    Bot.set_current(main.bot)
+    Dispatcher.set_current(main.dp)
+
+    async def process(update):
+        await main.dp.process_update(types.Update(**update))
+
+    harness = Harness(telegram, args.timeout)
+    harness.router = webhook.UpdateRouter(process)
+
+    await main.init_services()
+    probe = LoopLagProbe()
+    probe.start()
+
+    async def launch(index):
+        await asyncio.sleep(args.ramp * index / max(1, args.users))
+        await SimulatedUser(100_000_000 + index, harness).run()
+
+    started = time.perf_counter()
+    await asyncio.gather(*[launch(index) for index in range(args.users)])
+    elapsed = time.perf_counter() - started
+
+    await probe.stop()
+    await harness.router.drain()
+    await main.on_shutdown(main.dp)
+    await webhook._close_bot(main.dp)
+    for server in (telegram, openai_server, opencage):
+        await server.stop()
+
+    flows = {flow: summarize(samples) for flow, samples in harness.samples.items()}
+    for flow, timeouts in harness.timeouts.items():
+        flows[flow]["timeouts"] = timeouts
+    completed = sum(1 for duration, ok in harness.samples["report"] if ok)
+    return {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "elapsed_seconds": elapsed,
+        "throughput": {
+            "users_completed_per_second": completed / elapsed if elapsed else 0.0,
+            "flows_per_second": sum(flow["count"] - flow["errors"] for flow in flows.values()) / elapsed if elapsed else 0.0,
+        },
+        "flows": flows,
+        "event_loop_lag": probe.summary(),
+        "servers": {
+            "telegram": dict(telegram.stats(), calls=telegram.calls),
+            "openai": openai_server.stats(),
+            "opencage": opencage.stats(),
+        },
+        "bot": {
+            "outbox": main.outbox.stats(),
+            "chart_engine": main.chart_engine.stats(),
+            "subscriptions": main.subscription_cache.stats(),
+        },
+    }
+
+
+def print_summary(result):
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:.0f}"
+
+    print(f"{'flow':<14}{'count':>7}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for flow, stats in result["flows"].items():
+        print(f"{flow:<14}{stats['count']:>7}{stats['errors']:>8}{ms(stats['p50']):>9}{ms(stats['p95']):>9}"
+              f"{ms(stats['p99']):>9}{ms(stats['max']):>9}")
+    lag = result["event_loop_lag"]
+    print(f"elapsed {result['elapsed_seconds']:.1f}s, "
+          f"{result['throughput']['users_completed_per_second']:.2f} users/s, "
+          f"loop lag p99 {ms(lag['p99'])} ms, max {ms(lag['max'])} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20, help="число одновременных пользователей")
+    parser.add_argument("--ramp", type=float, default=5.0, help="за сколько секунд подключаются все пользователи")
+    parser.add_argument("--timeout", type=float, default=120.0, help="предельное время одного шага, с")
+    parser.add_argument("--telegram-latency", type=float, default=40.0, help="мс")
+    parser.add_argument("--openai-latency", type=float, default=400.0, help="мс до первого фрагмента")
+    parser.add_argument("--geocode-latency", type=float, default=150.0, help="мс")
+    parser.add_argument("--jitter", type=float, default=20.0, help="разброс задержки, мс")
+    parser.add_argument("--chunk-delay", type=float, default=5.0, help="пауза между фрагментами потока OpenAI, мс")
+    parser.add_argument("--telegram-errors", type=float, default=0.0, help="доля ответов 429/500 от Telegram")
+    parser.add_argument("--openai-errors", type=float, default=0.0, help="доля ответов 500 от OpenAI")
+    parser.add_argument("--geocode-errors", type=float, default=0.0, help="доля ответов 503 от OpenCage")
+    parser.add_argument("--send-rate", type=float, default=30.0, help="SEND_GLOBAL_RATE бота")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", help="файл для JSON-результата (иначе stdout)")
+    args = parser.parse_args()
+    args.output = os.path.abspath(args.output) if args.output else None
+
+    result = asyncio.run(run(args))
+    print_summary(result)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    else:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Рассылка «Транзиты дня» на синтетической базе пользователей.
+
+    python benchmarks/transits_bench.py --users 100000
+
+Пользователи со случайными натальными долготами записываются во временное хранилище (users.db), затем
+замеряются этапы: чтение пользователей, векторный поиск аспектов (и для сравнения — поштучный расчёт
+через chart_analytics на части пользователей), группировка, запись плана, сборка сообщений (GPT
+заменён заглушкой) и проход доставки через заглушку очереди без ограничения скорости.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+import transits
+from chart_analytics import find_aspects
+from user_store import UserStore
+
+
+class FakeGateway:
+    def __init__(self):
+        self.calls = 0
+
+    async def complete(self, prompt, model, kind, **kwargs):
+        self.calls += 1
+        return f"Совет дня ({kind})"
+
+
+class FakeOutbox:
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+
+
+def fill_store(path, users, seed):
+    rng = random.Random(seed)
+    data = {
+        str(100000000 + i): {"planets": {
+            body: {"sign": "Aries", "degree": rng.uniform(0, 360), "house": "House1"} for body in transits.NATAL_BODIES
+        }} for i in range(users)
+    }
+    json_path = os.path.join(os.path.dirname(path), "users.json")
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    store = UserStore(path)
+    store.migrate_from_json(json_path)
+    return store
+
+
+def per_user(natal_lons, sky, orbs):
+    """Поштучный расчёт: find_aspects для каждого пользователя, отбор транзитных пар с орбисом по транзитному телу."""
+    names = list(transits.TRANSIT_BODIES) + [f"natal {body}" for body in transits.NATAL_BODIES]
+    body_orbs = dict(zip(transits.TRANSIT_BODIES, orbs))
+    aspect_orbs = {name: 360.0 for name, _ in transits.ASPECTS}
+    result = []
+    for lons in natal_lons:
+        aspects = find_aspects(names, list(sky) + list(lons), aspect_orbs, body_orbs)
+        result.append([a for a in aspects if a[0] in body_orbs and a[1].startswith("natal")][:transits.MAX_ASPECTS])
+    return result
+
+
+def timed(name, func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    print(f"{name:<34} {time.perf_counter() - started:8.3f} s")
+    return result
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк рассылки транзитов")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--baseline", type=int, default=5000, help="пользователей для поштучного расчёта")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    day = date(2026, 1, 15)
+    with tempfile.TemporaryDirectory() as workdir:
+        user_store = timed("fill users.db", fill_store, os.path.join(workdir, "users.db"), args.users, args.seed)
+        sky = transits.sky_longitudes(day)
+        ids, natal_lons = timed("load users", transits.natal_longitudes, user_store.iter_users())
+        codes = timed("aspects (numpy, all users)", transits.transit_aspects, natal_lons, sky)
+        sample = natal_lons[:args.baseline]
+        baseline = timed(f"aspects (per user, {len(sample)} users)", per_user, sample, sky, transits.transit_orbs())
+        found = sum(1 for row in codes[:len(sample)] for code in row if code >= 0)
+        print(f"  per-user aspects {sum(map(len, baseline))}, numpy {found} (same orbs, top {transits.MAX_ASPECTS})")
+        sets, inverse = timed("group users", transits.group_users, codes)
+        leads = len({int(row[0]) for row in sets if row[0] >= 0})
+        print(f"  {len(sets)} groups, {leads} distinct main aspects, largest group {np.bincount(inverse).max()} users")
+
+        store = transits.TransitStore(os.path.join(workdir, "transits.db"))
+        gateway, outbox = FakeGateway(), FakeOutbox()
+        broadcast = transits.TransitBroadcast(store, user_store, outbox, gateway, rate=1e9, window=1000, page=1000, max_texts=300)
+        for name, step in (("prepare (load + plan + write)", broadcast.prepare), ("generate messages", broadcast.generate),
+                           ("deliver (no rate limit)", broadcast.deliver)):
+            started = time.perf_counter()
+            await step(day)
+            print(f"{name:<34} {time.perf_counter() - started:8.3f} s")
+        print(f"  GPT calls {gateway.calls}, messages {outbox.sent}, {store.counts(day.isoformat())}")
+        print(f"  delivery at 20 msg/s: {outbox.sent / 20 / 60:.0f} min")
+        store.close()
+        user_store.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,111 @@
+"""Векторизованный расчёт аспектов и домов по снимку карты (numpy).
+
+Аспекты ищутся сразу по матрице угловых расстояний между всеми телами, дома — бинарным
+поиском по куспидам, отсчитанным от первого дома.
+"""
+import numpy as np
+
+# Порядок важен: при равном попадании в два орбиса выбирается аспект, указанный раньше
+ASPECTS = (
+    ("соединение", 0.0),
+    ("секстиль", 60.0),
+    ("квадрат", 90.0),
+    ("тригон", 120.0),
+    ("оппозиция", 180.0),
+)
+
+# Орбис по аспекту (градусы)
+ASPECT_ORBS = {name: 15.0 for name, _ in ASPECTS}
+
+# Ограничение орбиса по телу: для пары берётся меньшее из ограничений обоих тел.
+# Личные планеты не ограничены, поэтому их аспекты между собой считаются с орбисом аспекта.
+BODY_ORBS = {
+    "Jupiter": 9.0,
+    "Saturn": 9.0,
+    "Uranus": 5.0,
+    "Neptune": 5.0,
+    "Pluto": 5.0,
+    "Chiron": 3.0,
+    "North Node": 3.0,
+    "South Node": 3.0,
+    "Asc": 5.0,
+    "MC": 5.0,
+}
+
+# Тела, участвующие в аспектах (Сизигия и Парс Фортуны — расчётные точки, в аспектах не учитываются)
+ASPECT_BODIES = (
+    "Sun", "Moon", "Mercury", "Venus", "Mars", "Jupiter", "Saturn",
+    "Uranus", "Neptune", "Pluto", "Chiron", "North Node", "South Node", "Asc", "MC",
+)
+
+# Пары, аспект между которыми задан построением (узлы всегда в оппозиции)
+EXCLUDED_PAIRS = {frozenset(("North Node", "South Node"))}
+
+_ANGLES = np.array([angle for _, angle in ASPECTS])
+_PAIRS = {}
+
+
+def angular_distances(lons):
+    """Матрица кратчайших угловых расстояний (0–180°) между всеми парами долгот."""
+    lons = np.asarray(lons, dtype=float)
+    diff = np.abs(lons[:, None] - lons[None, :])
+    return np.minimum(diff, 360 - diff)
+
+
+def find_aspects(names, lons, aspect_orbs=None, body_orbs=None):
+    """Аспекты между телами: список (тело1, тело2, расстояние, аспект), самые точные — первыми."""
+    aspect_orbs = ASPECT_ORBS if aspect_orbs is None else aspect_orbs
+    body_orbs = BODY_ORBS if body_orbs is None else body_orbs
+    names = list(names)
+    if len(names) < 2:
+        return []
+    if len(names) not in _PAIRS:
+        _PAIRS[len(names)] = np.triu_indices(len(names), k=1)
+    first, second = _PAIRS[len(names)]
+    distances = angular_distances(lons)[first, second]
+
+    limits = np.array([body_orbs.get(name, np.inf) for name in names])
+    pair_limit = np.minimum(limits[first], limits[second])
+    orbs = np.minimum([aspect_orbs.get(name, 0.0) for name, _ in ASPECTS], pair_limit[:, None])
+
+    deviation = np.abs(distances[:, None] - _ANGLES)
+    matches = deviation <= orbs
+    found = matches.any(axis=1)
+    aspect_index = matches.argmax(axis=1)
+
+    pairs = np.flatnonzero(found)
+    exactness = deviation[pairs, aspect_index[pairs]]
+    pairs = pairs[np.argsort(exactness, kind="stable")].tolist()
+    first, second, distances, aspect_index = first.tolist(), second.tolist(), distances.tolist(), aspect_index.tolist()
+    return [
+        (names[first[i]], names[second[i]], distances[i], ASPECTS[aspect_index[i]][0])
+        for i in pairs if frozenset((names[first[i]], names[second[i]])) not in EXCLUDED_PAIRS
+    ]
+
+
+def house_numbers(cusps, lons):
+    """Номера домов (1–12) для всех долгот; `cusps` — долготы куспидов по порядку домов.
+
+    Тело ровно на куспиде относится к предыдущему дому, на куспиде первого дома — к первому.
+    """
+    cusps = np.asarray(cusps, dtype=float)
+    offsets = (cusps - cusps[0]) % 360
+    relative = (np.asarray(lons, dtype=float) - cusps[0]) % 360
+    return np.maximum(np.searchsorted(offsets, relative, side="left"), 1)
+
+
+def chart_houses(chart, names):
+    """Дома тел карты: {тело: id дома}; отсутствующие в карте тела пропускаются."""
+    bodies = [chart.get(name) for name in names]
+    present = [body for body in bodies if body is not None]
+    if not present:
+        return {}
+    houses = list(chart.houses)
+    numbers = house_numbers([house.lon for house in houses], [body.lon for body in present])
+    return {body.id: houses[number - 1].id for body, number in zip(present, numbers)}
+
+
+def chart_aspects(chart, names=ASPECT_BODIES, aspect_orbs=None, body_orbs=None):
+    """Аспекты между телами карты (отсутствующие в карте тела пропускаются)."""
+    bodies = [body for body in (chart.get(name) for name in names) if body is not None]
+    return find_aspects([body.id for body in bodies], [body.lon for body in bodies], aspect_orbs, body_orbs)
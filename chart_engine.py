@@ -0,0 +1,201 @@
+"""Построение натальных карт в пуле процессов с LRU-кэшем готовых снимков.
+
+Если подключена таблица эфемерид (ephemeris_table.py), положения тел берутся из неё прямо в процессе бота,
+а по Swiss Ephemeris считаются только дома и углы; даты вне таблицы считаются полностью в пуле.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from flatlib import const
+from flatlib.chart import Chart
+from flatlib.datetime import Datetime
+from flatlib.ephem import eph
+from flatlib.geopos import GeoPos
+
+Body = namedtuple("Body", "id sign lon signlon lonspeed")
+House = namedtuple("House", "id sign lon size")
+
+
+class ChartSnapshot(namedtuple("ChartSnapshot", "date time lat lon hsys objects houses angles")):
+    """Неизменяемый снимок карты из простых данных: дешёво передаётся между процессами и хранится в кэше.
+
+    Повторяет используемую ботом часть интерфейса flatlib Chart: get(id), objects, houses.
+    """
+
+    __slots__ = ()
+
+    def get(self, id):
+        for body in self.objects + self.angles + self.houses:
+            if body.id == id:
+                return body
+        return None
+
+
+def _body(obj):
+    return Body(obj.id, obj.sign, obj.lon, obj.signlon, getattr(obj, "lonspeed", 0.0))
+
+
+def compute_snapshot(date, time_str, lat, lon, hsys=const.HOUSES_DEFAULT, ids=None):
+    """Расчёт карты flatlib (Swiss Ephemeris) и извлечение данных; выполняется в рабочем процессе.
+
+    `date` и `time_str` — UTC в форматах flatlib (ГГГГ/ММ/ДД, ЧЧ:ММ), `lat`/`lon` — строки вида 55n45.
+    """
+    chart = Chart(Datetime(date, time_str, "+00:00"), GeoPos(lat, lon), hsys=hsys,
+                  IDs=ids or const.LIST_OBJECTS_TRADITIONAL)
+    return ChartSnapshot(
+        date, time_str, lat, lon, hsys,
+        objects=tuple(_body(obj) for obj in chart.objects),
+        houses=tuple(House(house.id, house.sign, house.lon, house.size) for house in chart.houses),
+        angles=tuple(_body(angle) for angle in chart.angles)
+    )
+
+
+def table_snapshot(table, date, time_str, lat, lon, hsys=const.HOUSES_DEFAULT, ids=None):
+    """Снимок карты: тела — по таблице эфемерид, дома и углы — по Swiss Ephemeris; None, если дата вне таблицы."""
+    jd = Datetime(date, time_str, "+00:00").jd
+    if not table.covers(jd):
+        return None
+    pos = GeoPos(lat, lon)
+    bodies = table.bodies_at(jd)
+    houses, angles = eph.getHouses(jd, pos.lat, pos.lon, hsys)
+    return ChartSnapshot(
+        date, time_str, lat, lon, hsys,
+        objects=tuple(
+            Body(id, const.LIST_SIGNS[min(int(bodies[id][0] / 30), 11)], bodies[id][0], bodies[id][0] % 30, bodies[id][1])
+            for id in ids or const.LIST_OBJECTS_TRADITIONAL
+        ),
+        houses=tuple(House(house["id"], house["sign"], house["lon"], house["size"]) for house in houses),
+        angles=tuple(Body(angle["id"], angle["sign"], angle["lon"], angle["signlon"], 0.0) for angle in angles)
+    )
+
+
+def _warm_up_worker():
+    # Первый расчёт загружает файлы эфемерид в процесс
+    compute_snapshot("2000/01/01", "12:00", "0n00", "0e00")
+
+
+class ChartEngine:
+    """Асинхронный расчёт карт вне event loop с кэшем по (UTC-минута, координаты, система домов).
+
+    Координаты приходят строками с точностью до угловой минуты, так что близкие точки
+    (в пределах ~1,8 км) попадают в одну запись кэша.
+    """
+
+    def __init__(self, workers=2, max_size=2048, ids=None, table_path=None):
+        self.workers = workers
+        self.max_size = max_size
+        self.ids = ids
+        self.table_path = table_path
+        self.table = None
+        self._pool = None
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.compute_time = 0.0
+        self.table_charts = 0
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def load_table(self):
+        """Подключение таблицы эфемерид, если задан путь и в таблице есть все тела карты."""
+        if self.table is not None or not self.table_path:
+            return self.table
+        # numpy и таблица загружаются только при подключении (обычно во время прогрева)
+        from ephemeris_table import SUPPORTED, load
+        missing = set(self.ids or const.LIST_OBJECTS_TRADITIONAL) - SUPPORTED
+        if missing:
+            logging.warning(f"Ephemeris table not used: no {', '.join(sorted(missing))} in the table")
+            return None
+        self.table = load(self.table_path)
+        return self.table
+
+    def _cached(self, key):
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+            return None
+
+    def _store(self, key, snapshot, elapsed):
+        with self._lock:
+            self.misses += 1
+            self.compute_time += elapsed
+            self._cache[key] = snapshot
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    async def chart(self, dt_utc, lat, lon, hsys=const.HOUSES_DEFAULT):
+        """Снимок карты на момент `dt_utc` (aware datetime в UTC) для координат в формате flatlib."""
+        date, time_str = dt_utc.strftime("%Y/%m/%d"), dt_utc.strftime("%H:%M")
+        key = (date, time_str, lat, lon, hsys)
+        snapshot = self._cached(key)
+        if snapshot is not None:
+            return snapshot
+        if self.table is not None:
+            snapshot = self._from_table(key)
+            if snapshot is not None:
+                return snapshot
+        # Одинаковые одновременные запросы ждут один расчёт
+        pending = self._pending.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        future = self._pending[key] = asyncio.ensure_future(self._compute(key))
+        return await asyncio.shield(future)
+
+    def _from_table(self, key):
+        started = time.perf_counter()
+        snapshot = table_snapshot(self.table, *key, ids=self.ids)
+        if snapshot is not None:
+            self.table_charts += 1
+            self._store(key, snapshot, time.perf_counter() - started)
+            logging.debug("Chart from ephemeris table (%s %s, %s %s)", *key[:4])
+        return snapshot
+
+    async def _compute(self, key):
+        date, time_str, lat, lon, hsys = key
+        started = time.perf_counter()
+        try:
+            snapshot = await asyncio.get_event_loop().run_in_executor(
+                self._get_pool(), compute_snapshot, date, time_str, lat, lon, hsys, self.ids
+            )
+        finally:
+            self._pending.pop(key, None)
+        elapsed = time.perf_counter() - started
+        self._store(key, snapshot, elapsed)
+        logging.info(f"Chart computed in {elapsed * 1000:.0f} ms ({date} {time_str}, {lat} {lon})")
+        return snapshot
+
+    async def warm_up(self):
+        """Подключение таблицы эфемерид, запуск рабочих процессов и загрузка эфемерид заранее."""
+        await asyncio.get_event_loop().run_in_executor(None, self.load_table)
+        await asyncio.gather(*[
+            asyncio.get_event_loop().run_in_executor(self._get_pool(), _warm_up_worker)
+            for _ in range(self.workers)
+        ])
+        logging.info(f"Chart engine ready ({self.workers} workers, table {'on' if self.table is not None else 'off'})")
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._cache),
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "avg_compute_ms": round(self.compute_time / self.misses * 1000, 1) if self.misses else 0.0,
+            "table_charts": self.table_charts,
+        }
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,95 @@
+"""Отправка PDF с повторным использованием file_id Telegram.
+
+Первый раз документ загружается байтами, дальше отправляется по file_id из ответа Telegram
+(без повторной передачи файла). Если Telegram не принимает сохранённый file_id, документ
+создаётся заново через `produce()` и загружается ещё раз.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+
+from aiogram import types
+from aiogram.utils.exceptions import BadRequest
+
+import metrics
+
+
+def file_hash(path):
+    """Хэш содержимого файла для ключа кэша file_id."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(65536), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FileIdCache:
+    """file_id загруженных документов по ключу (например, хэшу содержимого) с сохранением в JSON-файл."""
+
+    def __init__(self, path):
+        self.path = path
+        self._data = {}
+        self.load()
+
+    def get(self, key):
+        return self._data.get(key)
+
+    def put(self, key, file_id):
+        self._data[key] = file_id
+        self.save()
+
+    def load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._data = json.load(f)
+        except Exception as e:
+            logging.error(f"Error loading {self.path}: {e}", exc_info=True)
+
+    def save(self):
+        """Атомарная запись на диск."""
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._data, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logging.error(f"Error saving {self.path}: {e}", exc_info=True)
+
+
+class DocumentDelivery:
+    """Отправка документов через очередь исходящих сообщений с приоритетом file_id."""
+
+    def __init__(self, outbox, cache):
+        self.outbox = outbox
+        self.cache = cache
+
+    async def send(self, chat_id, produce, filename, file_id=None, kind="document", **kwargs):
+        """Отправка по `file_id`, а если его нет или он устарел — загрузка байтов из `produce()`.
+
+        Возвращает file_id отправленного документа (его стоит сохранить для следующих отправок).
+        """
+        if file_id:
+            try:
+                await self.outbox.send_document(chat_id, file_id, **kwargs)
+                metrics.DOCUMENT_SENDS.inc(kind=kind, source="file_id")
+                return file_id
+            except BadRequest as e:
+                logging.warning(f"Stale file_id for {kind} in chat {chat_id}: {e}")
+        content = await produce()
+        message = await self.outbox.send_document(chat_id, types.InputFile(io.BytesIO(content), filename=filename), **kwargs)
+        metrics.DOCUMENT_SENDS.inc(kind=kind, source="upload")
+        return message.document.file_id
+
+    async def send_cached(self, chat_id, key, produce, filename, kind="document", **kwargs):
+        """Отправка документа, file_id которого хранится в общем кэше под `key`."""
+        cached = self.cache.get(key)
+        file_id = await self.send(chat_id, produce, filename, file_id=cached, kind=kind, **kwargs)
+        if file_id != cached:
+            self.cache.put(key, file_id)
+        return file_id
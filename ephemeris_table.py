@@ -0,0 +1,216 @@
+"""Предрасчитанная таблица долгот тел с доступом через memory-map.
+
+Долготы тел зависят только от момента UTC, поэтому они считаются заранее по Swiss Ephemeris с шагом
+`--step` часов и хранятся в .npy-файле (описание — в соседнем .json). Произвольная минута получается
+линейной интерполяцией между соседними строками. Файл открывается через np.load(mmap_mode="r"):
+страницы читаются по требованию и без копирования разделяются всеми процессами через кэш ОС.
+Дома и углы зависят от места и по-прежнему считаются по полным эфемеридам.
+
+    python ephemeris_table.py build --start 1900 --end 2100 --step 1
+    python ephemeris_table.py validate --samples 5000
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import flatlib
+import numpy as np
+import swisseph
+from flatlib import const
+from flatlib.ephem import eph, swe
+
+EPHEMERIS_TABLE = "./ephemeris.npy"
+
+# Тела в таблице (порядок столбцов); Южный узел — Северный узел + 180°
+TABLE_BODIES = (
+    const.SUN, const.MOON, const.MERCURY, const.VENUS, const.MARS, const.JUPITER, const.SATURN,
+    const.URANUS, const.NEPTUNE, const.PLUTO, const.CHIRON, const.NORTH_NODE,
+)
+SUPPORTED = frozenset(TABLE_BODIES + (const.SOUTH_NODE,))
+
+# Допустимое расхождение с flatlib: долгота (градусы, ~3,6″) и скорость (градусы в сутки). Скорость по таблице —
+# средняя за шаг, поэтому у быстрых Луны и Меркурия допуск больше
+LON_TOLERANCE = 0.001
+SPEED_TOLERANCE = 0.001
+SPEED_TOLERANCES = {const.MOON: 0.02, const.MERCURY: 0.01}
+
+# float64: в float32 около 300° шаг значений ~3e-5°, и у медленных планет у стоянки соседние строки совпадают,
+# а скорость выходит ровно 0 (или квантуется с шагом ~7e-4°/сутки — десятая часть скорости Нептуна)
+DTYPE = np.float64
+
+CHUNK_ROWS = 20000
+
+
+def julian_day(year, month=1, day=1, hour=0.0):
+    """Юлианская дата UT (григорианский календарь)."""
+    return swisseph.julday(year, month, day, hour)
+
+
+def _compute_rows(jd0, step, start, count):
+    """Долготы всех тел таблицы для строк [start, start + count); выполняется в рабочем процессе."""
+    rows = np.empty((count, len(TABLE_BODIES)), dtype=DTYPE)
+    ids = [swe.SWE_OBJECTS[body] for body in TABLE_BODIES]
+    for i in range(count):
+        jd = jd0 + (start + i) * step
+        for j, swe_id in enumerate(ids):
+            rows[i, j] = swisseph.calc_ut(jd, swe_id)[0][0]
+    return start, rows
+
+
+def build(path, start_year=1900, end_year=2100, step_hours=1.0, workers=None):
+    """Расчёт таблицы с 1 января `start_year` по 1 января `end_year + 1` и атомарная запись на диск."""
+    jd0 = julian_day(start_year)
+    step = step_hours / 24
+    rows = int(math.ceil((julian_day(end_year + 1) - jd0) / step)) + 1
+    tmp_path = f"{path}.tmp.npy"
+    data = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=DTYPE, shape=(rows, len(TABLE_BODIES)))
+    started = time.perf_counter()
+    chunks = [(start, min(CHUNK_ROWS, rows - start)) for start in range(0, rows, CHUNK_ROWS)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_compute_rows, jd0, step, start, count) for start, count in chunks]
+        for done, future in enumerate(futures, 1):
+            start, block = future.result()
+            data[start:start + len(block)] = block
+            if done % 10 == 0 or done == len(futures):
+                logging.info(f"Ephemeris table: {done}/{len(futures)} chunks ({time.perf_counter() - started:.0f}s)")
+    data.flush()
+    del data
+    meta = {
+        "jd0": jd0, "step_hours": step_hours, "rows": rows, "bodies": list(TABLE_BODIES),
+        "start_year": start_year, "end_year": end_year,
+    }
+    with open(f"{path}.json.tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, path)
+    os.replace(f"{path}.json.tmp", f"{path}.json")
+    logging.info(f"Ephemeris table {path}: {rows} rows, {os.path.getsize(path) / 2 ** 20:.0f} MiB")
+    return meta
+
+
+class EphemerisTable:
+    """Долготы и скорости тел на произвольные моменты (юлианские даты UT) по таблице."""
+
+    def __init__(self, data, jd0, step_hours, bodies=TABLE_BODIES):
+        self.data = data
+        self.jd0 = jd0
+        self.step = step_hours / 24
+        self.bodies = tuple(bodies)
+        self.jd_end = jd0 + (len(data) - 1) * self.step
+
+    @classmethod
+    def open(cls, path):
+        """Таблица из файла, открытого через memory-map."""
+        with open(f"{path}.json", encoding="utf-8") as f:
+            meta = json.load(f)
+        data = np.load(path, mmap_mode="r")
+        if data.shape != (meta["rows"], len(meta["bodies"])):
+            raise ValueError(f"Ephemeris table {path} shape {data.shape} does not match its metadata")
+        if data.dtype != DTYPE:
+            raise ValueError(f"Ephemeris table {path} stores {data.dtype}, rebuild it (python ephemeris_table.py build)")
+        return cls(data, meta["jd0"], meta["step_hours"], meta["bodies"])
+
+    def covers(self, jd):
+        """Все моменты `jd` попадают в диапазон таблицы."""
+        jd = np.asarray(jd, dtype=float)
+        return bool(np.all((jd >= self.jd0) & (jd < self.jd_end)))
+
+    def positions(self, jd):
+        """Долготы (n × тела, градусы) и скорости (градусы в сутки) для массива моментов `jd`."""
+        offset = (np.atleast_1d(np.asarray(jd, dtype=float)) - self.jd0) / self.step
+        index = np.floor(offset).astype(np.int64)
+        frac = (offset - index)[:, None]
+        before = self.data[index].astype(float)
+        # Разность с учётом перехода через 0°/360° (за шаг тело проходит меньше 180°)
+        delta = (self.data[index + 1] - before + 180.0) % 360.0 - 180.0
+        lons = (before + frac * delta) % 360.0
+        # Остаток от очень малого отрицательного числа округляется до 360.0
+        lons[lons >= 360.0] = 0.0
+        return lons, delta / self.step
+
+    def bodies_at(self, jd):
+        """{тело: (долгота, скорость)} на момент `jd`, включая Южный узел."""
+        lons, speeds = self.positions(jd)
+        result = {body: (float(lons[0, i]), float(speeds[0, i])) for i, body in enumerate(self.bodies)}
+        if const.NORTH_NODE in result:
+            lon, speed = result[const.NORTH_NODE]
+            result[const.SOUTH_NODE] = ((lon + 180.0) % 360.0, speed)
+        return result
+
+    def max_errors(self, samples=1000, seed=None):
+        """Наибольшие расхождения с flatlib по телам на `samples` случайных минутах: {тело: (долгота, скорость)}."""
+        # Swiss Ephemeris хранит путь к файлам отдельно для каждого потока, а проверка может идти в пуле потоков
+        swe.setPath(flatlib.PATH_RES + "swefiles")
+        rng = random.Random(seed)
+        errors = {body: (0.0, 0.0) for body in self.bodies}
+        # Минуты внутри диапазона, как у дат рождения в боте
+        minutes = int((self.jd_end - self.jd0) * 1440) - 1
+        for _ in range(samples):
+            jd = self.jd0 + rng.randrange(minutes) / 1440
+            for body, (lon, speed) in self.bodies_at(jd).items():
+                if body not in errors:
+                    continue
+                reference = eph.getObject(body, jd, 0.0, 0.0)
+                lon_error = abs((lon - reference["lon"] + 180.0) % 360.0 - 180.0)
+                speed_error = abs(speed - reference["lonspeed"])
+                errors[body] = (max(errors[body][0], lon_error), max(errors[body][1], speed_error))
+        return errors
+
+    def validate(self, samples=1000, seed=None):
+        """Проверка по flatlib; возвращает список тел с расхождением выше допуска."""
+        return out_of_tolerance(self.max_errors(samples, seed))
+
+
+def out_of_tolerance(errors):
+    return [
+        body for body, (lon_error, speed_error) in errors.items()
+        if lon_error > LON_TOLERANCE or speed_error > SPEED_TOLERANCES.get(body, SPEED_TOLERANCE)
+    ]
+
+
+def load(path, samples=50):
+    """Таблица с быстрой проверкой по flatlib или None, если файла нет или проверка не прошла."""
+    if not os.path.exists(path):
+        logging.info(f"Ephemeris table {path} not found, charts use the full ephemeris")
+        return None
+    started = time.perf_counter()
+    try:
+        table = EphemerisTable.open(path)
+        failed = table.validate(samples)
+    except Exception as e:
+        logging.error(f"Error loading ephemeris table {path}: {e}", exc_info=True)
+        return None
+    if failed:
+        logging.error(f"Ephemeris table {path} disabled: mismatch with flatlib for {', '.join(failed)}")
+        return None
+    logging.info(f"Ephemeris table {path} loaded in {time.perf_counter() - started:.2f}s ({len(table.data)} rows)")
+    return table
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    parser = argparse.ArgumentParser(description="Таблица эфемерид для быстрых расчётов карт")
+    parser.add_argument("command", choices=["build", "validate"])
+    parser.add_argument("--path", default=os.getenv("EPHEMERIS_TABLE", EPHEMERIS_TABLE))
+    parser.add_argument("--start", type=int, default=1900, help="первый год")
+    parser.add_argument("--end", type=int, default=2100, help="последний год")
+    parser.add_argument("--step", type=float, default=1.0, help="шаг таблицы в часах")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--samples", type=int, default=5000)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build(args.path, args.start, args.end, args.step, args.workers)
+    table = EphemerisTable.open(args.path)
+    errors = table.max_errors(args.samples)
+    for body, (lon_error, speed_error) in errors.items():
+        print(f"{body:<12} lon {lon_error * 3600:7.3f}″  speed {speed_error:.4f}°/day")
+    failed = out_of_tolerance(errors)
+    print("OK" if not failed else f"FAILED: {', '.join(failed)}")
+    sys.exit(1 if failed else 0)
@@ -1,11 +1,4 @@
-from fpdf import FPDF
-
-pdf = FPDF()
-pdf.add_page()
-
-# Добавляем шрифт с поддержкой кириллицы (должен лежать рядом с файлом)
-pdf.add_font("DejaVu", "", "DejaVuSans.ttf", uni=True)
-pdf.set_font("DejaVu", size=12)
+from pdf_renderer import render_file
 
 content = [
     "🌞 Солнце в Весах — стремление к гармонии, дипломатичность, любовь к красоте и балансу.",
@@ -23,8 +16,7 @@ content = [
     "💰 Финансовый потенциал: благоприятен в сфере консультирования и искусства.",
 ]
 
-for line in content:
-    pdf.multi_cell(0, 10, line)
-
-pdf.output("example_paid_astrology_report.pdf")
-print("✅ Файл example_paid_astrology_report.pdf создан!")
+if __name__ == "__main__":
+    # Шрифт DejaVu с поддержкой кириллицы подключает pdf_renderer
+    render_file("lines", content, "example_paid_astrology_report.pdf")
+    print("✅ Файл example_paid_astrology_report.pdf создан!")
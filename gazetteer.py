@@ -0,0 +1,356 @@
+"""Локальный геокодер по выгрузке GeoNames (cities500.txt, cities15000.txt и т. п.).
+
+Индекс — один .npy-файл (байтовый массив) с описанием разделов в соседнем .json: идентификаторы GeoNames,
+координаты и население мест (по возрастанию идентификатора), отсортированные ключи названий, списки мест для
+каждого названия и триграммный индекс названий.
+Файл открывается через np.load(mmap_mode="r"), поэтому запуск не зависит от размера выгрузки, а страницы
+разделяются всеми процессами через кэш ОС.
+
+Названия (основное, ASCII и альтернативные на кириллице) и запрос приводятся к одному ключу: нормализация
+как для кэша OpenCage, транслитерация кириллицы и удаление диакритики («Александров» и «Aleksandrov» дают
+`aleksandrov`). Точное совпадение ищется двоичным поиском, опечатки — по общим триграммам с проверкой
+расстояния Дамерау — Левенштейна; среди найденных мест выше стоят более точные и более населённые.
+
+    python gazetteer.py build --source cities500.txt --admin1 admin1CodesASCII.txt
+    python gazetteer.py search "Александров"
+"""
+import argparse
+import bisect
+import json
+import logging
+import os
+import re
+import time
+import unicodedata
+from collections import namedtuple
+
+import numpy as np
+
+from geocoding import normalize_city, place_label
+
+GAZETTEER = "./gazetteer.npy"
+
+# Символы ключа; остальные заменяются пробелом. Триграмма кодируется числом в системе счисления ALPHABET
+ALPHABET = " abcdefghijklmnopqrstuvwxyz0123456789"
+TRIGRAMS = len(ALPHABET) ** 3
+
+# Название считается неоднозначным, если второе по населению место с тем же названием больше 1/DOMINANCE первого
+DOMINANCE = 20
+# Сколько названий с наибольшим числом общих триграмм проверяется на опечатки
+MAX_CANDIDATES = 200
+
+Place = namedtuple("Place", "index geonameid name region country lat lon population distance")
+
+_TRANSLIT = str.maketrans({
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e", "ж": "zh", "з": "z", "и": "i",
+    "й": "y", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t",
+    "у": "u", "ф": "f", "х": "kh", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "shch", "ъ": "", "ы": "y", "ь": "",
+    "э": "e", "ю": "yu", "я": "ya", "і": "i", "ї": "yi", "є": "ye", "ґ": "g", "ў": "u",
+})
+_CYRILLIC_RE = re.compile(r"[а-яёіїєґў]", re.IGNORECASE)
+_NON_KEY_RE = re.compile(r"[^a-z0-9]+")
+_CODES = {c: i for i, c in enumerate(ALPHABET)}
+
+
+def name_key(name):
+    """Ключ названия: нижний регистр, транслитерация, без диакритики и знаков препинания."""
+    text = unicodedata.normalize("NFKD", name.lower().translate(_TRANSLIT))
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return _NON_KEY_RE.sub(" ", text).strip()
+
+
+def query_key(city):
+    """Ключ запроса пользователя (с сокращениями и префиксами «г.», «пгт» и т. п.)."""
+    return name_key(normalize_city(city))
+
+
+def trigrams(key):
+    """Коды триграмм ключа, дополненного пробелами с обеих сторон."""
+    padded = f" {key} "
+    return {
+        (_CODES[padded[i]] * len(ALPHABET) + _CODES[padded[i + 1]]) * len(ALPHABET) + _CODES[padded[i + 2]]
+        for i in range(len(padded) - 2)
+    }
+
+
+def max_distance(key):
+    """Допустимое число опечаток для ключа такой длины."""
+    return 0 if len(key) <= 3 else 1 if len(key) <= 6 else 2
+
+
+def edit_distance(a, b, limit):
+    """Расстояние Дамерау — Левенштейна (с перестановкой соседних букв) или limit + 1, если оно больше limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous, current = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+    return current[-1]
+
+
+def read_admin1(path):
+    """{"RU.83": "Vladimir", ...} из admin1CodesASCII.txt."""
+    names = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) >= 2:
+                names[fields[0]] = fields[1]
+    return names
+
+
+def read_geonames(path, admin1=None, min_population=0):
+    """Населённые пункты выгрузки: (geonameid, название, регион, страна, широта, долгота, население, варианты названий)."""
+    admin1 = admin1 or {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 15 or fields[6] != "P":
+                continue
+            population = int(fields[14] or 0)
+            if population < min_population:
+                continue
+            alternates = [name for name in fields[3].split(",") if _CYRILLIC_RE.search(name)]
+            # Показываем кириллическое название, если оно есть
+            display = alternates[0] if alternates else fields[1]
+            region = admin1.get(f"{fields[8]}.{fields[10]}", "")
+            yield (int(fields[0]), display, region, fields[8], float(fields[4]), float(fields[5]), population,
+                   [fields[1], fields[2]] + alternates)
+
+
+def build(source, path, admin1_path=None, min_population=0):
+    """Индекс по выгрузке GeoNames `source` и атомарная запись в `path`."""
+    started = time.perf_counter()
+    admin1 = read_admin1(admin1_path) if admin1_path else None
+    geonameids, lats, lons, populations, labels, pairs = [], [], [], [], [], []
+    # Места по возрастанию geonameid: выбранное кнопкой место находится двоичным поиском
+    rows = sorted(read_geonames(source, admin1, min_population), key=lambda row: row[0])
+    for geonameid, display, region, country, lat, lon, population, variants in rows:
+        index = len(lats)
+        geonameids.append(geonameid)
+        lats.append(lat)
+        lons.append(lon)
+        populations.append(population)
+        labels.append("\t".join((display, region, country)).encode("utf-8"))
+        pairs.extend((key, index) for key in {name_key(name) for name in variants} if key)
+
+    # Названия по алфавиту; места одного названия — по убыванию населения
+    pairs.sort(key=lambda pair: (pair[0], -populations[pair[1]]))
+    names, name_offsets, name_places, place_offsets = [], [0], [], [0]
+    for key, index in pairs:
+        if not names or names[-1] != key:
+            if names:
+                place_offsets.append(len(name_places))
+            names.append(key)
+            name_offsets.append(name_offsets[-1] + len(key))
+        name_places.append(index)
+    place_offsets.append(len(name_places))
+
+    grams = [(code, i) for i, key in enumerate(names) for code in trigrams(key)]
+    grams.sort()
+    gram_codes = np.fromiter((code for code, _ in grams), dtype=np.int64, count=len(grams))
+
+    label_offsets = np.zeros(len(labels) + 1, dtype=np.uint32)
+    np.cumsum([len(label) for label in labels], out=label_offsets[1:])
+    sections = {
+        "geonameid": np.asarray(geonameids, dtype=np.uint32),
+        "lat": np.asarray(lats, dtype=np.float32),
+        "lon": np.asarray(lons, dtype=np.float32),
+        "population": np.asarray(populations, dtype=np.uint32),
+        "label_offsets": label_offsets,
+        "labels": np.frombuffer(b"".join(labels), dtype=np.uint8),
+        "name_offsets": np.asarray(name_offsets, dtype=np.uint32),
+        "names": np.frombuffer("".join(names).encode("ascii"), dtype=np.uint8),
+        "place_offsets": np.asarray(place_offsets, dtype=np.uint32),
+        "name_places": np.asarray(name_places, dtype=np.uint32),
+        "trigram_offsets": np.searchsorted(gram_codes, np.arange(TRIGRAMS + 1)).astype(np.uint32),
+        "trigram_names": np.fromiter((i for _, i in grams), dtype=np.uint32, count=len(grams)),
+    }
+
+    # Разделы выравниваются по 8 байт и лежат подряд в одном байтовом массиве
+    layout, size = {}, 0
+    for name, array in sections.items():
+        layout[name] = [size, array.dtype.str, len(array)]
+        size += (array.nbytes + 7) // 8 * 8
+    tmp_path = f"{path}.tmp.npy"
+    blob = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=(size,))
+    for name, array in sections.items():
+        offset = layout[name][0]
+        blob[offset:offset + array.nbytes] = array.view(np.uint8)
+    blob.flush()
+    del blob
+    meta = {"source": os.path.basename(source), "places": len(lats), "names": len(names), "sections": layout}
+    with open(f"{path}.json.tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, path)
+    os.replace(f"{path}.json.tmp", f"{path}.json")
+    logging.info(f"Gazetteer {path}: {len(lats)} places, {len(names)} names, "
+                 f"{size / 2 ** 20:.0f} MiB in {time.perf_counter() - started:.0f}s")
+    return meta
+
+
+class _Names:
+    """Отсортированные ключи названий как последовательность строк (для bisect)."""
+
+    def __init__(self, offsets, chars):
+        self.offsets = offsets
+        self.chars = chars
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.chars[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("ascii")
+
+
+class Gazetteer:
+    """Поиск населённых пунктов по индексу, открытому через memory-map."""
+
+    def __init__(self, sections):
+        for name, array in sections.items():
+            setattr(self, name, array)
+        self.keys = _Names(self.name_offsets, self.names)
+
+    @classmethod
+    def open(cls, path):
+        with open(f"{path}.json", encoding="utf-8") as f:
+            meta = json.load(f)
+        if "geonameid" not in meta["sections"]:
+            raise ValueError(f"{path} has no geonameid section, rebuild it")
+        blob = np.load(path, mmap_mode="r")
+        sections = {}
+        for name, (offset, dtype, count) in meta["sections"].items():
+            dtype = np.dtype(dtype)
+            sections[name] = blob[offset:offset + count * dtype.itemsize].view(dtype)
+        return cls(sections)
+
+    def __len__(self):
+        return len(self.lat)
+
+    def place(self, index, distance=0):
+        """Место по номеру в индексе или None."""
+        if not 0 <= index < len(self):
+            return None
+        label = self.labels[self.label_offsets[index]:self.label_offsets[index + 1]].tobytes().decode("utf-8")
+        name, region, country = label.split("\t")
+        # float32 хранит координаты с точностью около метра
+        return Place(index, int(self.geonameid[index]), name, region, country, round(float(self.lat[index]), 5),
+                     round(float(self.lon[index]), 5), int(self.population[index]), distance)
+
+    def by_geonameid(self, geonameid):
+        """Место по идентификатору GeoNames или None (номера мест меняются при пересборке, идентификаторы — нет)."""
+        if not 0 < geonameid < 2 ** 32:
+            return None
+        index = int(np.searchsorted(self.geonameid, geonameid))
+        if index < len(self) and self.geonameid[index] == geonameid:
+            return self.place(index)
+        return None
+
+    def _exact(self, key):
+        i = bisect.bisect_left(self.keys, key)
+        return [i] if i < len(self.keys) and self.keys[i] == key else []
+
+    def _prefix(self, key):
+        """Названия, начинающиеся с ключа (недописанный запрос: «Моск» → «Москва»)."""
+        i = bisect.bisect_left(self.keys, key)
+        found = []
+        while i < len(self.keys) and len(found) < MAX_CANDIDATES and self.keys[i].startswith(key):
+            found.append(i)
+            i += 1
+        return found
+
+    def _fuzzy(self, key, limit):
+        """Номера названий на расстоянии не больше `limit` от ключа: [(номер, расстояние)]."""
+        grams = trigrams(key)
+        postings = [self.trigram_names[self.trigram_offsets[g]:self.trigram_offsets[g + 1]] for g in grams]
+        postings = [p for p in postings if len(p)]
+        if not postings:
+            return []
+        ids, common = np.unique(np.concatenate(postings), return_counts=True)
+        # Замена, вставка или удаление буквы меняют не больше трёх триграмм, перестановка соседних — до четырёх
+        keep = common >= len(grams) - 4 * limit
+        ids, common = ids[keep], common[keep]
+        if len(ids) > MAX_CANDIDATES:
+            top = np.argpartition(-common, MAX_CANDIDATES)[:MAX_CANDIDATES]
+            ids = ids[top]
+        found = []
+        for i in ids.tolist():
+            distance = edit_distance(key, self.keys[i], limit)
+            if distance <= limit:
+                found.append((i, distance))
+        return found
+
+    def search(self, city, limit=5):
+        """Места по названию: точные совпадения, а если их нет — с опечатками и по началу названия;
+        при равном расстоянии выше более населённые."""
+        key = query_key(city)
+        if not key:
+            return []
+        matches = [(i, 0) for i in self._exact(key)]
+        if not matches:
+            matches = self._fuzzy(key, max_distance(key))
+            # Продолжение названия считается как одна опечатка
+            if len(key) >= 4:
+                matches += [(i, 1) for i in self._prefix(key)]
+        best = {}
+        for i, distance in matches:
+            for index in self.name_places[self.place_offsets[i]:self.place_offsets[i + 1]].tolist():
+                if index not in best or distance < best[index]:
+                    best[index] = distance
+        ranked = sorted(best.items(), key=lambda item: (item[1], -int(self.population[item[0]])))
+        return [self.place(index, distance) for index, distance in ranked[:limit]]
+
+    @staticmethod
+    def needs_choice(places):
+        """Нужно ли спросить пользователя: название набрано с опечаткой или места с ним сравнимы по населению."""
+        if not places:
+            return False
+        if places[0].distance > 0:
+            return True
+        return len(places) > 1 and places[1].distance == 0 and places[1].population * DOMINANCE > places[0].population
+
+
+def load(path):
+    """Индекс или None, если файла нет или он повреждён."""
+    if not os.path.exists(path):
+        logging.info(f"Gazetteer {path} not found, cities are geocoded by OpenCage")
+        return None
+    started = time.perf_counter()
+    try:
+        gazetteer = Gazetteer.open(path)
+        gazetteer.search("Москва")
+    except Exception as e:
+        logging.error(f"Error loading gazetteer {path}: {e}", exc_info=True)
+        return None
+    logging.info(f"Gazetteer {path} loaded in {time.perf_counter() - started:.2f}s ({len(gazetteer)} places)")
+    return gazetteer
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    parser = argparse.ArgumentParser(description="Локальный геокодер по выгрузке GeoNames")
+    parser.add_argument("command", choices=["build", "search"])
+    parser.add_argument("query", nargs="?", help="название для search")
+    parser.add_argument("--path", default=os.getenv("GAZETTEER", GAZETTEER))
+    parser.add_argument("--source", help="выгрузка GeoNames (cities500.txt, cities15000.txt, ...)")
+    parser.add_argument("--admin1", help="admin1CodesASCII.txt для названий регионов")
+    parser.add_argument("--min-population", type=int, default=0)
+    parser.add_argument("--limit", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        if not args.source:
+            parser.error("build requires --source")
+        build(args.source, args.path, args.admin1, args.min_population)
+    elif args.query:
+        gazetteer = Gazetteer.open(args.path)
+        for place in gazetteer.search(args.query, args.limit):
+            print(f"{place_label(place)}  ({place.lat:.4f}, {place.lon:.4f}, distance {place.distance})")
@@ -0,0 +1,281 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+
+import aiohttp
+
+import metrics
+
+OPENCAGE_URL = "https://api.opencagedata.com/geocode/v1/json"
+
+# Распространённые сокращения и разговорные названия городов
+CITY_ALIASES = {
+    "спб": "санкт петербург",
+    "питер": "санкт петербург",
+    "с петербург": "санкт петербург",
+    "ст петербург": "санкт петербург",
+    "мск": "москва",
+    "екб": "екатеринбург",
+    "нск": "новосибирск",
+    "нн": "нижний новгород",
+    "н новгород": "нижний новгород",
+    "ст оскол": "старый оскол",
+}
+
+# Префиксы типа населённого пункта: «г. Казань», «город Казань», «пгт Васильево». Сокращения снимаются
+# только с точкой: «С» и «Ст» без точки бывают частью названия, а «Ст. Оскол» раскрывается через CITY_ALIASES
+_PREFIX_RE = re.compile(
+    r"^(?:(?:г|гор|пос|с|д|дер|ст)\.\s*|(?:город|посёлок|поселок|пгт|село|деревня|станица)\.?\s+)"
+)
+_PUNCT_RE = re.compile(r"[.,\-–—_/()\"']+")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_city(city):
+    """Нормализация названия города для ключа кэша."""
+    name = _SPACE_RE.sub(" ", city.strip().lower().replace("ё", "е"))
+    # Сокращения проверяются до снятия префиксов: «Ст. Петербург», «Ст. Оскол»
+    alias = CITY_ALIASES.get(_strip_punct(name))
+    if alias:
+        return alias
+    name = _strip_punct(_PREFIX_RE.sub("", name))
+    return CITY_ALIASES.get(name, name)
+
+
+def _strip_punct(name):
+    return _SPACE_RE.sub(" ", _PUNCT_RE.sub(" ", name)).strip()
+
+
+def place_label(place):
+    """Подпись места из локального индекса для кнопки выбора: «Александров, Vladimir, RU · 61 тыс.»."""
+    text = ", ".join([place.name] + [part for part in (place.region, place.country) if part])
+    if place.population >= 1000:
+        text += f" · {place.population // 1000} тыс."
+    return text
+
+
+class GeocodingError(Exception):
+    """Ошибка обращения к сервису геокодирования."""
+
+
+class GeoCache:
+    """LRU-кэш «город → координаты» с TTL и сохранением на диск."""
+
+    def __init__(self, path, max_size=5000, ttl=30 * 24 * 3600):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        lat, lon, ts = entry
+        if time.time() - ts > self.ttl:
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return lat, lon
+
+    def put(self, key, lat, lon, ts=None):
+        self._data[key] = (lat, lon, ts if ts is not None else time.time())
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+    def load(self):
+        """Загрузка кэша с диска (просроченные записи отбрасываются)."""
+        try:
+            if not os.path.exists(self.path):
+                return
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            now = time.time()
+            for key, (lat, lon, ts) in data.items():
+                if now - ts <= self.ttl:
+                    self.put(key, lat, lon, ts)
+            logging.info(f"Loaded {len(self._data)} cities from {self.path}")
+        except Exception as e:
+            logging.error(f"Error loading {self.path}: {e}", exc_info=True)
+
+    def snapshot(self):
+        """Копия записей для сохранения в другом потоке (снимается в потоке event loop)."""
+        return {k: list(v) for k, v in self._data.items()}
+
+    def save(self, data=None):
+        """Атомарная запись кэша (или снимка `data`) на диск."""
+        if data is None:
+            data = self.snapshot()
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logging.error(f"Error saving {self.path}: {e}", exc_info=True)
+
+
+class Geocoder:
+    """Поиск координат города: по локальному индексу GeoNames (gazetteer.py), если он подключён, иначе —
+    асинхронный клиент OpenCage с кэшем и объединением одновременных запросов."""
+
+    def __init__(self, api_key, cache_path, max_size=5000, ttl=30 * 24 * 3600,
+                 timeout=10, pool_size=20, save_delay=5.0, url=OPENCAGE_URL, gazetteer_path=None):
+        self.api_key = api_key
+        self.gazetteer_path = gazetteer_path
+        self.gazetteer = None
+        self._loading = None
+        self.url = url
+        self.cache = GeoCache(cache_path, max_size=max_size, ttl=ttl)
+        self.cache.load()
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.pool_size = pool_size
+        self.save_delay = save_delay
+        self._session = None
+        self._inflight = {}
+        self._save_task = None
+
+    async def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    def load_gazetteer(self):
+        """Открытие локального индекса (numpy загружается только здесь)."""
+        if self.gazetteer is None and self.gazetteer_path:
+            from gazetteer import load
+            self.gazetteer = load(self.gazetteer_path)
+        return self.gazetteer
+
+    async def warm_up(self):
+        if self._loading is None:
+            self._loading = asyncio.get_event_loop().run_in_executor(None, self.load_gazetteer)
+        await self._loading
+
+    async def search(self, city, limit=5):
+        """Места из локального индекса, подходящие под название (пустой список, если индекса нет)."""
+        await self.warm_up()
+        if self.gazetteer is None:
+            return []
+        return await asyncio.get_event_loop().run_in_executor(None, self.gazetteer.search, city, limit)
+
+    async def choices(self, city, limit=5):
+        """Варианты для кнопок выбора, если название неоднозначно или набрано с опечаткой; иначе []."""
+        places = await self.search(city, limit)
+        return places if self.gazetteer is not None and self.gazetteer.needs_choice(places) else []
+
+    @property
+    def online(self):
+        """Можно ли искать город в OpenCage (для кнопки «нет в списке»)."""
+        return bool(self.api_key)
+
+    def place(self, geonameid):
+        """Место, выбранное кнопкой, по идентификатору GeoNames."""
+        return self.gazetteer.by_geonameid(geonameid) if self.gazetteer is not None else None
+
+    async def geocode(self, city, geonameid=None, online=False):
+        """Координаты (lat, lon) города или None, если город не найден.
+
+        `geonameid` — место из локального индекса, выбранное пользователем. Без него берётся лучшее
+        совпадение из индекса, а OpenCage (если задан ключ) запрашивается только для городов, которых в нём нет.
+        `online=True` — пользователь не нашёл свой город среди предложенных: индекс пропускается.
+        """
+        key = normalize_city(city)
+        if not key:
+            return None
+        found = None
+        if not online:
+            await self.warm_up()
+            if geonameid is not None:
+                found = self.place(geonameid)
+            if found is None:
+                found = next(iter(await self.search(city, 1)), None)
+        if found is not None:
+            metrics.GEOCODE_LOOKUPS.inc(source="gazetteer")
+            logging.info(f"Geocoded {city} -> {found.name}, {found.region}, {found.country} (distance {found.distance})")
+            return found.lat, found.lon
+        cached = self.cache.get(key)
+        if cached is not None:
+            metrics.GEOCODE_LOOKUPS.inc(source="cache")
+            return cached
+        if not self.api_key:
+            metrics.GEOCODE_LOOKUPS.inc(source="not_found")
+            logging.info(f"No geocode for {city} (no OpenCage key)")
+            return None
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key, city))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key, city):
+        # Для сокращений («спб», «мск») запрашиваем полное название
+        query = key if key in CITY_ALIASES.values() else city.strip()
+        params = {"q": query, "key": self.api_key, "limit": 1, "no_annotations": 1}
+        session = await self._get_session()
+        try:
+            async with session.get(self.url, params=params) as response:
+                if response.status != 200:
+                    raise GeocodingError(f"OpenCage HTTP {response.status}: {await response.text()}")
+                geo = await response.json()
+        except aiohttp.ClientError as e:
+            raise GeocodingError(f"OpenCage request failed: {e}") from e
+        except asyncio.TimeoutError as e:
+            raise GeocodingError("OpenCage request timed out") from e
+
+        if not geo.get("results"):
+            metrics.GEOCODE_LOOKUPS.inc(source="not_found")
+            logging.info(f"No geocode for {city}")
+            return None
+        metrics.GEOCODE_LOOKUPS.inc(source="opencage")
+        geometry = geo["results"][0]["geometry"]
+        lat = geometry.get("lat", 0.0)
+        lon = geometry.get("lng", 0.0)
+        self.cache.put(key, lat, lon)
+        self._schedule_save()
+        logging.info(f"Geocoded {city} -> {lat}, {lon}")
+        return lat, lon
+
+    def _schedule_save(self):
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.ensure_future(self._delayed_save())
+
+    async def _delayed_save(self):
+        await asyncio.sleep(self.save_delay)
+        # Кэш меняется в event loop, поэтому в поток передаётся только снимок
+        snapshot = self.cache.snapshot()
+        await asyncio.get_event_loop().run_in_executor(None, self.cache.save, snapshot)
+
+    def stats(self):
+        return {
+            "gazetteer": len(self.gazetteer) if self.gazetteer is not None else "off",
+            "cache": len(self.cache),
+            "cache_hits": self.cache.hits,
+            "cache_misses": self.cache.misses,
+        }
+
+    async def close(self):
+        if self._save_task is not None and not self._save_task.done():
+            self._save_task.cancel()
+        self.cache.save()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
@@ -0,0 +1,205 @@
+"""Библиотека готовых кратких интерпретаций по ключу (планета, знак, дом).
+
+Прогрев библиотеки (можно прерывать и запускать повторно):
+    python interpretations.py warm --variants 3 --concurrency 5
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from dotenv import load_dotenv
+from flatlib import const
+
+import llm
+
+PLANETS = ["Sun", "Moon", "Mercury", "Venus", "Mars"]
+ASCENDANT = "Ascendant"
+INTERPRETATIONS_DB = "./interpretations.db"
+INTERPRETATION_MODEL = "gpt-4o"
+# Сколько вариантов на ключ хранится: ответы GPT при промахах сверх этого не добавляются
+VARIANTS = 3
+
+
+def planet_prompt(body, sign, house):
+    return f"{body} в знаке {sign}, дом {house}. Краткая интерпретация."
+
+
+def ascendant_prompt(sign):
+    return f"Асцендент в {sign}. Краткая интерпретация."
+
+
+def prompt_for(body, sign, house=""):
+    return ascendant_prompt(sign) if body == ASCENDANT else planet_prompt(body, sign, house)
+
+
+def all_keys():
+    """Все возможные ключи библиотеки: планеты × знаки × дома и Асцендент × знаки."""
+    keys = [(p, sign, house) for p in PLANETS for sign in const.LIST_SIGNS for house in const.LIST_HOUSES]
+    keys += [(ASCENDANT, sign, "") for sign in const.LIST_SIGNS]
+    return keys
+
+
+async def request_interpretation(gateway, prompt, user_id=None):
+    """Запрос краткой интерпретации у GPT через шлюз; при ошибке выбрасывает исключение."""
+    return await gateway.complete(prompt, INTERPRETATION_MODEL, "interpretation", user_id=user_id, temperature=0.7, max_tokens=200)
+
+
+class InterpretationStore:
+    """Хранилище нескольких вариантов интерпретации на ключ (SQLite-файл, читается в память)."""
+
+    def __init__(self, path=INTERPRETATIONS_DB, variants=VARIANTS):
+        self.path = path
+        self.variants = variants
+        self._variants = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS interpretations ("
+                "body TEXT NOT NULL, sign TEXT NOT NULL, house TEXT NOT NULL, "
+                "variant INTEGER NOT NULL, text TEXT NOT NULL, "
+                "PRIMARY KEY (body, sign, house, variant)) WITHOUT ROWID"
+            )
+            self._conn.commit()
+        return self._conn
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def load(self):
+        """Чтение всей библиотеки в память (отдельным соединением: get и add в это время не ждут)."""
+        started = time.perf_counter()
+        with self._lock:
+            self._connect()
+        conn = sqlite3.connect(self.path)
+        try:
+            rows = conn.execute(
+                "SELECT body, sign, house, text FROM interpretations ORDER BY body, sign, house, variant"
+            ).fetchall()
+        finally:
+            conn.close()
+        variants = {}
+        for body, sign, house, text in rows:
+            variants.setdefault((body, sign, house), []).append(text)
+        with self._lock:
+            # Варианты, добавленные во время чтения
+            for key, texts in self._variants.items():
+                loaded = variants.setdefault(key, [])
+                loaded.extend(text for text in texts if text not in loaded)
+            self._variants = variants
+            self._loaded = True
+        logging.info(f"Loaded {len(rows)} interpretations for {len(variants)} keys in {time.perf_counter() - started:.3f}s")
+
+    async def load_async(self):
+        await asyncio.get_event_loop().run_in_executor(None, self.load)
+
+    def get(self, body, sign, house=""):
+        """Случайный вариант интерпретации или None, если ключа нет."""
+        key = (body, sign, house or "")
+        if self._loaded:
+            texts = self._variants.get(key)
+        else:
+            # Библиотека ещё читается при прогреве — точечный запрос по первичному ключу
+            with self._lock:
+                texts = [row[0] for row in self._connect().execute(
+                    "SELECT text FROM interpretations WHERE body = ? AND sign = ? AND house = ?", key
+                )]
+        return random.choice(texts) if texts else None
+
+    def count(self, body, sign, house=""):
+        return len(self._variants.get((body, sign, house or ""), ()))
+
+    def add(self, body, sign, house, text, limit=None):
+        """Добавление нового варианта интерпретации, если у ключа их меньше `limit` (по умолчанию `variants`);
+        возвращает, добавлен ли вариант."""
+        key = (body, sign, house or "")
+        limit = self.variants if limit is None else limit
+        with self._lock:
+            conn = self._connect()
+            count, variant = conn.execute(
+                "SELECT COUNT(*), COALESCE(MAX(variant) + 1, 0) FROM interpretations "
+                "WHERE body = ? AND sign = ? AND house = ?",
+                key
+            ).fetchone()
+            # Одновременные промахи по одному ключу (и другие процессы) не раздувают библиотеку
+            if count >= limit:
+                return False
+            cursor = conn.execute("INSERT OR IGNORE INTO interpretations VALUES (?, ?, ?, ?, ?)", (*key, variant, text))
+            conn.commit()
+            if cursor.rowcount != 1:
+                return False
+            self._variants.setdefault(key, []).append(text)
+            return True
+
+    async def add_async(self, body, sign, house, text, limit=None):
+        return await asyncio.get_event_loop().run_in_executor(None, self.add, body, sign, house, text, limit)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+async def warm(store, gateway, variants=VARIANTS, concurrency=5):
+    """Заполнение библиотеки до `variants` вариантов на ключ; уже готовые ключи пропускаются."""
+    store.load()
+    todo = [key for key in all_keys() for _ in range(max(0, variants - store.count(*key)))]
+    logging.info(f"Warm-up: {len(todo)} interpretations to generate")
+    semaphore = asyncio.Semaphore(concurrency)
+    done = 0
+
+    async def generate(key):
+        nonlocal done
+        async with semaphore:
+            try:
+                text = await request_interpretation(gateway, prompt_for(*key))
+            except Exception as e:
+                logging.error(f"Warm-up error for {key}: {e}")
+                return
+            await store.add_async(*key, text, limit=variants)
+            done += 1
+            if done % 50 == 0:
+                logging.info(f"Warm-up progress: {done}/{len(todo)}")
+
+    await asyncio.gather(*[generate(key) for key in todo])
+    logging.info(f"Warm-up finished: {done}/{len(todo)} generated")
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    parser = argparse.ArgumentParser(description="Библиотека кратких интерпретаций")
+    parser.add_argument("command", choices=["warm", "stats"])
+    parser.add_argument("--db", default=os.getenv("INTERPRETATIONS_DB", INTERPRETATIONS_DB))
+    parser.add_argument("--variants", type=int, default=VARIANTS)
+    parser.add_argument("--concurrency", type=int, default=5)
+    args = parser.parse_args()
+
+    interpretation_store = InterpretationStore(args.db)
+    if args.command == "warm":
+        async def run_warm():
+            gateway = llm.from_env()
+            try:
+                await warm(interpretation_store, gateway, args.variants, args.concurrency)
+            finally:
+                await gateway.close()
+
+        asyncio.run(run_warm())
+    else:
+        interpretation_store.load()
+        total = len(all_keys())
+        filled = sum(1 for key in all_keys() if interpretation_store.count(*key))
+        print(f"{filled}/{total} keys filled")
+    interpretation_store.close()
@@ -0,0 +1,166 @@
+"""Ограниченная очередь задач с приоритетами, пулом обработчиков и сохранением в SQLite."""
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+class QueueFull(Exception):
+    """Очередь заполнена — новые задачи временно не принимаются."""
+
+
+class DuplicateJob(Exception):
+    """Задача с таким id уже в очереди или выполняется."""
+
+
+class JobQueue:
+    """Очередь с приоритетами (меньше — раньше) и фиксированным числом обработчиков.
+
+    Ожидающие и выполняемые задачи хранятся в SQLite и восстанавливаются после перезапуска.
+    """
+
+    def __init__(self, handler, path, workers=4, max_size=200, on_position=None, position_interval=10.0):
+        self.handler = handler
+        self.workers = workers
+        self.max_size = max_size
+        self.on_position = on_position
+        self.position_interval = position_interval
+        self._heap = []
+        self._payloads = {}
+        self._running = set()
+        self._notified = {}
+        self._seq = itertools.count()
+        self._available = asyncio.Condition()
+        self._tasks = []
+        self._accepting = False
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, priority INTEGER NOT NULL, created_at REAL NOT NULL, payload TEXT NOT NULL)"
+        )
+
+    def _db(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def __len__(self):
+        return len(self._heap)
+
+    @property
+    def running(self):
+        return len(self._running)
+
+    @property
+    def full(self):
+        return len(self._heap) >= self.max_size
+
+    @property
+    def busy(self):
+        """Все обработчики заняты — новая задача будет ждать в очереди."""
+        return len(self._running) + len(self._heap) > self.workers
+
+    def position(self, job_id):
+        """Место задачи в очереди (1 — следующая) или None, если задача уже не ждёт."""
+        for index, (_, _, queued_id) in enumerate(sorted(self._heap), start=1):
+            if queued_id == job_id:
+                return index
+        return None
+
+    def contains(self, job_id):
+        return job_id in self._payloads or job_id in self._running
+
+    async def submit(self, job_id, payload, priority=1):
+        """Постановка задачи в очередь; возвращает её место в очереди."""
+        if not self._accepting:
+            raise QueueFull("Queue is stopped")
+        if self.contains(job_id):
+            raise DuplicateJob(job_id)
+        if self.full:
+            raise QueueFull(f"Queue is full ({self.max_size})")
+        self._db("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?)",
+                 (job_id, priority, time.time(), json.dumps(payload, ensure_ascii=False)))
+        await self._push(job_id, payload, priority)
+        position = self.position(job_id)
+        self._notified[job_id] = position
+        return position
+
+    async def update_payload(self, job_id, payload):
+        """Обновление данных ожидающей задачи (например, id статусного сообщения)."""
+        if job_id in self._payloads:
+            self._payloads[job_id] = payload
+            self._db("UPDATE jobs SET payload = ? WHERE job_id = ?", (json.dumps(payload, ensure_ascii=False), job_id))
+
+    async def _push(self, job_id, payload, priority):
+        self._payloads[job_id] = payload
+        heapq.heappush(self._heap, (priority, next(self._seq), job_id))
+        async with self._available:
+            self._available.notify()
+
+    async def start(self):
+        """Восстановление незавершённых задач и запуск обработчиков."""
+        rows = self._db("SELECT job_id, priority, payload FROM jobs ORDER BY created_at")
+        for job_id, priority, payload in rows:
+            await self._push(job_id, json.loads(payload), priority)
+        if rows:
+            logging.info(f"Restored {len(rows)} pending jobs")
+        self._accepting = True
+        self._tasks = [asyncio.ensure_future(self._worker(i)) for i in range(self.workers)]
+        if self.on_position:
+            self._tasks.append(asyncio.ensure_future(self._notify_positions()))
+
+    async def _worker(self, index):
+        while True:
+            async with self._available:
+                # После stop() новые задачи не берутся, ожидающие остаются в базе
+                await self._available.wait_for(lambda: self._heap and self._accepting)
+                _, _, job_id = heapq.heappop(self._heap)
+            payload = self._payloads.pop(job_id)
+            self._notified.pop(job_id, None)
+            self._running.add(job_id)
+            try:
+                await self.handler(job_id, payload)
+            except asyncio.CancelledError:
+                # Задача прервана остановкой — остаётся в базе и будет выполнена после перезапуска
+                raise
+            except Exception as e:
+                logging.error(f"Job {job_id} failed: {e}", exc_info=True)
+            finally:
+                self._running.discard(job_id)
+            self._db("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+
+    async def _notify_positions(self):
+        """Периодическое сообщение ожидающим задачам их нового места в очереди."""
+        while True:
+            await asyncio.sleep(self.position_interval)
+            for index, (_, _, job_id) in enumerate(sorted(self._heap), start=1):
+                if self._notified.get(job_id) != index and job_id in self._payloads:
+                    self._notified[job_id] = index
+                    try:
+                        await self.on_position(job_id, self._payloads[job_id], index)
+                    except Exception as e:
+                        logging.warning(f"Position update error for {job_id}: {e}")
+
+    async def stop(self, timeout=60):
+        """Остановка: новые задачи не принимаются, текущие дорабатывают до `timeout` секунд."""
+        self._accepting = False
+        deadline = time.monotonic() + timeout
+        while self._running and time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+        interrupted = len(self._running)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logging.info(f"Job queue stopped: {len(self._heap)} pending, {interrupted} interrupted")
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,368 @@
+"""Единая точка запросов к OpenAI chat completions.
+
+Общий пул HTTP-соединений, таймауты, повторы с разбросом задержки при 429/5xx и сетевых ошибках,
+ограничение параллельности по модели, автоматический выключатель (circuit breaker) с переходом
+на более дешёвую модель и дневные лимиты токенов на пользователя и на весь бот.
+Адрес API берётся из OPENAI_API_BASE, поэтому шлюз можно проверять на локальной заглушке.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from datetime import datetime, timezone
+
+import aiohttp
+
+import metrics
+
+DEFAULT_API_BASE = "https://api.openai.com/v1"
+DEFAULT_FALLBACKS = {"gpt-4o": "gpt-4o-mini", "gpt-4-turbo": "gpt-4o-mini"}
+RETRY_STATUSES = (408, 409, 429, 500, 502, 503, 504)
+
+
+class LLMError(Exception):
+    """Запрос не выполнен ни основной, ни резервной моделью."""
+
+
+class BudgetExceeded(LLMError):
+    """Исчерпан дневной лимит токенов пользователя или бота."""
+
+
+class _RetryableError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_limits(spec):
+    """'gpt-4o=6,gpt-4o-mini=12' → {'gpt-4o': 6, 'gpt-4o-mini': 12}."""
+    limits = {}
+    for part in filter(None, (spec or "").split(",")):
+        model, _, limit = part.partition("=")
+        limits[model.strip()] = int(limit)
+    return limits
+
+
+class CircuitBreaker:
+    """После `threshold` неудач подряд запросы к модели не отправляются `cooldown` секунд,
+    затем пропускается один пробный запрос: успех закрывает выключатель, неудача открывает снова."""
+
+    def __init__(self, threshold=5, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def release(self):
+        """Пробный запрос завершился без ответа о доступности модели (ошибка запроса, отмена):
+        следующий запрос снова будет пробным."""
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+class TokenBudget:
+    """Дневной учёт токенов (сутки по UTC): лимит на пользователя и общий лимит; 0 — без лимита.
+
+    С `backend` (бэкенд rate_limit: SQLite-файл или Redis) счётчики общие для рабочих процессов и переживают
+    перезапуск; без него — только в памяти процесса. Счётчики процесса ведутся всегда: по ним строится
+    статистика, и на них учёт опирается, если бэкенд недоступен.
+    """
+
+    # Ключ дня живёт дольше суток, чтобы счётчик не пропал до смены даты
+    KEY_TTL = 2 * 24 * 3600
+
+    def __init__(self, per_user=0, total=0, backend=None):
+        self.per_user = per_user
+        self.total = total
+        self.backend = backend
+        self._day = None
+        self._users = {}
+        self._total = 0
+
+    def _roll(self):
+        day = datetime.now(timezone.utc).date()
+        if day != self._day:
+            self._day = day
+            self._users = {}
+            self._total = 0
+
+    def _key(self, user_id=None):
+        return f"tokens:{self._day.isoformat()}:{'total' if user_id is None else user_id}"
+
+    async def _shared_used(self, user_id=None):
+        """Расход за сутки по общим счётчикам (не меньше учтённого этим процессом)."""
+        used = self.used(user_id)
+        if self.backend is None:
+            return used
+        try:
+            return max(used, int(await self.backend.get(self._key(user_id)) or 0))
+        except Exception as e:
+            logging.warning(f"Token budget backend error: {e}")
+            return used
+
+    async def check(self, user_id, tokens):
+        """BudgetExceeded, если запрос на `tokens` токенов превысит лимит."""
+        self._roll()
+        if self.total:
+            used = await self._shared_used()
+            if used + tokens > self.total:
+                raise BudgetExceeded(f"Daily token budget exhausted ({used}/{self.total})")
+        if self.per_user and user_id is not None:
+            used = await self._shared_used(str(user_id))
+            if used + tokens > self.per_user:
+                raise BudgetExceeded(f"Daily token budget for user {user_id} exhausted ({used}/{self.per_user})")
+
+    async def charge(self, user_id, tokens):
+        self._roll()
+        self._total += tokens
+        if user_id is not None:
+            self._users[str(user_id)] = self._users.get(str(user_id), 0) + tokens
+        if self.backend is None:
+            return
+        # В общих счётчиках — только то, что ограничено
+        keys = ([self._key()] if self.total else []) + ([self._key(str(user_id))] if self.per_user and user_id is not None else [])
+        try:
+            for key in keys:
+                await self.backend.incr(key, tokens, self.KEY_TTL)
+        except Exception as e:
+            logging.warning(f"Token budget backend error: {e}")
+
+    def used(self, user_id=None):
+        self._roll()
+        return self._total if user_id is None else self._users.get(str(user_id), 0)
+
+
+class LLMGateway:
+    """Асинхронный клиент chat completions; все запросы к OpenAI идут через него."""
+
+    def __init__(self, api_key, api_base=DEFAULT_API_BASE, timeout=60, connect_timeout=10, pool_size=20,
+                 max_retries=3, backoff=0.5, max_backoff=20.0, concurrency=None, default_concurrency=6,
+                 fallbacks=None, breaker_threshold=5, breaker_cooldown=30.0, budget=None):
+        self.api_key = api_key
+        self.url = f"{api_base.rstrip('/')}/chat/completions"
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        # Для потока ограничивается пауза между фрагментами, а не длительность всего ответа
+        self.stream_timeout = aiohttp.ClientTimeout(total=None, connect=connect_timeout, sock_read=timeout)
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.concurrency = concurrency or {}
+        self.default_concurrency = default_concurrency
+        self.fallbacks = DEFAULT_FALLBACKS if fallbacks is None else fallbacks
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.budget = budget or TokenBudget()
+        self._session = None
+        self._semaphores = {}
+        self._breakers = {}
+        self.retries = 0
+        self.fallback_calls = 0
+
+    async def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=self.timeout,
+                headers={"Authorization": f"Bearer {self.api_key}"}
+            )
+        return self._session
+
+    def _semaphore(self, model):
+        semaphore = self._semaphores.get(model)
+        if semaphore is None:
+            semaphore = self._semaphores[model] = asyncio.Semaphore(self.concurrency.get(model, self.default_concurrency))
+        return semaphore
+
+    def breaker(self, model):
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = self._breakers[model] = CircuitBreaker(self.breaker_threshold, self.breaker_cooldown)
+        return breaker
+
+    def _delay(self, attempt, retry_after=None):
+        """Экспоненциальная задержка с полным разбросом; Retry-After сервера соблюдается."""
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        return max(delay, retry_after or 0)
+
+    async def complete(self, prompt, model, kind, user_id=None, temperature=0.7, max_tokens=200, on_delta=None):
+        """Ответ модели на `prompt`; с `on_delta(text)` ответ запрашивается потоком и фрагменты передаются по мере прихода.
+
+        При недоступности модели (открыт выключатель или исчерпаны повторы) запрос уходит в резервную модель.
+        """
+        await self.budget.check(user_id, metrics.estimate_tokens(prompt) + max_tokens)
+        candidates = [model] + ([self.fallbacks[model]] if model in self.fallbacks else [])
+        last_error = None
+        for candidate in candidates:
+            breaker = self.breaker(candidate)
+            if not breaker.allow():
+                last_error = LLMError(f"Circuit open for {candidate}")
+                continue
+            if candidate != model:
+                self.fallback_calls += 1
+                metrics.OPENAI_FALLBACKS.inc(model=model, fallback=candidate)
+                logging.warning(f"LLM fallback {model} -> {candidate} for {kind}: {last_error}")
+            try:
+                text, prompt_tokens, completion_tokens = await self._call(
+                    candidate, kind, prompt, temperature, max_tokens, on_delta
+                )
+            except _RetryableError as e:
+                breaker.record_failure()
+                last_error = e
+                continue
+            except BaseException:
+                # Ошибка самого запроса (HTTP 400/401) или отмена ничего не говорят о доступности модели,
+                # но пробный запрос должен быть освобождён, иначе выключатель останется открытым навсегда
+                breaker.release()
+                raise
+            breaker.record_success()
+            metrics.record_openai_usage(candidate, prompt_tokens, completion_tokens)
+            await self.budget.charge(user_id, prompt_tokens + completion_tokens)
+            return text
+        raise LLMError(f"LLM request failed for {kind}: {last_error}")
+
+    async def _call(self, model, kind, prompt, temperature, max_tokens, on_delta):
+        body = {
+            "model": model,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        }
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._semaphore(model):
+                    with metrics.openai_call(model, kind):
+                        if on_delta is None:
+                            return await self._request(body)
+                        return await self._stream(body, prompt, on_delta)
+            except _RetryableError as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self._delay(attempt, e.retry_after)
+                self.retries += 1
+                metrics.OPENAI_RETRIES.inc(model=model, kind=kind)
+                logging.warning(f"LLM {model} {kind} attempt {attempt + 1} failed: {e}; retry in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def _post(self, session, body, timeout):
+        try:
+            response = await session.post(self.url, json=body, timeout=timeout)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise _RetryableError(f"{type(e).__name__}: {e}") from e
+        if response.status != 200:
+            text = await response.text()
+            response.release()
+            if response.status in RETRY_STATUSES:
+                retry_after = response.headers.get("Retry-After")
+                raise _RetryableError(f"HTTP {response.status}: {text[:200]}",
+                                      float(retry_after) if retry_after and retry_after.isdigit() else None)
+            raise LLMError(f"HTTP {response.status}: {text[:200]}")
+        return response
+
+    async def _request(self, body):
+        session = await self._get_session()
+        response = await self._post(session, body, self.timeout)
+        try:
+            data = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise _RetryableError(f"Bad response: {e}") from e
+        finally:
+            response.release()
+        choices = data.get("choices") or []
+        text = (choices[0].get("message", {}).get("content") or "").strip() if choices else ""
+        if not text:
+            raise _RetryableError("Empty completion")
+        usage = data.get("usage") or {}
+        return (text, usage.get("prompt_tokens", metrics.estimate_tokens(str(body["messages"]))),
+                usage.get("completion_tokens", metrics.estimate_tokens(text)))
+
+    async def _stream(self, body, prompt, on_delta):
+        parts = []
+        session = await self._get_session()
+        response = await self._post(session, dict(body, stream=True), self.stream_timeout)
+        try:
+            async for line in response.content:
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                payload = line[5:].strip()
+                if payload == b"[DONE]":
+                    break
+                chunk = json.loads(payload)
+                delta = chunk["choices"][0].get("delta", {}).get("content") if chunk.get("choices") else None
+                if delta:
+                    parts.append(delta)
+                    on_delta(delta)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise _RetryableError(f"Stream interrupted: {type(e).__name__}: {e}") from e
+        finally:
+            response.release()
+        text = "".join(parts).strip()
+        if not text:
+            raise _RetryableError("Empty completion")
+        # Потоковый ответ не содержит usage: каждый фрагмент — примерно один токен
+        return text, metrics.estimate_tokens(prompt), len(parts)
+
+    def stats(self):
+        return {
+            "retries": self.retries,
+            "fallbacks": self.fallback_calls,
+            "breakers": {model: breaker.state for model, breaker in self._breakers.items()},
+            "tokens_today": self.budget.used(),
+        }
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+def from_env(backend=None):
+    """Шлюз с настройками из окружения.
+
+    `backend` — бэкенд rate_limit для дневных счётчиков токенов. Если он не общий для процессов (или не задан),
+    общий дневной лимит делится между рабочими процессами.
+    """
+    workers = 1 if backend is not None and backend.shared else int(os.getenv("WORKER_COUNT", "1"))
+    return LLMGateway(
+        os.getenv("OPENAI_API_KEY"),
+        api_base=os.getenv("OPENAI_API_BASE", DEFAULT_API_BASE),
+        timeout=float(os.getenv("LLM_TIMEOUT", "60")),
+        max_retries=int(os.getenv("LLM_RETRIES", "3")),
+        concurrency=parse_limits(os.getenv("LLM_CONCURRENCY")),
+        default_concurrency=int(os.getenv("GPT_CONCURRENCY", "6")),
+        breaker_threshold=int(os.getenv("LLM_BREAKER_THRESHOLD", "5")),
+        breaker_cooldown=float(os.getenv("LLM_BREAKER_COOLDOWN", "30")),
+        budget=TokenBudget(
+            per_user=int(os.getenv("LLM_USER_DAILY_TOKENS", "40000")),
+            total=int(os.getenv("LLM_DAILY_TOKENS", "0")) // workers,
+            backend=backend
+        )
+    )
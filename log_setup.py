@@ -0,0 +1,166 @@
+"""Логирование через очередь: запись на диск в фоновом потоке, JSON-записи с id запроса,
+ограничение частоты и выборка для шумных модулей, ротация по размеру.
+
+Обработчики бота вызывают только QueueHandler (положить запись в очередь); форматирование
+и запись в файл выполняет QueueListener в отдельном потоке.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+request_id = contextvars.ContextVar("request_id", default="-")
+
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - [%(request_id)s] - %(message)s"
+
+_listener = None
+
+
+def new_request_id(prefix=""):
+    """Новый случайный id запроса."""
+    return f"{prefix}{uuid.uuid4().hex[:12]}"
+
+
+def set_request_id(value):
+    request_id.set(value)
+
+
+class RequestIdFilter(logging.Filter):
+    """Добавляет к записи id текущего запроса (в потоке, где запись создана)."""
+
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Для записей ниже WARNING: доля `rates[модуль]` и не больше `per_second` записей в секунду на модуль.
+
+    Предупреждения и ошибки проходят всегда; число отброшенных записей сообщается раз в минуту.
+    """
+
+    def __init__(self, rates=None, per_second=20.0):
+        super().__init__()
+        self.rates = rates or {}
+        self.per_second = per_second
+        self._buckets = {}
+        self._dropped = {}
+        self._reported = time.monotonic()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        module = record.module
+        rate = self.rates.get(module, 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            return self._drop(module)
+        if self.per_second:
+            now = time.monotonic()
+            with self._lock:
+                tokens, updated = self._buckets.get(module, (self.per_second, now))
+                tokens = min(self.per_second, tokens + (now - updated) * self.per_second)
+                allowed = tokens >= 1
+                self._buckets[module] = (tokens - 1 if allowed else tokens, now)
+            if not allowed:
+                return self._drop(module)
+        return True
+
+    def _drop(self, module):
+        with self._lock:
+            self._dropped[module] = self._dropped.get(module, 0) + 1
+            now = time.monotonic()
+            if now - self._reported < 60:
+                return False
+            dropped, self._dropped = self._dropped, {}
+            self._reported = now
+        logging.getLogger(__name__).warning(f"Log records dropped by sampling: {dropped}")
+        return False
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "module": record.module,
+            "line": record.lineno,
+            "process": record.processName,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Подготовка записи к передаче в поток записи: сообщение форматируется сразу,
+    трассировка сохраняется отдельно, чтобы JSON-формат мог вынести её в своё поле."""
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def parse_rates(spec):
+    """'chart_engine=0.1,geocoding=0.5' → {'chart_engine': 0.1, 'geocoding': 0.5}."""
+    rates = {}
+    for part in filter(None, (spec or "").split(",")):
+        module, _, rate = part.partition("=")
+        rates[module.strip()] = float(rate)
+    return rates
+
+
+def setup_logging(path="bot.log", level="INFO", json_file=True, max_bytes=10 * 1024 * 1024, backup_count=5,
+                  sample_rates=None, per_second=20.0):
+    """Настройка корневого логгера; повторный вызов заменяет прежнюю настройку."""
+    global _listener
+    stop_logging()
+
+    file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    file_handler.setFormatter(JsonFormatter() if json_file else logging.Formatter(TEXT_FORMAT))
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    records = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    handler.addFilter(RequestIdFilter())
+    handler.addFilter(SamplingFilter(sample_rates, per_second))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    """Дописывает оставшиеся записи и останавливает поток записи."""
+    global _listener
+    if _listener is not None:
+        listener, _listener = _listener, None
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
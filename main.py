@@ -1,39 +1,86 @@
+# Первым импортом: отсчёт времени запуска начинается до тяжёлых модулей
+import startup
 from aiogram import Bot, Dispatcher, types, executor
+from aiogram.bot.api import TelegramAPIServer
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-import logging, os, requests, openai, json
-from flatlib import const
-from flatlib.datetime import Datetime
-from flatlib.geopos import GeoPos
-from flatlib.chart import Chart
-from fpdf import FPDF
+import importlib, logging, os, io, time, uuid
 from dotenv import load_dotenv
-from timezonefinder import TimezoneFinder
 import pytz
-from datetime import datetime, timedelta
+from datetime import datetime
 import asyncio
 import aiohttp
+from geocoding import Geocoder, OPENCAGE_URL, place_label
+from timezones import TimezoneService
+from pdf_renderer import ReportRenderer
+from chart_engine import ChartEngine
+from send_scheduler import SendScheduler, BULK
+from subscriptions import SubscriptionCache, is_channel
+from user_store import UserStore, migrate_if_needed
+from rate_limit import create_rate_limiter
+import webhook
+import log_setup
+import llm
+import metrics
+import natal
+from documents import DocumentDelivery, FileIdCache, file_hash
+from example_paid_astrology_report import content as EXAMPLE_CONTENT
+from report_checkpoints import ReportCheckpoints, report_job_id
+from job_queue import JobQueue, QueueFull, DuplicateJob
+from interpretations import InterpretationStore, ASCENDANT
 
 load_dotenv()
+startup_state = startup.Startup()
+startup_state.mark("imports")
 
 API_TOKEN = os.getenv("API_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENCAGE_API_KEY = os.getenv("OPENCAGE_API_KEY")
 CHANNEL_USERNAME = os.getenv("ASTRO_CHANNEL_ID", "@moyanatalkarta")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", webhook.DEFAULT_API_URL).rstrip("/")
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
 
-bot = Bot(token=API_TOKEN)
+bot = Bot(token=API_TOKEN, server=TelegramAPIServer.from_base(TELEGRAM_API_URL))
 dp = Dispatcher(bot)
-openai.api_key = OPENAI_API_KEY
-
-# Логирование
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s",
-    handlers=[
-        logging.FileHandler("bot.log", mode="a", encoding="utf-8"),
-        logging.StreamHandler()
-    ]
+# Все исходящие сообщения идут через очередь с ограничением скорости;
+# лимит бота делится между рабочими процессами вебхука
+outbox = SendScheduler(
+    bot,
+    global_rate=float(os.getenv("SEND_GLOBAL_RATE", "30")) / int(os.getenv("WORKER_COUNT", "1")),
+    chat_rate=float(os.getenv("SEND_CHAT_RATE", "1")),
+    merge_limit=int(os.getenv("SEND_MERGE_LIMIT", "1500"))
 )
 
+# Логирование (запись в файл в фоновом потоке; у рабочих процессов вебхука свой файл)
+log_setup.setup_logging(
+    path=f"bot_{os.getenv('WORKER_INDEX')}.log" if os.getenv("WORKER_INDEX") else "bot.log",
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    json_file=os.getenv("LOG_FORMAT", "json") == "json",
+    max_bytes=int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+    backup_count=int(os.getenv("LOG_BACKUPS", "5")),
+    sample_rates=log_setup.parse_rates(os.getenv("LOG_SAMPLE")),
+    per_second=float(os.getenv("LOG_RATE", "20"))
+)
+
+class RequestIdMiddleware(BaseMiddleware):
+    """Id запроса для всех записей лога, относящихся к одному обновлению.
+
+    Вебхук вызывает dp.process_update напрямую, поэтому используются события по типам обновлений.
+    """
+
+    async def _set_request_id(self, *_):
+        update = types.Update.get_current()
+        log_setup.set_request_id(f"u{update.update_id}" if update else log_setup.new_request_id())
+
+    on_pre_process_message = _set_request_id
+    on_pre_process_callback_query = _set_request_id
+    on_pre_process_chat_member = _set_request_id
+
+dp.middleware.setup(RequestIdMiddleware())
+
 # Клавиатуры
 kb = ReplyKeyboardMarkup(resize_keyboard=True, row_width=1).add(
     KeyboardButton("🚗 Начать расчёт")
@@ -43,56 +90,78 @@ main_kb = ReplyKeyboardMarkup(resize_keyboard=True, row_width=1).add(
     "🔮 Расчёт", "📝 Заказать подробную натальную карту"
 )
 
-users = {}
 admin_id = 7943520249
-processing_users = set()
 USERS_FILE = "/tmp/users.json" if os.getenv("RENDER") else "./users.json"
-users_lock = asyncio.Lock()
-
-def load_users():
-    """Загрузка пользователей из JSON."""
+USERS_DB = "/tmp/users.db" if os.getenv("RENDER") else "./users.db"
+user_store = UserStore(USERS_DB)
+rate_limiter = create_rate_limiter(
+    os.getenv("RATE_LIMIT_BACKEND", "sqlite"),
+    sqlite_path="/tmp/ratelimit.db" if os.getenv("RENDER") else "./ratelimit.db",
+    redis_url=os.getenv("REDIS_URL")
+)
+COOLDOWN = 24 * 3600
+# Резерв на время расчёта или отчёта; после успеха ограничение продлевается до COOLDOWN
+RESERVE_TTL = int(os.getenv("RESERVE_TTL", "1800"))
+# В режиме нескольких процессов у каждого рабочего процесса своя очередь
+JOBS_DB_SUFFIX = f"_{os.getenv('WORKER_INDEX')}" if os.getenv("WORKER_INDEX") else ""
+JOBS_DB = f"/tmp/jobs{JOBS_DB_SUFFIX}.db" if os.getenv("RENDER") else f"./jobs{JOBS_DB_SUFFIX}.db"
+LOCK_TTL = int(os.getenv("LOCK_TTL", "600"))
+FILE_IDS_FILE = "/tmp/file_ids.json" if os.getenv("RENDER") else "./file_ids.json"
+REPORT_CHECKPOINTS_DB = "/tmp/report_checkpoints.db" if os.getenv("RENDER") else "./report_checkpoints.db"
+TRANSITS_DB = "/tmp/transits.db" if os.getenv("RENDER") else "./transits.db"
+GEOCODE_CACHE_FILE = "/tmp/geocache.json" if os.getenv("RENDER") else "./geocache.json"
+geocoder = Geocoder(
+    OPENCAGE_API_KEY, GEOCODE_CACHE_FILE,
+    url=os.getenv("OPENCAGE_URL", OPENCAGE_URL),
+    gazetteer_path=os.getenv("GAZETTEER", "./gazetteer.npy")
+)
+timezone_service = TimezoneService(
+    grid=float(os.getenv("TZ_CACHE_GRID", "0.01")),
+    in_memory=os.getenv("TZ_IN_MEMORY", "0") == "1"
+)
+# Дневные счётчики токенов хранятся там же, где ограничения, — общие для процессов и перезапусков
+llm_gateway = llm.from_env(rate_limiter.backend)
+interpretation_store = InterpretationStore(os.getenv("INTERPRETATIONS_DB", "./interpretations.db"))
+pdf_renderer = ReportRenderer(workers=int(os.getenv("PDF_WORKERS", "2")))
+documents = DocumentDelivery(outbox, FileIdCache(FILE_IDS_FILE))
+EXAMPLE_REPORT_FILE = "example_paid_astrology_report.pdf"
+# file_id примера хранится по хэшу содержимого: новый файл примера будет загружен заново
+EXAMPLE_REPORT_KEY = f"example:{file_hash(EXAMPLE_REPORT_FILE) if os.path.exists(EXAMPLE_REPORT_FILE) else 'rendered'}"
+report_checkpoints = ReportCheckpoints(
+    REPORT_CHECKPOINTS_DB,
+    ttl=int(os.getenv("REPORT_CHECKPOINT_TTL_DAYS", "7")) * 24 * 3600
+)
+chart_engine = ChartEngine(
+    workers=int(os.getenv("CHART_WORKERS", "2")),
+    max_size=int(os.getenv("CHART_CACHE_SIZE", "2048")),
+    ids=natal.CHART_OBJECTS,
+    table_path=os.getenv("EPHEMERIS_TABLE", "./ephemeris.npy")
+)
+# Рассылка «Транзиты дня» (создаётся в init_services, numpy не загружается при старте)
+transit_broadcast = None
+
+def stored_time_left(user, field):
+    """Остаток суточного ограничения по времени последнего успешного расчёта или отчёта в хранилище
+    (ограничения, выданные до появления лимитера или потерянные вместе с ним)."""
+    last = (user or {}).get(field)
+    if not isinstance(last, datetime):
+        return 0
+    return max(0, COOLDOWN - (datetime.now(pytz.utc) - last).total_seconds())
+
+def format_time_left(seconds):
+    hours, remainder = divmod(int(seconds), 3600)
+    return hours, remainder // 60
+
+async def save_user(user_id, fields):
+    """Сохранение полей пользователя в хранилище."""
     try:
-        if os.path.exists(USERS_FILE):
-            with open(USERS_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                for user_id, info in data.items():
-                    if "dt_utc" in info:
-                        info["dt_utc"] = datetime.fromisoformat(info["dt_utc"])
-                    if "last_calc_time" in info:
-                        info["last_calc_time"] = datetime.fromisoformat(info["last_calc_time"])
-                    if "last_report_time" in info:
-                        info["last_report_time"] = datetime.fromisoformat(info["last_report_time"])
-                logging.info(f"Loaded {len(data)} users from {USERS_FILE}: {list(data.keys())}")
-                return data
-        logging.info(f"No {USERS_FILE} found, starting empty")
-        return {}
+        with metrics.stage("store", "save_user"):
+            info = await user_store.update_async(user_id, fields)
+        logging.info(f"Saved user {user_id}")
+        return info
     except Exception as e:
-        logging.error(f"Error loading {USERS_FILE}: {e}", exc_info=True)
-        return {}
-
-async def save_users():
-    """Сохранение пользователей в JSON."""
-    async with users_lock:
-        try:
-            data = {}
-            for user_id, info in users.items():
-                data[user_id] = info.copy()
-                if "dt_utc" in data[user_id]:
-                    data[user_id]["dt_utc"] = data[user_id]["dt_utc"].isoformat()
-                if "last_calc_time" in data[user_id]:
-                    data[user_id]["last_calc_time"] = data[user_id]["last_calc_time"].isoformat()
-                if "last_report_time" in data[user_id]:
-                    data[user_id]["last_report_time"] = data[user_id]["last_report_time"].isoformat()
-            os.makedirs(os.path.dirname(USERS_FILE), exist_ok=True)
-            with open(USERS_FILE, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            logging.info(f"Saved {len(data)} users to {USERS_FILE}: {list(data.keys())}")
-        except Exception as e:
-            logging.error(f"Error saving {USERS_FILE}: {e}", exc_info=True)
-            await bot.send_message(admin_id, f"⚠️ Failed to save users.json: {e}")
-
-# Инициализация users
-users = load_users()
+        logging.error(f"Error saving user {user_id}: {e}", exc_info=True)
+        await outbox.send_message(admin_id, f"⚠️ Failed to save user {user_id}: {e}")
 
 async def clear_webhook():
     """Удаление вебхука."""
@@ -100,7 +169,7 @@ async def clear_webhook():
     for attempt in range(1, max_attempts + 1):
         try:
             async with aiohttp.ClientSession() as session:
-                url = f"https://api.telegram.org/bot{API_TOKEN}/getWebhookInfo"
+                url = f"{TELEGRAM_API_URL}/bot{API_TOKEN}/getWebhookInfo"
                 async with session.get(url) as response:
                     if response.status != 200:
                         logging.error(f"Failed webhook info attempt {attempt}: {await response.text()}")
@@ -108,7 +177,7 @@ async def clear_webhook():
                     webhook_info = await response.json()
                     logging.info(f"Webhook info attempt {attempt}: {webhook_info}")
                     if webhook_info.get("result", {}).get("url"):
-                        url_delete = f"https://api.telegram.org/bot{API_TOKEN}/deleteWebhook"
+                        url_delete = f"{TELEGRAM_API_URL}/bot{API_TOKEN}/deleteWebhook"
                         async with session.get(url_delete) as delete_response:
                             if delete_response.status == 200:
                                 logging.info(f"Webhook deleted attempt {attempt}")
@@ -123,85 +192,42 @@ async def clear_webhook():
         await asyncio.sleep(2)
     logging.error("Failed to clear webhook")
 
-def decimal_to_dms_str(degree, is_lat=True):
-    d = int(abs(degree))
-    m = int((abs(degree) - d) * 60)
-    suffix = 'n' if is_lat and degree >= 0 else 's' if is_lat else 'e' if degree >= 0 else 'w'
-    return f"{d}{suffix}{str(m).zfill(2)}"
+async def short_interpretation(body, sign, house="", user_id=None):
+    return await natal.short_interpretation(interpretation_store, llm_gateway, body, sign, house, user_id)
 
-def get_house_manually(chart, lon):
-    try:
-        for house in chart.houses:
-            start_lon = house.lon
-            end_lon = (house.lon + house.size) % 360
-            if start_lon <= end_lon:
-                if start_lon <= lon <= end_lon:
-                    return house.id
-            else:
-                if lon >= start_lon or lon <= end_lon:
-                    return house.id
-        logging.error(f"No house for lon {lon}")
-        return None
-    except Exception as e:
-        logging.error(f"Error getting house for lon {lon}: {e}", exc_info=True)
-        return None
+async def fetch_member_status(user_id):
+    member = await bot.get_chat_member(CHANNEL_USERNAME, user_id)
+    return member.status
 
-def get_aspects(chart, planet_names):
-    aspects = []
-    try:
-        if not chart or not hasattr(chart, 'objects'):
-            logging.error("Chart not initialized")
-            return aspects
-        for p in planet_names:
-            obj = chart.get(p)
-            if obj and hasattr(obj, 'lon'):
-                logging.info(f"Planet {p} at {obj.lon:.2f}°")
-            else:
-                logging.error(f"Planet {p} not found")
-        for i, p1 in enumerate(planet_names):
-            obj1 = chart.get(p1)
-            if not obj1 or not hasattr(obj1, 'lon'):
-                logging.warning(f"Skipping {p1}")
-                continue
-            for p2 in planet_names[i + 1:]:
-                obj2 = chart.get(p2)
-                if not obj2 or not hasattr(obj2, 'lon'):
-                    logging.warning(f"Skipping {p2}")
-                    continue
-                try:
-                    diff = abs(obj1.lon - obj2.lon)
-                    diff = min(diff, 360 - diff)
-                    logging.info(f"Angle {p1} ({obj1.lon:.2f}°) - {p2} ({obj2.lon:.2f}°): {diff:.2f}°")
-                    orb = 15
-                    if abs(diff - 0) <= orb:
-                        aspects.append((p1, p2, diff, "соединение"))
-                    elif abs(diff - 60) <= orb:
-                        aspects.append((p1, p2, diff, "секстиль"))
-                    elif abs(diff - 90) <= orb:
-                        aspects.append((p1, p2, diff, "квадрат"))
-                    elif abs(diff - 120) <= orb:
-                        aspects.append((p1, p2, diff, "тригон"))
-                    elif abs(diff - 180) <= orb:
-                        aspects.append((p1, p2, diff, "оппозиция"))
-                except Exception as e:
-                    logging.error(f"Aspect error {p1}-{p2}: {e}", exc_info=True)
-        logging.info(f"Aspects: {aspects}")
-        return aspects
-    except Exception as e:
-        logging.error(f"Error in aspects: {e}", exc_info=True)
-        return []
+subscription_cache = SubscriptionCache(
+    fetch_member_status,
+    positive_ttl=int(os.getenv("SUBSCRIPTION_TTL", "300")),
+    negative_ttl=int(os.getenv("SUBSCRIPTION_NEGATIVE_TTL", "30"))
+)
 
-async def is_user_subscribed(user_id):
-    try:
-        member = await bot.get_chat_member(CHANNEL_USERNAME, user_id)
-        return member.status in ["member", "creator", "administrator"]
-    except Exception as e:
-        logging.error(f"Subscription check error: {e}", exc_info=True)
-        return False
+async def is_user_subscribed(user_id, recheck_negative=False):
+    return await subscription_cache.is_subscribed(user_id, recheck_negative)
+
+@dp.chat_member_handler()
+async def channel_member_update(update: types.ChatMemberUpdated):
+    """Подписка или отписка в канале (бот должен быть администратором канала)."""
+    if is_channel(update.chat, CHANNEL_USERNAME):
+        user_id = update.new_chat_member.user.id
+        subscription_cache.update_from_status(user_id, update.new_chat_member.status)
+        logging.info(f"Channel member {user_id}: {update.new_chat_member.status}")
+
+CALC_STARTED_TEXT = "⏳ Выполняется расчёт натальной карты. Это может занять 1–2 минуты..."
+QUEUE_FULL_TEXT = "⚠️ Сейчас слишком много запросов. Попробуйте через несколько минут."
+# Название города в callback_data не помещается (лимит 64 байта), поэтому кнопка «нет в списке» берёт его из «…»
+CHOOSE_PLACE_TEXT = "🔎 Уточните город «{}»:"
+
+def queue_position_text(position):
+    return f"⏳ Вы {position}-й в очереди на расчёт. Начнём, как только освободится место."
 
 @dp.message_handler(commands=["start"])
 async def start(message: types.Message):
-    await message.answer(
+    await outbox.answer(
+        message,
         "👋 Добро пожаловать в *Моя Натальная Карта*! Нажми ниже.",
         reply_markup=kb,
         parse_mode="Markdown"
@@ -212,274 +238,334 @@ async def start(message: types.Message):
 async def debug(message: types.Message):
     user_id = str(message.from_user.id)
     if user_id != str(admin_id):
-        await message.answer("⚠️ Доступ запрещен.")
+        await outbox.answer(message, "⚠️ Доступ запрещен.")
         return
-    global users
-    users = load_users()
-    try:
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
-            json_content = f.read()
-    except Exception as e:
-        json_content = f"Error reading {USERS_FILE}: {e}"
     user_info = "\n".join([
-        f"User {uid}: Last calc {u.get('last_calc_time', 'None')}, Last report {u.get('last_report_time', 'None')}"
-        for uid, u in users.items()
+        f"User {uid}: Last calc {last_calc or 'None'}, Last report {last_report or 'None'}"
+        for uid, last_calc, last_report in await user_store.recent_async(20)
     ])
-    await message.answer(
-        f"Users in memory: {list(users.keys())}\n{user_info}\nUsers.json:\n{json_content}",
-        parse_mode="Markdown"
-    )
-    logging.info(f"Debug by {user_id}: {list(users.keys())}")
+    cache_info = f"Geocoder: {geocoder.stats()}\nTimezone cache: {timezone_service.stats()}\nChart cache: {chart_engine.stats()}\nOutbox: {outbox.stats()}\nSubscriptions: {subscription_cache.stats()}\nLLM: {llm_gateway.stats()}\nReport checkpoints: {report_checkpoints.stats()}\nStartup: {startup_state.report()} (ready={startup_state.ready})"
+    if transit_broadcast is not None:
+        cache_info += f"\nTransits: {transit_broadcast.stats()}"
+    await outbox.answer(message, f"Users in store: {await user_store.count_async()}\n{user_info}\n{cache_info}")
+    logging.info(f"Debug by {user_id}")
 
 @dp.message_handler(commands=["reset"])
 async def reset(message: types.Message):
     user_id = str(message.from_user.id)
     if user_id != str(admin_id):
-        await message.answer("⚠️ Доступ запрещен.")
+        await outbox.answer(message, "⚠️ Доступ запрещен.")
         return
-    global users
-    users = {}
     try:
-        if os.path.exists(USERS_FILE):
-            os.remove(USERS_FILE)
-        await save_users()
-        await message.answer("✅ Данные сброшены.", reply_markup=main_kb)
+        await user_store.delete_all_async()
+        await outbox.answer(message, "✅ Данные сброшены.", reply_markup=main_kb)
         logging.info(f"Reset by {user_id}")
     except Exception as e:
         logging.error(f"Reset error: {e}", exc_info=True)
-        await message.answer(f"⚠️ Ошибка сброса: {e}")
+        await outbox.answer(message, f"⚠️ Ошибка сброса: {e}")
+
+@dp.message_handler(commands=["transits"])
+async def transits_toggle(message: types.Message):
+    user_id = str(message.from_user.id)
+    user = await user_store.get_async(user_id) or {}
+    enabled = user.get("transits") is False
+    await save_user(user_id, {"transits": enabled})
+    if enabled:
+        text = "✅ Ежедневные транзиты включены." if user.get("planets") else "✅ Ежедневные транзиты включены. Сначала рассчитайте карту."
+    else:
+        text = "🔕 Ежедневные транзиты отключены. Включить снова: /transits"
+    await outbox.answer(message, text, reply_markup=main_kb)
+    logging.info(f"Transits {'enabled' if enabled else 'disabled'} by {user_id}")
 
 @dp.message_handler(lambda m: m.text == "🚗 Начать расчёт")
 async def begin(message: types.Message):
-    await message.answer("Введите: ДД.ММ.ГГГГ, ЧЧ:ММ, Город", reply_markup=main_kb)
+    await outbox.answer(message, "Введите: ДД.ММ.ГГГГ, ЧЧ:ММ, Город", reply_markup=main_kb)
     logging.info(f"Sent begin message with main_kb to {message.from_user.id}")
 
+async def example_report_bytes():
+    try:
+        with open(EXAMPLE_REPORT_FILE, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        logging.warning("Example report file not found, rendering")
+        return await pdf_renderer.render("lines", EXAMPLE_CONTENT)
+
+async def summary_pdf_bytes(user):
+    """Краткий PDF пользователя: с диска, а если файла нет (например, после перезапуска на Render) —
+    заново по сохранённым дате, времени и координатам."""
+    try:
+        with open(user["pdf"], "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        if "dt_utc" not in user:
+            raise
+    logging.info(f"Regenerating summary PDF {user['pdf']}")
+    chart = await chart_engine.chart(
+        user["dt_utc"], natal.decimal_to_dms_str(user["lat"], True), natal.decimal_to_dms_str(user["lon"], False)
+    )
+    positions = natal.analyze(chart, pipeline="pdf")
+    asc_sign = natal.ascendant_sign(chart)
+    *replies, asc_reply = await asyncio.gather(
+        *[short_interpretation(p.body, p.sign, p.house) for p in positions],
+        short_interpretation(ASCENDANT, asc_sign)
+    )
+    summary = [natal.summary_entry(p, reply) for p, reply in zip(positions, replies)]
+    summary.append(natal.ascendant_summary_entry(asc_sign, asc_reply))
+    return await pdf_renderer.render("summary", summary)
+
 @dp.message_handler(lambda m: m.text == "📘 Пример платного отчёта")
 async def send_example_report(message: types.Message):
     try:
-        with open("example_paid_astrology_report.pdf", "rb") as f:
-            await message.answer_document(f, caption="📘 Пример", reply_markup=main_kb)
-    except FileNotFoundError:
-        logging.error("Example report not found")
-        await message.answer("⚠️ Пример не найден.", reply_markup=main_kb)
+        await documents.send_cached(
+            message.chat.id, EXAMPLE_REPORT_KEY, example_report_bytes, EXAMPLE_REPORT_FILE,
+            kind="example", caption="📘 Пример", reply_markup=main_kb
+        )
+    except Exception as e:
+        logging.error(f"Example report error: {e}", exc_info=True)
+        await outbox.answer(message, "⚠️ Пример не найден.", reply_markup=main_kb)
 
 @dp.message_handler(lambda m: m.text == "📄 Скачать PDF")
 async def pdf_handler(message: types.Message):
     user_id = str(message.from_user.id)
-    global users
-    users = load_users()
-    logging.info(f"PDF for {user_id}. Users: {list(users.keys())}")
-    if user_id in users and "pdf" in users[user_id]:
+    user = await user_store.get_async(user_id)
+    logging.info(f"PDF for {user_id}")
+    if user and "pdf" in user:
         try:
-            with open(users[user_id]["pdf"], "rb") as f:
-                await message.answer_document(f, reply_markup=main_kb)
+            file_id = await documents.send(
+                message.chat.id, lambda: summary_pdf_bytes(user), os.path.basename(user["pdf"]),
+                file_id=user.get("pdf_file_id"), kind="summary", reply_markup=main_kb
+            )
+            if file_id != user.get("pdf_file_id"):
+                await save_user(user_id, {"pdf_file_id": file_id})
         except FileNotFoundError:
-            logging.error(f"PDF {users[user_id]['pdf']} not found")
-            await message.answer("⚠️ PDF не найден.", reply_markup=main_kb)
+            logging.error(f"PDF {user['pdf']} not found")
+            await outbox.answer(message, "⚠️ PDF не найден.", reply_markup=main_kb)
     else:
-        await message.answer("Сначала рассчитайте карту.", reply_markup=main_kb)
+        await outbox.answer(message, "Сначала рассчитайте карту.", reply_markup=main_kb)
 
 @dp.message_handler(lambda m: m.text == "🔮 Расчёт" or "," in m.text)
 async def calculate(message: types.Message):
+    """Проверки и постановка расчёта в очередь; сам расчёт выполняет run_calculation."""
     user_id = str(message.from_user.id)
-    if user_id in processing_users:
+    if calc_queue.contains(f"calc:{user_id}"):
         logging.warning(f"User {user_id} processing")
-        await message.answer("⏳ Запрос обрабатывается.", reply_markup=main_kb)
+        await outbox.answer(message, "⏳ Запрос обрабатывается.", reply_markup=main_kb)
+        return
+
+    parts = [x.strip() for x in message.text.split(",")]
+    if len(parts) != 3:
+        logging.error("Invalid input")
+        await outbox.answer(message, "⚠️ Формат: ДД.ММ.ГГГГ, ЧЧ:ММ, Город", reply_markup=main_kb)
+        return
+
+    # Неоднозначное или набранное с опечаткой название — уточняем город кнопками до списания лимита
+    date_str, time_str, city = parts
+    places = await geocoder.choices(city)
+    callback_prefix = f"place|{date_str}|{time_str}|"
+    # В callback_data — geonameid (до 10 цифр): он не меняется при пересборке индекса
+    if places and "|" not in date_str + time_str and len(callback_prefix.encode()) + 10 <= 64:
+        place_kb = InlineKeyboardMarkup(row_width=1)
+        for place in places:
+            place_kb.add(InlineKeyboardButton(f"📍 {place_label(place)}", callback_data=f"{callback_prefix}{place.geonameid}"))
+        if geocoder.online:
+            place_kb.add(InlineKeyboardButton("🌐 Нет в списке — искать онлайн", callback_data=f"{callback_prefix}web"))
+        await outbox.answer(message, CHOOSE_PLACE_TEXT.format(city), reply_markup=place_kb)
+        logging.info(f"Asked {user_id} to choose from {len(places)} places for {city}")
+        return
+    await queue_calculation(message, user_id, message.text)
+
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith("place|"))
+async def place_chosen(callback_query: types.CallbackQuery):
+    """Выбор города кнопкой: данные расчёта передаются в callback_data, поэтому выбор не зависит от процесса."""
+    user_id = str(callback_query.from_user.id)
+    _, date_str, time_str, choice = callback_query.data.split("|")
+    await callback_query.answer()
+    place = None
+    if choice == "web":
+        text = callback_query.message.text or ""
+        city = text[text.find("«") + 1:text.rfind("»")].strip() if "«" in text and "»" in text else ""
+        label = f"🌐 {city}"
+    else:
+        place = geocoder.place(int(choice)) if choice.isdigit() else None
+        city = place.name.replace(",", " ") if place else ""
+        label = f"📍 {place_label(place)}" if place else ""
+    if not city:
+        await callback_query.message.edit_text("⚠️ Город не найден. Введите: ДД.ММ.ГГГГ, ЧЧ:ММ, Город")
+        return
+    await callback_query.message.edit_text(label)
+    if calc_queue.contains(f"calc:{user_id}"):
+        await outbox.answer(callback_query.message, "⏳ Запрос обрабатывается.", reply_markup=main_kb)
+        return
+    await queue_calculation(callback_query.message, user_id, f"{date_str}, {time_str}, {city}",
+                            geonameid=place.geonameid if place else None, online=place is None)
+
+async def queue_calculation(message, user_id, text, geonameid=None, online=False):
+    """Лимит, приоритет и постановка расчёта в очередь.
+
+    `geonameid` — город, выбранный кнопкой; `online=True` — кнопка «нет в списке» (город ищется в OpenCage).
+    """
+    job_id = f"calc:{user_id}"
+    user = await user_store.get_async(user_id)
+    # Проверка ограничения (резерв снимается, если расчёт не завершился)
+    time_left = stored_time_left(user, "last_calc_time") or await rate_limiter.reserve("calc", user_id, RESERVE_TTL)
+    if time_left:
+        hours, minutes = format_time_left(time_left)
+        await outbox.answer(
+            message,
+            f"⏳ Расчёт доступен раз в 24 часа. Попробуйте через {hours}ч {minutes}мин.",
+            reply_markup=main_kb
+        )
+        logging.info(f"User {user_id} blocked: time left {hours}h {minutes}m")
+        return
+
+    if calc_queue.full:
+        await rate_limiter.refund("calc", user_id)
+        await outbox.answer(message, QUEUE_FULL_TEXT, reply_markup=main_kb)
+        logging.warning(f"Queue full, rejected {user_id}")
         return
 
+    # Заказавшие подробный отчёт и вернувшиеся пользователи обслуживаются раньше новых
+    priority = 0 if user and user.get("last_report_time") else 1 if user else 2
+    status = await outbox.answer(message, CALC_STARTED_TEXT, reply_markup=main_kb)
+    payload = {
+        "chat_id": message.chat.id,
+        "user_id": user_id,
+        "text": text,
+        "geonameid": geonameid,
+        "online": online,
+        # Блокировка расчёта привязана к задаче: восстановленная после падения задача снова её получит
+        "lock_token": uuid.uuid4().hex,
+        "status_message_id": status.message_id,
+        "request_id": log_setup.request_id.get()
+    }
     try:
-        processing_users.add(user_id)
-        global users
-        users = load_users()
-
-        # Проверка ограничения
-        if user_id in users and "last_calc_time" in users[user_id]:
-            last_calc = users[user_id]["last_calc_time"]
-            now = datetime.now(pytz.utc)
-            if (now - last_calc) < timedelta(days=1):
-                time_left = timedelta(days=1) - (now - last_calc)
-                hours, remainder = divmod(int(time_left.total_seconds()), 3600)
-                minutes = remainder // 60
-                await message.answer(
-                    f"⏳ Расчёт доступен раз в 24 часа. Попробуйте через {hours}ч {minutes}мин.",
-                    reply_markup=main_kb
-                )
-                logging.info(f"User {user_id} blocked: time left {hours}h {minutes}m")
-                return
+        position = await calc_queue.submit(job_id, payload, priority)
+    except (QueueFull, DuplicateJob) as e:
+        logging.warning(f"Rejected job {job_id}: {e}")
+        await rate_limiter.refund("calc", user_id)
+        await status.edit_text(QUEUE_FULL_TEXT)
+        return
+    if calc_queue.busy:
+        await status.edit_text(queue_position_text(position))
+    logging.info(f"Queued {job_id} at position {position} (priority {priority})")
 
-        # Сообщение об обработке
-        await message.answer("⏳ Выполняется расчёт натальной карты. Это может занять 1–2 минуты...", reply_markup=main_kb)
+async def notify_queue_position(job_id, payload, position):
+    await bot.edit_message_text(queue_position_text(position), payload["chat_id"], payload["status_message_id"])
 
-        parts = [x.strip() for x in message.text.split(",")]
-        if len(parts) != 3:
-            logging.error("Invalid input")
-            await message.answer("⚠️ Формат: ДД.ММ.ГГГГ, ЧЧ:ММ, Город", reply_markup=main_kb)
-            return
+async def run_calculation(job_id, payload):
+    """Расчёт натальной карты (выполняется обработчиком очереди)."""
+    chat_id = payload["chat_id"]
+    user_id = payload["user_id"]
+    log_setup.set_request_id(payload.get("request_id") or job_id)
 
-        date_str, time_str, city = parts
-        logging.info(f"Input: {date_str}, {time_str}, {city}")
-        try:
-            geo = requests.get(f"https://api.opencagedata.com/geocode/v1/json?q={city}&key={OPENCAGE_API_KEY}").json()
-            if not geo.get("results"):
-                logging.error(f"No geocode for {city}")
-                await message.answer("❌ Город не найден.", reply_markup=main_kb)
-                return
-            lat = geo["results"][0]["geometry"].get("lat", 0.0)
-            lon = geo["results"][0]["geometry"].get("lng", 0.0)
-        except Exception as e:
-            logging.error(f"Geocode error: {e}", exc_info=True)
-            await message.answer("❌ Ошибка координат.", reply_markup=main_kb)
-            return
+    async def answer(text, **kwargs):
+        return await outbox.send_message(chat_id, text, **kwargs)
 
-        lat_str = decimal_to_dms_str(lat, True)
-        lon_str = decimal_to_dms_str(lon, False)
-        logging.info(f"Coords: lat={lat_str}, lon={lon_str}")
+    lock_token = await rate_limiter.acquire_lock("calc", user_id, LOCK_TTL, token=payload.get("lock_token"))
+    if lock_token is None:
+        logging.warning(f"User {user_id} processing")
+        await answer("⏳ Запрос обрабатывается.", reply_markup=main_kb)
+        return
 
-        tf = TimezoneFinder()
-        timezone_str = tf.timezone_at(lat=lat, lng=lon)
-        if not timezone_str:
-            logging.warning("No timezone")
-            await message.answer("❌ Часовой пояс не найден.", reply_markup=main_kb)
-            return
-        logging.info(f"Timezone: {timezone_str}")
+    completed = False
+    started = time.perf_counter()
+    metrics.IN_FLIGHT.inc(pipeline="calc")
+    try:
+        # Сообщение об обработке
+        try:
+            await bot.edit_message_text(CALC_STARTED_TEXT, chat_id, payload["status_message_id"])
+        except Exception:
+            # Текст не изменился, если задача не ждала в очереди
+            pass
 
-        timezone = pytz.timezone(timezone_str)
+        parts = [x.strip() for x in payload["text"].split(",")]
+        date_str, time_str, city = parts
+        logging.info(f"Input: {date_str}, {time_str}, {city}")
         try:
-            dt_input = datetime.strptime(f"{date_str} {time_str}", "%d.%m.%Y %H:%M")
-        except ValueError as e:
-            logging.error(f"Invalid datetime: {e}")
-            await message.answer("⚠️ Неверная дата/время.", reply_markup=main_kb)
+            birth = await natal.locate(geocoder, timezone_service, date_str, time_str, city,
+                                       geonameid=payload.get("geonameid"), online=payload.get("online", False))
+        except natal.BirthDataError as e:
+            await answer(str(e), reply_markup=main_kb)
             return
-        dt_local = timezone.localize(dt_input)
-        dt_utc = dt_local.astimezone(pytz.utc)
-        dt = Datetime(dt_utc.strftime("%Y/%m/%d"), dt_utc.strftime("%H:%M"), "+00:00")
-        logging.info(f"UTC: {dt_utc}")
 
         try:
-            chart = Chart(dt, GeoPos(lat_str, lon_str))
-            logging.info(f"Chart: {chart.houses}")
+            with metrics.stage("calc", "chart"):
+                chart = await chart_engine.chart(birth.dt_utc, birth.lat_str, birth.lon_str)
+            logging.debug("Chart cusps: %s (cache %s)", [house.lon for house in chart.houses], chart_engine.stats())
         except Exception as e:
             logging.error(f"Chart error: {e}", exc_info=True)
-            await message.answer("❌ Ошибка карты.", reply_markup=main_kb)
+            await answer("❌ Ошибка карты.", reply_markup=main_kb)
             return
 
-        planet_names = ["Sun", "Moon", "Mercury", "Venus", "Mars"]
         summary = []
-        planet_info = {}
-        aspects = get_aspects(chart, planet_names)
-        aspects_by_planet = {p: [] for p in planet_names}
-        for p1, p2, diff, aspect_name in aspects:
-            aspects_by_planet[p1].append(f"{p1} {aspect_name} {p2} ({round(diff, 1)}°)")
-            aspects_by_planet[p2].append(f"{p2} {aspect_name} {p1} ({round(diff, 1)}°)")
-        logging.info(f"Aspects: {aspects_by_planet}")
-
-        for p in planet_names:
-            try:
-                obj = chart.get(p)
-                if not obj:
-                    logging.error(f"Planet {p} not found")
-                    await message.answer(f"⚠️ Планета {p} не найдена.", reply_markup=main_kb)
-                    continue
-                sign = getattr(obj, "sign", "Unknown")
-                deg = getattr(obj, "lon", 0.0)
-                house = get_house_manually(chart, deg)
-                logging.info(f"Planet {p}: {sign}, {deg:.2f}°, House {house}")
-
-                prompt = f"{p} в знаке {sign}, дом {house}. Краткая интерпретация."
-                try:
-                    res = openai.ChatCompletion.create(
-                        model="gpt-4o",
-                        messages=[{"role": "user", "content": prompt}],
-                        temperature=0.7,
-                        max_tokens=200
-                    )
-                    reply = res.choices[0].message.content.strip() if res.choices else "Ошибка интерпретации."
-                    logging.info(f"GPT for {p}: {reply[:50]}...")
-                except Exception as e:
-                    logging.error(f"GPT error for {p}: {e}", exc_info=True)
-                    reply = "Ошибка интерпретации."
-
-                aspect_text = "\n".join([f"• {a}" for a in aspects_by_planet[p]]) if aspects_by_planet[p] else "• Нет аспектов"
-                output = f"🔍 **{p}** в {sign}, дом {house}\n📩 {reply}\n📐 Аспекты:\n{aspect_text}\n"
-                try:
-                    await message.answer(output, parse_mode="Markdown", reply_markup=main_kb)
-                    await asyncio.sleep(1.0)
-                except Exception as e:
-                    logging.error(f"Send error for {p}: {e}", exc_info=True)
-
-                pdf_output = f"[Положение] {p} в {sign}, дом {house}\n[Интерпретация] {reply}\n[Аспекты]\n{aspect_text}\n"
-                summary.append(pdf_output)
-                planet_info[p] = {
-                    "sign": sign,
-                    "degree": deg,
-                    "house": house
-                }
-            except Exception as e:
-                logging.error(f"Planet error {p}: {e}", exc_info=True)
+        # Положения и аспекты (самые точные — первыми) считаем сразу, а запросы к GPT запускаем параллельно
+        positions = natal.analyze(chart)
+        for p in sorted(set(natal.PLANET_NAMES) - {position.body for position in positions}, key=natal.PLANET_NAMES.index):
+            await answer(f"⚠️ Планета {p} не найдена.", reply_markup=main_kb)
+        tasks = [asyncio.ensure_future(short_interpretation(p.body, p.sign, p.house, user_id)) for p in positions]
 
-        # Асцендент
+        asc_task = None
         try:
-            ascendant = chart.get(const.ASC)
-            asc_sign = getattr(ascendant, "sign", "Unknown")
-            logging.info(f"Ascendant: {asc_sign}")
-
-            prompt = f"Асцендент в {asc_sign}. Краткая интерпретация."
-            try:
-                res = openai.ChatCompletion.create(
-                    model="gpt-4o",
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=0.7,
-                    max_tokens=200
-                )
-                asc_reply = res.choices[0].message.content.strip() if res.choices else "Ошибка интерпретации."
-            except Exception as e:
-                logging.error(f"GPT error for Ascendant: {e}", exc_info=True)
-                asc_reply = "Ошибка интерпретации."
-
-            asc_output = f"🔍 **Асцендент** в {asc_sign}\n📩 {asc_reply}\n"
-            try:
-                await message.answer(asc_output, parse_mode="Markdown", reply_markup=main_kb)
-                await asyncio.sleep(1.0)
-            except Exception as e:
-                logging.error(f"Send error Ascendant: {e}")
-
-            asc_pdf_output = f"[Положение] Асцендент в {asc_sign}\n[Интерпретация] {asc_reply}\n"
-            summary.append(asc_pdf_output)
-            planet_info["Ascendant"] = {"sign": asc_sign}
+            asc_sign = natal.ascendant_sign(chart)
+            logging.debug("Ascendant: %s", asc_sign)
+            asc_task = asyncio.ensure_future(short_interpretation(ASCENDANT, asc_sign, user_id=user_id))
         except Exception as e:
             logging.error(f"Ascendant error: {e}", exc_info=True)
 
+        # Отправляем ответы по порядку планет, как только готов очередной. Разделы ставятся в очередь без
+        # ожидания отправки: пока чат ждёт своей очереди, соседние короткие разделы склеиваются в одно сообщение
+        sends = []
+        try:
+            for position, task in zip(positions, tasks):
+                reply = await task
+                output = (f"🔍 **{position.body}** в {position.sign}, дом {position.house}\n📩 {reply}\n"
+                          f"📐 Аспекты:\n{natal.aspect_text(position.aspects)}\n")
+                sends.append((position.body, outbox.queue_message(
+                    chat_id, output, parse_mode="Markdown", reply_markup=main_kb, priority=BULK, merge=True
+                )))
+                summary.append(natal.summary_entry(position, reply))
+
+            # Асцендент
+            if asc_task is not None:
+                asc_reply = await asc_task
+                asc_output = f"🔍 **Асцендент** в {asc_sign}\n📩 {asc_reply}\n"
+                sends.append(("Ascendant", outbox.queue_message(
+                    chat_id, asc_output, parse_mode="Markdown", reply_markup=main_kb, priority=BULK, merge=True
+                )))
+                summary.append(natal.ascendant_summary_entry(asc_sign, asc_reply))
+        finally:
+            for task in tasks + [asc_task]:
+                if task is not None and not task.done():
+                    task.cancel()
+            results = await asyncio.gather(*[future for _, future in sends], return_exceptions=True)
+            for (body, _), result in zip(sends, results):
+                if isinstance(result, Exception):
+                    logging.error(f"Send error for {body}: {result}", exc_info=result)
+
         try:
-            pdf = FPDF()
-            pdf.add_page()
-            pdf.add_font("DejaVu", "", "DejaVuSans.ttf", uni=True)
-            pdf.set_font("DejaVu", size=12)
-            for line in summary:
-                if not isinstance(line, str):
-                    line = str(line)
-                for chunk in [line[i:i+200] for i in range(0, len(line), 200)]:
-                    pdf.multi_cell(0, 10, chunk)
             pdf_path = f"/tmp/user_{user_id}_report.pdf" if os.getenv("RENDER") else f"user_{user_id}_report.pdf"
-            pdf.output(pdf_path)
+            with metrics.stage("calc", "pdf"):
+                await pdf_renderer.render_to_file("summary", summary, pdf_path)
             logging.info(f"PDF: {pdf_path}")
         except Exception as e:
             logging.error(f"PDF error: {e}", exc_info=True)
-            await message.answer(f"❌ Ошибка PDF: {e}", reply_markup=main_kb)
+            await answer(f"❌ Ошибка PDF: {e}", reply_markup=main_kb)
             return
 
-        users[user_id] = {
+        await save_user(user_id, {
             "pdf": pdf_path,
-            "planets": planet_info,
-            "lat": lat,
-            "lon": lon,
+            "pdf_file_id": None,
+            "planets": natal.planets_info(positions, asc_sign if asc_task is not None else None),
+            "lat": birth.lat,
+            "lon": birth.lon,
             "city": city,
             "date_str": date_str,
             "time_str": time_str,
-            "dt_utc": dt_utc,
+            "dt_utc": birth.dt_utc,
             "last_calc_time": datetime.now(pytz.utc)
-        }
-        await save_users()
-        logging.info(f"Saved for {user_id}: {users[user_id]}")
+        })
+        await rate_limiter.confirm("calc", user_id, COOLDOWN)
+        completed = True
 
         subscription_kb = InlineKeyboardMarkup(row_width=1)
         subscription_kb.add(
@@ -488,25 +574,40 @@ async def calculate(message: types.Message):
         subscription_kb.add(
             InlineKeyboardButton("✅ Я подписался", callback_data="check_subscription")
         )
-        await message.answer(
+        await answer(
             "✅ Готово! Хотите подробный отчёт? Подпишитесь!",
             reply_markup=subscription_kb,
             parse_mode="Markdown"
         )
     except Exception as e:
         logging.error(f"Calculate error: {e}", exc_info=True)
-        await message.answer(f"❌ Ошибка: {e}", reply_markup=main_kb)
+        await answer(f"❌ Ошибка: {e}", reply_markup=main_kb)
     finally:
-        processing_users.remove(user_id)
+        metrics.IN_FLIGHT.dec(pipeline="calc")
+        metrics.STAGE_SECONDS.observe(time.perf_counter() - started, pipeline="calc", stage="total")
+        if not completed:
+            await rate_limiter.refund("calc", user_id)
+        await rate_limiter.release_lock("calc", user_id, lock_token)
+
+calc_queue = JobQueue(
+    run_calculation,
+    JOBS_DB,
+    workers=int(os.getenv("CALC_WORKERS", "4")),
+    max_size=int(os.getenv("CALC_QUEUE_SIZE", "200")),
+    on_position=notify_queue_position
+)
+
+metrics.gauge("astrobot_calc_queue_length", "Calculations waiting in the queue", func=lambda: len(calc_queue))
+metrics.gauge("astrobot_calc_queue_running", "Calculations being processed", func=lambda: calc_queue.running)
+metrics.gauge("astrobot_outbox_pending", "Outgoing messages waiting to be sent", func=lambda: outbox.pending)
+metrics.gauge("astrobot_chart_cache_size", "Cached chart snapshots", func=lambda: chart_engine.stats()["size"])
 
 @dp.callback_query_handler(lambda c: c.data == "check_subscription")
 async def process_subscription_check(callback_query: types.CallbackQuery):
     user_id = str(callback_query.from_user.id)
-    global users
-    users = load_users()
-    logging.info(f"Subscription check for {user_id}. Users: {list(users.keys())}")
-    if await is_user_subscribed(user_id):
-        if user_id not in users:
+    logging.info(f"Subscription check for {user_id}")
+    if await is_user_subscribed(user_id, recheck_negative=True):
+        if not await user_store.exists_async(user_id):
             logging.warning(f"User {user_id} not in users")
             await callback_query.message.edit_text("❗ Сначала сделайте расчёт.", reply_markup=main_kb)
             await callback_query.answer()
@@ -527,16 +628,69 @@ async def process_subscription_check(callback_query: types.CallbackQuery):
         )
         await bot.answer_callback_query(callback_query.id, text="❌ Вы ещё не подписались.", show_alert=True)
 
+REPORT_EDIT_INTERVAL = float(os.getenv("REPORT_EDIT_INTERVAL", "2.0"))
+REPORT_MODEL = natal.REPORT_MODEL
+
+class ReportProgress:
+    """Статусное сообщение с прогрессом генерации разделов отчёта (правки не чаще интервала)."""
+
+    def __init__(self, status_message, titles, interval=REPORT_EDIT_INTERVAL):
+        self.status_message = status_message
+        self.interval = interval
+        self.states = {title: "wait" for title in titles}
+        self.chars = {title: 0 for title in titles}
+        self.dirty = False
+        self.last_text = None
+
+    def update(self, title, state=None, chars=0):
+        if state:
+            self.states[title] = state
+        self.chars[title] += chars
+        self.dirty = True
+
+    def render(self):
+        icons = {"wait": "⏳", "writing": "✍️", "done": "✅", "error": "⚠️"}
+        lines = ["⏳ Подготавливаем ваш подробный отчёт:"]
+        for title, state in self.states.items():
+            suffix = f" — {self.chars[title]} симв." if state == "writing" else ""
+            lines.append(f"{icons[state]} {title}{suffix}")
+        return "\n".join(lines)
+
+    async def flush(self):
+        text = self.render()
+        self.dirty = False
+        if text == self.last_text:
+            return
+        try:
+            await self.status_message.edit_text(text)
+            self.last_text = text
+        except Exception as e:
+            logging.warning(f"Progress edit error: {e}")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.dirty:
+                await self.flush()
+
+async def stream_report_section(prompt, title, progress, user_id):
+    """Потоковая генерация раздела отчёта с обновлением прогресса по мере прихода токенов."""
+    return await natal.request_report_section(
+        llm_gateway, prompt, user_id, REPORT_MODEL,
+        on_delta=lambda delta: progress.update(title, "writing", len(delta))
+    )
+
 @dp.message_handler(lambda m: m.text == "📝 Заказать подробную натальную карту")
 async def send_detailed_report(message: types.Message):
     user_id = str(message.from_user.id)
-    global users
-    users = load_users()
-    logging.info(f"Detailed report for {user_id}. Users: {list(users.keys())}")
+    user_data = await user_store.get_async(user_id)
+    logging.info(f"Detailed report for {user_id}")
+    lock_token = None
+    reserved = completed = False
     try:
-        if user_id not in users:
+        if user_data is None:
             logging.warning(f"User {user_id} not in users")
-            await message.answer("❗ Сначала сделайте расчёт.", reply_markup=main_kb)
+            await outbox.answer(message, "❗ Сначала сделайте расчёт.", reply_markup=main_kb)
             return
         if not await is_user_subscribed(user_id):
             subscription_kb = InlineKeyboardMarkup(row_width=1)
@@ -546,117 +700,206 @@ async def send_detailed_report(message: types.Message):
             subscription_kb.add(
                 InlineKeyboardButton("✅ Я подписался", callback_data="check_subscription")
             )
-            await message.answer(
+            await outbox.answer(
+                message,
                 "Подпишитесь для отчёта!",
                 reply_markup=subscription_kb,
                 parse_mode="Markdown"
             )
             return
 
-        # Сообщение об ожидании
-        await message.answer("⏳ Подготавливаем ваш подробный отчёт. Это может занять 2–3 минуты...")
+        lock_token = await rate_limiter.acquire_lock("report", user_id, LOCK_TTL)
+        if lock_token is None:
+            logging.warning(f"User {user_id} report processing")
+            await outbox.answer(message, "⏳ Отчёт уже готовится.", reply_markup=main_kb)
+            return
 
-        # Проверка ограничения на один заказ в сутки
-        now = datetime.now(pytz.utc)
-        if user_id in users and "last_report_time" in users[user_id]:
-            last_report = users[user_id]["last_report_time"]
-            if (now - last_report) < timedelta(days=1):
-                time_left = timedelta(days=1) - (now - last_report)
-                hours, remainder = divmod(int(time_left.total_seconds()), 3600)
-                minutes = remainder // 60
-                await message.answer(
-                    f"⏳ Подробный отчёт можно заказать раз в 24 часа. Попробуйте через {hours}ч {minutes}мин.",
-                    reply_markup=main_kb
-                )
-                logging.info(f"User {user_id} blocked from report: time left {hours}h {minutes}m")
-                return
-
-        user_data = users[user_id]
-        first_name = message.from_user.first_name or "Пользователь"
-        date_str = user_data["date_str"]
-        time_str = user_data["time_str"]
-        city = user_data["city"]
-        dt_utc_str = user_data["dt_utc"].strftime("%Y-%m-%d %H:%M:%S")
-        lat = user_data["lat"]
-        lon = user_data["lon"]
-
-        planet_lines = "\n".join([
-            f"{p}: {info['sign']} ({round(info['degree'], 2)}°), дом: {info['house']}"
-            for p, info in user_data["planets"].items() if p != "Ascendant" and 'house' in info
-        ])
-        asc_line = f"Ascendant: {user_data['planets'].get('Ascendant', {}).get('sign', 'Unknown')}" if "Ascendant" in user_data["planets"] else ""
-
-        header = f"""
-Имя: {first_name}
-Дата: {date_str}
-Время: {time_str}
-Город: {city}
-UTC: {dt_utc_str}
-Широта: {lat}
-Долгота: {lon}
-Планеты:
-{planet_lines}
-{asc_line}
-"""
-
-        sections = [
-            ("Планеты", "Подробно опиши влияние планет на личность, конфликты, дары."),
-            ("Дома", "Как дома влияют на жизнь, с планетами."),
-            ("Аспекты", "Три значимых аспекта."),
-            ("Асцендент", "Влияние Асцендента на личность и образ."),
-            ("Рекомендации", "Советы по саморазвитию, любви, карьере.")
-        ]
-
-        for title, instruction in sections:
-            prompt = f"""
-Астролог. Анализируй данные:
-
-{header}
-
-Задача: {instruction}
-"""
+        sections = natal.REPORT_SECTIONS
+        job_id = report_job_id(user_id, user_data, sections)
 
+        # Проверка ограничения на один заказ в сутки; прерванный отчёт по тем же данным можно дописать
+        now = datetime.now(pytz.utc)
+        time_left = (stored_time_left(user_data, "last_report_time")
+                     or await rate_limiter.reserve("report", user_id, RESERVE_TTL))
+        if time_left and not await report_checkpoints.pending_async(job_id):
+            hours, minutes = format_time_left(time_left)
+            await outbox.answer(
+                message,
+                f"⏳ Подробный отчёт можно заказать раз в 24 часа. Попробуйте через {hours}ч {minutes}мин.",
+                reply_markup=main_kb
+            )
+            logging.info(f"User {user_id} blocked from report: time left {hours}h {minutes}m")
+            return
+        reserved = True
+        started = time.perf_counter()
+        metrics.IN_FLIGHT.inc(pipeline="report")
+
+        header = natal.report_header(message.from_user.first_name or "Пользователь", user_data)
+        # Разделы, готовые после прошлой попытки, берутся из контрольной точки
+        saved = await report_checkpoints.begin_async(job_id, user_id)
+        if saved:
+            logging.info(f"Resuming report {job_id} for {user_id}: {len(saved)}/{len(sections)} sections saved")
+
+        # Сообщение об ожидании, в котором затем показывается прогресс
+        status = await outbox.answer(message, "⏳ Подготавливаем ваш подробный отчёт. Это может занять 1–2 минуты...")
+        progress = ReportProgress(status, [title for title, _ in sections])
+        for title in saved:
+            progress.update(title, "done")
+        progress_task = asyncio.ensure_future(progress.run())
+
+        async def generate(title, instruction):
+            if title in saved:
+                return saved[title]
             try:
-                res = openai.ChatCompletion.create(
-                    model="gpt-4o",
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=0.95,
-                    max_tokens=2000
-                )
-                content = res.choices[0].message.content.strip() or "Ошибка анализа."
-                logging.info(f"GPT for {title}: {content[:50]}...")
-
-                pdf = FPDF()
-                pdf.add_page()
-                pdf.add_font("DejaVu", "", "DejaVuSans.ttf", uni=True)
-                pdf.set_font("DejaVu", size=12)
-                for line in content.split("\n"):
-                    pdf.multi_cell(0, 10, line)
-                    pdf.ln(2)
-
-                filename = f"/tmp/{user_id}_{title}.pdf" if os.getenv("RENDER") else f"{user_id}_{title}.pdf"
-                pdf.output(filename)
-                with open(filename, "rb") as f:
-                    await message.answer_document(f, caption=f"📘 Отчёт: {title}", reply_markup=main_kb)
-                os.remove(filename)
-                logging.info(f"Sent {title} for {user_id}")
+                content = await stream_report_section(natal.report_prompt(header, instruction), title, progress, user_id)
+                logging.debug("GPT for %s: %.50s...", title, content)
+                await report_checkpoints.save_section_async(job_id, title, content)
+                progress.update(title, "done")
+                return content
             except Exception as e:
-                logging.error(f"Error in {title} for {user_id}: {e}", exc_info=True)
-                await message.answer(f"⚠️ Ошибка в {title}: {e}", reply_markup=main_kb)
+                logging.error(f"Error in {title} for {user_id}: {e}", exc_info=not isinstance(e, llm.LLMError))
+                progress.update(title, "error")
+                return None
+
+        try:
+            with metrics.stage("report", "sections"):
+                contents = await asyncio.gather(*[generate(title, instruction) for title, instruction in sections])
+        finally:
+            progress_task.cancel()
+        await progress.flush()
+
+        failed = [title for (title, _), content in zip(sections, contents) if not content]
+        if failed:
+            # Неполный отчёт не отправляется: готовые разделы сохранены, повторный заказ допишет остальные
+            await outbox.answer(
+                message,
+                f"⚠️ Не удалось подготовить разделы: {', '.join(failed)}. Готовые разделы сохранены — "
+                "закажите отчёт ещё раз, чтобы дописать недостающие.",
+                reply_markup=main_kb
+            )
+            return
+        chapters = [(title, content) for (title, _), content in zip(sections, contents)]
+
+        pdf_bytes = await report_checkpoints.pdf_async(job_id)
+        if pdf_bytes is None:
+            with metrics.stage("report", "pdf"):
+                pdf_bytes = await pdf_renderer.render("report", chapters)
+            await report_checkpoints.save_pdf_async(job_id, pdf_bytes)
+        with metrics.stage("report", "upload"):
+            await outbox.answer_document(
+                message,
+                types.InputFile(io.BytesIO(pdf_bytes), filename="natal_report.pdf"),
+                caption="📘 Ваш подробный отчёт",
+                reply_markup=main_kb
+            )
+        logging.info(f"Sent report ({len(chapters)} sections) for {user_id}")
+        completed = True
+        await report_checkpoints.complete_async(job_id)
 
         # Обновление времени последнего отчёта
-        users[user_id]["last_report_time"] = now
-        await save_users()
+        await save_user(user_id, {"last_report_time": now})
+        await rate_limiter.confirm("report", user_id, COOLDOWN)
         logging.info(f"Report done for {user_id}")
     except Exception as e:
         logging.error(f"Report error for {user_id}: {e}", exc_info=True)
-        await message.answer(f"❌ Ошибка отчёта: {e}", reply_markup=main_kb)
+        await outbox.answer(message, f"❌ Ошибка отчёта: {e}", reply_markup=main_kb)
+    finally:
+        if reserved:
+            metrics.IN_FLIGHT.dec(pipeline="report")
+            metrics.STAGE_SECONDS.observe(time.perf_counter() - started, pipeline="report", stage="total")
+        if reserved and not completed:
+            await rate_limiter.refund("report", user_id)
+        if lock_token is not None:
+            await rate_limiter.release_lock("report", user_id, lock_token)
+
+async def warm_up_user_store():
+    await asyncio.get_event_loop().run_in_executor(None, user_store.count)
+
+async def warm_up_analytics():
+    await asyncio.get_event_loop().run_in_executor(None, importlib.import_module, "chart_analytics")
+
+WARM_UP_STEPS = [
+    ("timezones", timezone_service.warm_up),
+    ("gazetteer", geocoder.warm_up),
+    ("pdf", pdf_renderer.warm_up),
+    ("ephemeris", chart_engine.warm_up),
+    ("analytics", warm_up_analytics),
+    ("interpretations", interpretation_store.load_async),
+    ("users", warm_up_user_store),
+]
+
+async def init_services():
+    """Подготовка сервисов процесса (общая для polling и вебхука).
+
+    Прогрев по умолчанию идёт в фоне, и обновления обрабатываются сразу; сервисы, к которым обратились
+    до конца прогрева, инициализируются при первом использовании. STARTUP_WARMUP=blocking — ждать прогрева.
+    """
+    global transit_broadcast
+    # Однократный перенос старого users.json (до обработки обновлений)
+    try:
+        migrate_if_needed(user_store, USERS_FILE)
+    except Exception as e:
+        logging.error(f"Error migrating {USERS_FILE}: {e}", exc_info=True)
+    if os.getenv("STARTUP_WARMUP", "background") == "blocking":
+        await startup_state.warm_up_now(WARM_UP_STEPS)
+    else:
+        startup_state.start_warm_up(WARM_UP_STEPS)
+    await calc_queue.start()
+    report_checkpoints.start()
+    # Рассылку ведёт один процесс: при нескольких рабочих процессах вебхука — процесс 0
+    if os.getenv("TRANSITS_ENABLED", "0") == "1" and os.getenv("WORKER_INDEX", "0") == "0":
+        from transits import TransitBroadcast, TransitStore
+        transit_broadcast = TransitBroadcast(
+            TransitStore(os.getenv("TRANSITS_DB", TRANSITS_DB)), user_store, outbox, llm_gateway,
+            rate=float(os.getenv("TRANSITS_RATE", "20")),
+            hour=int(os.getenv("TRANSITS_HOUR", "6")),
+            max_texts=int(os.getenv("TRANSITS_MAX_TEXTS", "200"))
+        )
+        transit_broadcast.start()
+    metrics_port = int(os.getenv("METRICS_PORT", "9102"))
+    if metrics_port:
+        # У каждого рабочего процесса вебхука свой порт: METRICS_PORT + номер процесса
+        await metrics.start_server(os.getenv("METRICS_HOST", "127.0.0.1"), metrics_port + int(os.getenv("WORKER_INDEX", "0")))
+    startup_state.mark("init")
+    logging.info(f"Bot started: {startup_state.report()}")
 
 async def on_startup(_):
     await clear_webhook()
-    global users
-    users = load_users()
-    logging.info("Bot started")
+    await init_services()
+
+async def on_shutdown(_):
+    startup_state.cancel()
+    if transit_broadcast is not None:
+        await transit_broadcast.close()
+    await calc_queue.stop(timeout=int(os.getenv("SHUTDOWN_TIMEOUT", "60")))
+    await outbox.stop()
+    await metrics.stop_server()
+    await geocoder.close()
+    await llm_gateway.close()
+    interpretation_store.close()
+    pdf_renderer.close()
+    chart_engine.close()
+    report_checkpoints.close()
+    user_store.close()
+    await rate_limiter.close()
+    logging.info("Bot stopped")
+
+startup_state.mark("module")
 
 if __name__ == "__main__":
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
\ No newline at end of file
+    if BOT_MODE == "webhook":
+        webhook.run_in_process(
+            dp, init_services, lambda: on_shutdown(dp),
+            host=os.getenv("WEBAPP_HOST", "0.0.0.0"),
+            port=int(os.getenv("PORT", "8080")),
+            path=WEBHOOK_PATH,
+            url=WEBHOOK_URL,
+            secret=WEBHOOK_SECRET,
+            api_url=TELEGRAM_API_URL,
+            is_ready=lambda: startup_state.ready
+        )
+    else:
+        executor.start_polling(
+            dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown,
+            allowed_updates=webhook.ALLOWED_UPDATES
+        )
\ No newline at end of file
@@ -0,0 +1,274 @@
+"""Метрики бота в текстовом формате Prometheus и HTTP-эндпоинт /metrics.
+
+Счётчики и гистограммы хранятся в памяти процесса; обновление — словарь и сложение под блокировкой,
+поэтому метрики можно не отключать в продакшене.
+"""
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Цены OpenAI, долларов за миллион токенов (вход, выход)
+OPENAI_PRICES = {
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-3.5-turbo": (0.5, 1.5),
+}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, (), value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self.samples():
+            lines.append(f"{name}{_format_labels(self.labels, key, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Значение «сейчас»; `func` вычисляет его при каждом чтении (для gauge без меток)."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), func=None):
+        super().__init__(name, help, labels)
+        self.func = func
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """Число выполняющихся операций внутри блока."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def samples(self):
+        if self.func is not None:
+            try:
+                return [(self.name, (), (), self.func())]
+            except Exception as e:
+                logging.warning(f"Gauge {self.name} error: {e}")
+                return []
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    samples.append((f"{self.name}_bucket", key, (("le", _format_value(bound)),), cumulative))
+                samples.append((f"{self.name}_sum", key, (), total))
+                samples.append((f"{self.name}_count", key, (), count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labels=()):
+    return REGISTRY.register(Counter(name, help, labels))
+
+
+def gauge(name, help, labels=(), func=None):
+    return REGISTRY.register(Gauge(name, help, labels, func))
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+
+# Метрики бота
+STAGE_SECONDS = histogram("astrobot_stage_seconds", "Duration of pipeline stages", ("pipeline", "stage"))
+STAGE_ERRORS = counter("astrobot_stage_errors_total", "Exceptions raised in pipeline stages", ("pipeline", "stage"))
+IN_FLIGHT = gauge("astrobot_in_flight", "Requests currently being processed", ("pipeline",))
+OPENAI_SECONDS = histogram("astrobot_openai_seconds", "OpenAI request duration", ("model", "kind"))
+OPENAI_REQUESTS = counter("astrobot_openai_requests_total", "OpenAI requests by outcome", ("model", "kind", "status"))
+OPENAI_TOKENS = counter("astrobot_openai_tokens_total", "OpenAI tokens used", ("model", "direction"))
+OPENAI_COST = counter("astrobot_openai_cost_usd_total", "Estimated OpenAI cost in USD", ("model",))
+OPENAI_RETRIES = counter("astrobot_openai_retries_total", "OpenAI request retries", ("model", "kind"))
+OPENAI_FALLBACKS = counter("astrobot_openai_fallbacks_total", "Requests sent to the fallback model", ("model", "fallback"))
+TELEGRAM_SECONDS = histogram("astrobot_telegram_send_seconds", "Telegram send call duration", ("method",))
+TELEGRAM_ERRORS = counter("astrobot_telegram_send_errors_total", "Telegram send errors", ("method", "error"))
+DOCUMENT_SENDS = counter("astrobot_document_sends_total", "Documents sent by file_id or by upload", ("kind", "source"))
+GEOCODE_LOOKUPS = counter("astrobot_geocode_lookups_total", "City lookups by source", ("source",))
+TRANSIT_MESSAGES = counter("astrobot_transit_messages_total", "Daily transit messages by outcome", ("status",))
+STARTUP_SECONDS = gauge("astrobot_startup_seconds", "Duration of startup phases and warm-up steps", ("phase",))
+READY = gauge("astrobot_ready", "1 after background warm-up has finished")
+STORE_SECONDS = histogram(
+    "astrobot_store_seconds", "SQLite store query duration", ("store", "query"),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+)
+
+
+@contextmanager
+def stage(pipeline, name):
+    """Замер этапа обработки; исключения учитываются в счётчике ошибок этапа."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(pipeline=pipeline, stage=name)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, pipeline=pipeline, stage=name)
+
+
+@contextmanager
+def openai_call(model, kind):
+    """Замер запроса к OpenAI с учётом результата (ok/error)."""
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        OPENAI_SECONDS.observe(time.perf_counter() - started, model=model, kind=kind)
+        OPENAI_REQUESTS.inc(model=model, kind=kind, status=status)
+
+
+def estimate_tokens(text):
+    """Грубая оценка числа токенов для ответов без usage (русский текст — около 3 символов на токен)."""
+    return max(1, len(text) // 3)
+
+
+def record_openai_usage(model, prompt_tokens, completion_tokens):
+    OPENAI_TOKENS.inc(prompt_tokens, model=model, direction="prompt")
+    OPENAI_TOKENS.inc(completion_tokens, model=model, direction="completion")
+    prices = OPENAI_PRICES.get(model)
+    if prices:
+        OPENAI_COST.inc((prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1_000_000, model=model)
+
+
+def render():
+    return REGISTRY.render()
+
+
+_runner = None
+
+
+async def start_server(host="127.0.0.1", port=9102):
+    """HTTP-сервер с /metrics (отдельный от вебхука, по умолчанию только локальный)."""
+    global _runner
+
+    async def handle(_):
+        return web.Response(body=render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    _runner = web.AppRunner(app)
+    await _runner.setup()
+    await web.TCPSite(_runner, host, port).start()
+    logging.info(f"Metrics on http://{host}:{port}/metrics")
+
+
+async def stop_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -0,0 +1,197 @@
+"""Общие шаги расчёта натальной карты и отчёта, не зависящие от Telegram.
+
+Используются обработчиками бота (main.py) и пакетной генерацией (batch.py).
+"""
+import logging
+from collections import namedtuple
+from datetime import datetime
+
+import pytz
+from flatlib import const
+
+import metrics
+from geocoding import GeocodingError
+from interpretations import ASCENDANT, prompt_for, request_interpretation
+from llm import LLMError
+
+PLANET_NAMES = ["Sun", "Moon", "Mercury", "Venus", "Mars"]
+# Тела карты: все объекты flatlib, кроме расчётных точек (Сизигия, Парс Фортуны), которые не используются
+CHART_OBJECTS = [obj for obj in const.LIST_OBJECTS if obj not in (const.SYZYGY, const.PARS_FORTUNA)]
+REPORT_MODEL = "gpt-4o"
+
+REPORT_SECTIONS = [
+    ("Планеты", "Подробно опиши влияние планет на личность, конфликты, дары."),
+    ("Дома", "Как дома влияют на жизнь, с планетами."),
+    ("Аспекты", "Три значимых аспекта."),
+    ("Асцендент", "Влияние Асцендента на личность и образ."),
+    ("Рекомендации", "Советы по саморазвитию, любви, карьере.")
+]
+
+# Место и момент рождения: координаты, строки координат для flatlib, часовой пояс и время UTC
+Birth = namedtuple("Birth", "date_str time_str city lat lon lat_str lon_str timezone dt_utc")
+
+# Положение тела в карте и его аспекты (строки для ответа)
+Position = namedtuple("Position", "body sign degree house aspects")
+
+
+class BirthDataError(Exception):
+    """Данные рождения не удалось разобрать; текст исключения — сообщение для пользователя."""
+
+
+def decimal_to_dms_str(degree, is_lat=True):
+    d = int(abs(degree))
+    m = int((abs(degree) - d) * 60)
+    suffix = 'n' if is_lat and degree >= 0 else 's' if is_lat else 'e' if degree >= 0 else 'w'
+    return f"{d}{suffix}{str(m).zfill(2)}"
+
+
+async def locate(geocoder, timezone_service, date_str, time_str, city, pipeline="calc", geonameid=None, online=False):
+    """Геокодирование, часовой пояс и перевод местного времени рождения в UTC.
+
+    `geonameid` — место из локального индекса городов, если пользователь выбрал его кнопкой;
+    `online=True` — город ищется сразу в OpenCage (кнопка «нет в списке»).
+    """
+    try:
+        with metrics.stage(pipeline, "geocode"):
+            coords = await geocoder.geocode(city, geonameid=geonameid, online=online)
+    except GeocodingError as e:
+        logging.error(f"Geocode error: {e}", exc_info=True)
+        raise BirthDataError("❌ Ошибка координат.")
+    if coords is None:
+        logging.error(f"No geocode for {city}")
+        raise BirthDataError("❌ Город не найден.")
+    lat, lon = coords
+
+    lat_str = decimal_to_dms_str(lat, True)
+    lon_str = decimal_to_dms_str(lon, False)
+    logging.debug("Coords: lat=%s, lon=%s", lat_str, lon_str)
+
+    with metrics.stage(pipeline, "timezone"):
+        timezone_str = await timezone_service.timezone_at(lat, lon)
+    if not timezone_str:
+        logging.warning("No timezone")
+        raise BirthDataError("❌ Часовой пояс не найден.")
+    logging.debug("Timezone: %s (cache %s)", timezone_str, timezone_service.stats())
+
+    try:
+        dt_input = datetime.strptime(f"{date_str} {time_str}", "%d.%m.%Y %H:%M")
+    except ValueError as e:
+        logging.error(f"Invalid datetime: {e}")
+        raise BirthDataError("⚠️ Неверная дата/время.")
+    dt_utc = pytz.timezone(timezone_str).localize(dt_input).astimezone(pytz.utc)
+    logging.debug("UTC: %s", dt_utc)
+    return Birth(date_str, time_str, city, lat, lon, lat_str, lon_str, timezone_str, dt_utc)
+
+
+def analyze(chart, planet_names=PLANET_NAMES, pipeline="calc", aspect_bodies=None):
+    """Положения планет с домами и аспектами (самые точные — первыми); отсутствующие в карте планеты пропускаются.
+
+    В списки аспектов попадают пары из `aspect_bodies` — по умолчанию только сами `planet_names`, как
+    в сообщении пользователю; chart_analytics.ASPECT_BODIES даёт аспекты со всеми телами карты.
+    """
+    # numpy загружается при первом расчёте (или при прогреве), а не при запуске бота
+    from chart_analytics import chart_aspects, chart_houses
+    bodies = tuple(aspect_bodies or planet_names)
+    with metrics.stage(pipeline, "analytics"):
+        aspects = chart_aspects(chart, bodies)
+        houses = chart_houses(chart, planet_names)
+    aspects_by_planet = {p: [] for p in set(bodies) | set(planet_names)}
+    for p1, p2, diff, aspect_name in aspects:
+        aspects_by_planet[p1].append(f"{p1} {aspect_name} {p2} ({round(diff, 1)}°)")
+        aspects_by_planet[p2].append(f"{p2} {aspect_name} {p1} ({round(diff, 1)}°)")
+    logging.debug("Aspects: %s", aspects)
+
+    positions = []
+    for p in planet_names:
+        obj = chart.get(p)
+        if not obj:
+            logging.error(f"Planet {p} not found")
+            continue
+        sign = getattr(obj, "sign", "Unknown")
+        deg = getattr(obj, "lon", 0.0)
+        logging.debug("Planet %s: %s, %.2f°, House %s", p, sign, deg, houses.get(p))
+        positions.append(Position(p, sign, deg, houses.get(p), aspects_by_planet[p]))
+    return positions
+
+
+def ascendant_sign(chart):
+    return getattr(chart.get(const.ASC), "sign", "Unknown")
+
+
+def aspect_text(aspects):
+    return "\n".join([f"• {a}" for a in aspects]) if aspects else "• Нет аспектов"
+
+
+def summary_entry(position, reply):
+    """Раздел краткого PDF для планеты."""
+    return (f"[Положение] {position.body} в {position.sign}, дом {position.house}\n"
+            f"[Интерпретация] {reply}\n[Аспекты]\n{aspect_text(position.aspects)}\n")
+
+
+def ascendant_summary_entry(sign, reply):
+    return f"[Положение] Асцендент в {sign}\n[Интерпретация] {reply}\n"
+
+
+async def short_interpretation(store, gateway, body, sign, house="", user_id=None, pipeline="calc"):
+    """Краткая интерпретация: из библиотеки, а при промахе — от GPT через шлюз."""
+    reply = store.get(body, sign, house)
+    if reply is not None:
+        return reply
+    try:
+        with metrics.stage(pipeline, "interpretation_gpt"):
+            reply = await request_interpretation(gateway, prompt_for(body, sign, house), user_id)
+        logging.debug("GPT for %s: %.50s...", body, reply)
+    except Exception as e:
+        logging.error(f"GPT error for {body}: {e}", exc_info=not isinstance(e, LLMError))
+        return "Ошибка интерпретации."
+    try:
+        await store.add_async(body, sign, house, reply)
+    except Exception as e:
+        logging.error(f"Interpretation store error for {body}: {e}", exc_info=True)
+    return reply
+
+
+def planets_info(positions, asc_sign=None):
+    """Положения в формате, который хранится у пользователя (поле planets)."""
+    info = {p.body: {"sign": p.sign, "degree": p.degree, "house": p.house} for p in positions}
+    if asc_sign is not None:
+        info[ASCENDANT] = {"sign": asc_sign}
+    return info
+
+
+def report_header(first_name, data):
+    """Исходные данные карты для запросов разделов подробного отчёта."""
+    planet_lines = "\n".join([
+        f"{p}: {info['sign']} ({round(info['degree'], 2)}°), дом: {info['house']}"
+        for p, info in data["planets"].items() if p != ASCENDANT and 'house' in info
+    ])
+    asc_line = f"Ascendant: {data['planets'].get(ASCENDANT, {}).get('sign', 'Unknown')}" if ASCENDANT in data["planets"] else ""
+    return f"""
+Имя: {first_name}
+Дата: {data["date_str"]}
+Время: {data["time_str"]}
+Город: {data["city"]}
+UTC: {data["dt_utc"].strftime("%Y-%m-%d %H:%M:%S")}
+Широта: {data["lat"]}
+Долгота: {data["lon"]}
+Планеты:
+{planet_lines}
+{asc_line}
+"""
+
+
+def report_prompt(header, instruction):
+    return f"""
+Астролог. Анализируй данные:
+
+{header}
+
+Задача: {instruction}
+"""
+
+
+async def request_report_section(gateway, prompt, user_id=None, model=REPORT_MODEL, on_delta=None):
+    """Раздел подробного отчёта; с `on_delta` ответ приходит потоком."""
+    return await gateway.complete(
+        prompt, model, "report_section", user_id=user_id, temperature=0.95, max_tokens=2000, on_delta=on_delta
+    )
@@ -0,0 +1,144 @@
+import asyncio
+import io
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+FONT_FAMILY = "DejaVu"
+FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "DejaVuSans.ttf")
+
+# Метрики шрифта разбираются один раз на процесс и затем подставляются в каждый новый документ
+_font_entry = None
+_font_files = None
+
+
+def load_font():
+    """Однократный разбор TTF-шрифта в текущем процессе."""
+    global _font_entry, _font_files
+    if _font_entry is None:
+        # fpdf нужен только процессам отрисовки, поэтому импортируется при первом использовании
+        from fpdf import FPDF
+        probe = FPDF()
+        probe.add_font(FONT_FAMILY, "", FONT_PATH, uni=True)
+        _font_entry = probe.fonts[FONT_FAMILY.lower()]
+        _font_files = probe.font_files
+    return _font_entry
+
+
+def _warm_up_worker():
+    load_font()
+
+
+def new_document():
+    """Новый FPDF-документ с уже подключённым шрифтом DejaVu."""
+    from fpdf import FPDF
+    load_font()
+    pdf = FPDF()
+    entry = dict(_font_entry)
+    # Набор использованных символов свой у каждого документа
+    entry["subset"] = list(_font_entry["subset"])
+    entry["i"] = len(pdf.fonts) + 1
+    pdf.fonts[FONT_FAMILY.lower()] = entry
+    pdf.font_files.update({key: dict(value) for key, value in _font_files.items()})
+    return pdf
+
+
+def _clean(text):
+    """fpdf 1.7 падает на символах вне BMP (большинство эмодзи), поэтому они отбрасываются."""
+    return "".join(ch for ch in text if ord(ch) <= 0xFFFF)
+
+
+def _summary_template(pdf, lines):
+    """Краткий отчёт после расчёта: строки режутся на куски по 200 символов."""
+    pdf.add_page()
+    pdf.set_font(FONT_FAMILY, size=12)
+    for line in lines:
+        if not isinstance(line, str):
+            line = str(line)
+        line = _clean(line)
+        for chunk in [line[i:i+200] for i in range(0, len(line), 200)]:
+            pdf.multi_cell(0, 10, chunk)
+
+
+def _report_template(pdf, chapters):
+    """Подробный отчёт: глава на каждый раздел."""
+    for title, content in chapters:
+        pdf.add_page()
+        pdf.set_font(FONT_FAMILY, size=16)
+        pdf.multi_cell(0, 12, _clean(title))
+        pdf.ln(4)
+        pdf.set_font(FONT_FAMILY, size=12)
+        for line in _clean(content).split("\n"):
+            pdf.multi_cell(0, 10, line)
+            pdf.ln(2)
+
+
+def _lines_template(pdf, lines):
+    """Простой документ из строк (пример платного отчёта)."""
+    pdf.add_page()
+    pdf.set_font(FONT_FAMILY, size=12)
+    for line in lines:
+        pdf.multi_cell(0, 10, _clean(line))
+
+
+TEMPLATES = {
+    "summary": _summary_template,
+    "report": _report_template,
+    "lines": _lines_template,
+}
+
+
+def render_bytes(template, data):
+    """Отрисовка документа по шаблону в байты PDF."""
+    pdf = new_document()
+    TEMPLATES[template](pdf, data)
+    return pdf.output(dest="S").encode("latin1")
+
+
+def render_file(template, data, path):
+    """Отрисовка документа по шаблону с записью в файл."""
+    content = render_bytes(template, data)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+
+class ReportRenderer:
+    """Отрисовка PDF в пуле процессов, чтобы не блокировать обработку сообщений."""
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=load_font)
+        return self._pool
+
+    async def _run(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._get_pool(), func, *args)
+
+    async def render(self, template, data):
+        """PDF в виде байтов."""
+        return await self._run(render_bytes, template, data)
+
+    async def render_buffer(self, template, data):
+        """PDF в BytesIO для прямой загрузки в Telegram."""
+        return io.BytesIO(await self.render(template, data))
+
+    async def render_to_file(self, template, data, path):
+        """PDF, записанный в файл рабочим процессом."""
+        return await self._run(render_file, template, data, path)
+
+    async def warm_up(self):
+        """Запуск рабочих процессов и разбор шрифта заранее."""
+        await asyncio.gather(*[self._run(_warm_up_worker) for _ in range(self.workers)])
+        logging.info(f"PDF renderer ready ({self.workers} workers)")
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
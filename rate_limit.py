@@ -0,0 +1,323 @@
+"""Ограничения «раз в N часов» и блокировки «запрос уже выполняется», общие для всех процессов бота.
+
+Бэкенды: память процесса, SQLite-файл (процессы на одной машине) и Redis-совместимый сервер.
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from urllib.parse import urlparse
+
+
+class MemoryBackend:
+    """Ключи с истечением в памяти процесса."""
+
+    # Видны ли ключи другим процессам
+    shared = False
+
+    def __init__(self):
+        self._data = {}
+
+    def _alive(self, key):
+        entry = self._data.get(key)
+        if entry and entry[1] <= time.time():
+            del self._data[key]
+            return None
+        return entry
+
+    async def set_if_absent(self, key, value, ttl):
+        if self._alive(key):
+            return False
+        self._data[key] = (value, time.time() + ttl)
+        return True
+
+    async def set(self, key, value, ttl):
+        self._data[key] = (value, time.time() + ttl)
+
+    async def get(self, key):
+        entry = self._alive(key)
+        return entry[0] if entry else None
+
+    async def incr(self, key, amount, ttl):
+        entry = self._alive(key)
+        value = (int(entry[0]) if entry else 0) + amount
+        self._data[key] = (str(value), entry[1] if entry else time.time() + ttl)
+        return value
+
+    async def ttl(self, key):
+        entry = self._alive(key)
+        return entry[1] - time.time() if entry else None
+
+    async def delete(self, key):
+        self._data.pop(key, None)
+
+    async def delete_if_equal(self, key, value):
+        entry = self._alive(key)
+        if entry and entry[0] == value:
+            del self._data[key]
+            return True
+        return False
+
+    async def close(self):
+        pass
+
+
+class SQLiteBackend:
+    """Ключи с истечением в SQLite-файле; атомарность обеспечивают транзакции BEGIN IMMEDIATE."""
+
+    shared = True
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def _transaction(self, func):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(self._conn, time.time())
+                self._conn.execute("COMMIT")
+                return result
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    async def _run(self, func):
+        # BEGIN IMMEDIATE может ждать другой процесс до busy_timeout — не в потоке event loop
+        return await asyncio.get_event_loop().run_in_executor(None, self._transaction, func)
+
+    async def set_if_absent(self, key, value, ttl):
+        def op(conn, now):
+            conn.execute("DELETE FROM rate_limits WHERE key = ? AND expires_at <= ?", (key, now))
+            cursor = conn.execute("INSERT OR IGNORE INTO rate_limits VALUES (?, ?, ?)", (key, value, now + ttl))
+            return cursor.rowcount == 1
+        return await self._run(op)
+
+    async def set(self, key, value, ttl):
+        await self._run(
+            lambda conn, now: conn.execute("INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?)", (key, value, now + ttl))
+        )
+
+    async def get(self, key):
+        def op(conn, now):
+            row = conn.execute("SELECT value FROM rate_limits WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+            return row[0] if row else None
+        return await self._run(op)
+
+    async def incr(self, key, amount, ttl):
+        def op(conn, now):
+            conn.execute("DELETE FROM rate_limits WHERE key = ? AND expires_at <= ?", (key, now))
+            conn.execute("INSERT OR IGNORE INTO rate_limits VALUES (?, '0', ?)", (key, now + ttl))
+            conn.execute("UPDATE rate_limits SET value = CAST(value AS INTEGER) + ? WHERE key = ?", (amount, key))
+            return int(conn.execute("SELECT value FROM rate_limits WHERE key = ?", (key,)).fetchone()[0])
+        return await self._run(op)
+
+    async def ttl(self, key):
+        def op(conn, now):
+            row = conn.execute("SELECT expires_at FROM rate_limits WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+            return row[0] - now if row else None
+        return await self._run(op)
+
+    async def delete(self, key):
+        await self._run(lambda conn, now: conn.execute("DELETE FROM rate_limits WHERE key = ?", (key,)))
+
+    async def delete_if_equal(self, key, value):
+        def op(conn, now):
+            cursor = conn.execute(
+                "DELETE FROM rate_limits WHERE key = ? AND value = ? AND expires_at > ?", (key, value, now)
+            )
+            return cursor.rowcount == 1
+        return await self._run(op)
+
+    async def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RedisError(Exception):
+    """Ошибка, возвращённая Redis-сервером."""
+
+
+class RedisBackend:
+    """Минимальный клиент протокола Redis (RESP) поверх asyncio: SET NX PX, PTTL, DEL и EVAL."""
+
+    shared = True
+
+    _DELETE_IF_EQUAL = "if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) else return 0 end"
+    # Срок жизни задаётся только новому счётчику
+    _INCR = ("local value = redis.call('INCRBY', KEYS[1], ARGV[1]) "
+             "if value == tonumber(ARGV[1]) then redis.call('PEXPIRE', KEYS[1], ARGV[2]) end return value")
+
+    def __init__(self, url="redis://localhost:6379/0", prefix="astrobot:", timeout=5.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.prefix = prefix
+        self.timeout = timeout
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            await self._roundtrip("AUTH", self.password)
+        if self.db:
+            await self._roundtrip("SELECT", self.db)
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            raise RedisError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = await self._reader.readexactly(length + 2)
+            return data[:-2].decode()
+        if kind == b"*":
+            count = int(payload)
+            return None if count < 0 else [await self._read_reply() for _ in range(count)]
+        raise RedisError(f"Unexpected reply: {line!r}")
+
+    async def _roundtrip(self, *args):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = str(arg).encode()
+            parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+        self._writer.write(b"".join(parts))
+        await self._writer.drain()
+        return await self._read_reply()
+
+    def _disconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def command(self, *args, idempotent=True):
+        """Команда и ответ на неё (не дольше `timeout` секунд).
+
+        Если ответ не дочитан (ошибка, таймаут, отмена задачи), соединение закрывается: иначе этот ответ
+        получила бы следующая команда. После сбоя соединения команда повторяется один раз, но
+        неидемпотентная (`idempotent=False`, например SET NX) — только если она ещё не была отправлена.
+        """
+        async with self._lock:
+            for attempt in range(2):
+                sent = False
+                try:
+                    if self._writer is None:
+                        await asyncio.wait_for(self._connect(), self.timeout)
+                    sent = True
+                    return await asyncio.wait_for(self._roundtrip(*args), self.timeout)
+                except BaseException as e:
+                    self._disconnect()
+                    retry = (isinstance(e, (ConnectionError, OSError)) and not isinstance(e, asyncio.TimeoutError)
+                             and not attempt and (idempotent or not sent))
+                    if not retry:
+                        raise
+                    logging.warning(f"Redis connection error (attempt {attempt + 1}): {e}")
+
+    async def set_if_absent(self, key, value, ttl):
+        return await self.command("SET", self.prefix + key, value, "NX", "PX", int(ttl * 1000), idempotent=False) == "OK"
+
+    async def set(self, key, value, ttl):
+        await self.command("SET", self.prefix + key, value, "PX", int(ttl * 1000))
+
+    async def get(self, key):
+        return await self.command("GET", self.prefix + key)
+
+    async def incr(self, key, amount, ttl):
+        return await self.command("EVAL", self._INCR, 1, self.prefix + key, amount, int(ttl * 1000), idempotent=False)
+
+    async def ttl(self, key):
+        ms = await self.command("PTTL", self.prefix + key)
+        return ms / 1000 if ms is not None and ms >= 0 else None
+
+    async def delete(self, key):
+        await self.command("DEL", self.prefix + key)
+
+    async def delete_if_equal(self, key, value):
+        return await self.command("EVAL", self._DELETE_IF_EQUAL, 1, self.prefix + key, value, idempotent=False) == 1
+
+    async def close(self):
+        self._disconnect()
+
+
+class RateLimiter:
+    """Атомарные ограничения по времени и арендуемые блокировки на пользователя."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def reserve(self, action, user_id, period):
+        """Резервирует действие на `period` секунд; возвращает 0 или сколько секунд осталось ждать.
+
+        Резерв берётся коротким (на время выполнения) и продлевается confirm после успеха: если процесс
+        упадёт между reserve и refund, пользователь не останется заблокированным на все сутки.
+        """
+        key = f"cooldown:{action}:{user_id}"
+        if await self.backend.set_if_absent(key, str(time.time()), period):
+            return 0
+        remaining = await self.backend.ttl(key)
+        if remaining is None:
+            # Ключ истёк между двумя запросами — пробуем ещё раз
+            return 0 if await self.backend.set_if_absent(key, str(time.time()), period) else period
+        return remaining
+
+    async def confirm(self, action, user_id, period):
+        """Действие выполнено: ограничение действует `period` секунд с этого момента."""
+        await self.backend.set(f"cooldown:{action}:{user_id}", str(time.time()), period)
+
+    async def refund(self, action, user_id):
+        """Отмена резерва (например, если расчёт не удался)."""
+        await self.backend.delete(f"cooldown:{action}:{user_id}")
+
+    async def acquire_lock(self, action, user_id, ttl=300, token=None):
+        """Блокировка «уже выполняется»; возвращает токен или None. Истекает через `ttl`, если процесс упал.
+
+        `token` — постоянный токен задачи: задача, восстановленная после падения процесса, снова получает
+        блокировку, которую держала до падения, не дожидаясь её истечения.
+        """
+        key = f"lock:{action}:{user_id}"
+        token = token or uuid.uuid4().hex
+        if await self.backend.set_if_absent(key, token, ttl):
+            return token
+        if await self.backend.get(key) == token:
+            await self.backend.set(key, token, ttl)
+            return token
+        return None
+
+    async def release_lock(self, action, user_id, token):
+        return await self.backend.delete_if_equal(f"lock:{action}:{user_id}", token)
+
+    async def close(self):
+        await self.backend.close()
+
+
+def create_rate_limiter(kind="sqlite", sqlite_path="./ratelimit.db", redis_url=None):
+    """Выбор бэкенда: memory, sqlite или redis."""
+    if kind == "memory":
+        return RateLimiter(MemoryBackend())
+    if kind == "redis":
+        return RateLimiter(RedisBackend(redis_url or "redis://localhost:6379/0"))
+    return RateLimiter(SQLiteBackend(sqlite_path))
@@ -0,0 +1,172 @@
+"""Контрольные точки подробных отчётов: готовые разделы и итоговый PDF сохраняются в SQLite.
+
+Задача отчёта определяется пользователем и данными его карты, поэтому повторный заказ после сбоя
+или перезапуска догенерирует только недостающие разделы. Старые задачи удаляются по возрасту.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+def report_job_id(user_id, user_data, sections):
+    """Id задачи отчёта: пользователь, данные карты и тексты заданий разделов."""
+    key = json.dumps({
+        "user_id": str(user_id),
+        "date": user_data["date_str"],
+        "time": user_data["time_str"],
+        "city": user_data["city"],
+        "lat": user_data["lat"],
+        "lon": user_data["lon"],
+        "planets": user_data["planets"],
+        "sections": sections,
+    }, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class ReportCheckpoints:
+    """Разделы (title → текст) и отрисованный PDF по id задачи."""
+
+    def __init__(self, path, ttl=7 * 24 * 3600, gc_interval=3600):
+        self.ttl = ttl
+        self.gc_interval = gc_interval
+        self._lock = threading.Lock()
+        self._gc_task = None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS report_jobs ("
+            "job_id TEXT PRIMARY KEY, user_id TEXT NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL, "
+            "completed INTEGER NOT NULL DEFAULT 0, pdf BLOB)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS report_sections ("
+            "job_id TEXT NOT NULL, title TEXT NOT NULL, content TEXT NOT NULL, created_at REAL NOT NULL, "
+            "PRIMARY KEY (job_id, title)) WITHOUT ROWID"
+        )
+
+    def _db(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    async def _run(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    def begin(self, job_id, user_id):
+        """Регистрация задачи; возвращает готовые разделы незавершённой задачи.
+
+        Завершённая задача с тем же id (новый заказ по тем же данным после суточного ограничения)
+        начинается заново: её разделы и PDF удаляются, чтобы отчёт был сгенерирован повторно.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                completed = self._conn.execute(
+                    "SELECT 1 FROM report_jobs WHERE job_id = ? AND completed = 1", (job_id,)
+                ).fetchone()
+                if completed:
+                    self._conn.execute("DELETE FROM report_sections WHERE job_id = ?", (job_id,))
+                    self._conn.execute(
+                        "UPDATE report_jobs SET completed = 0, pdf = NULL, created_at = ?, updated_at = ? WHERE job_id = ?",
+                        (now, now, job_id)
+                    )
+                else:
+                    self._conn.execute(
+                        "INSERT INTO report_jobs (job_id, user_id, created_at, updated_at) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT(job_id) DO UPDATE SET updated_at = excluded.updated_at",
+                        (job_id, str(user_id), now, now)
+                    )
+                saved = self._conn.execute("SELECT title, content FROM report_sections WHERE job_id = ?", (job_id,)).fetchall()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return dict(saved)
+
+    def pending(self, job_id):
+        """Есть незавершённая задача (отчёт начат, но не доставлен)."""
+        return bool(self._db("SELECT 1 FROM report_jobs WHERE job_id = ? AND completed = 0", (job_id,)))
+
+    def save_section(self, job_id, title, content):
+        now = time.time()
+        self._db("INSERT OR REPLACE INTO report_sections VALUES (?, ?, ?, ?)", (job_id, title, content, now))
+        self._db("UPDATE report_jobs SET updated_at = ? WHERE job_id = ?", (now, job_id))
+
+    def save_pdf(self, job_id, pdf_bytes):
+        self._db("UPDATE report_jobs SET pdf = ?, updated_at = ? WHERE job_id = ?", (pdf_bytes, time.time(), job_id))
+
+    def pdf(self, job_id):
+        rows = self._db("SELECT pdf FROM report_jobs WHERE job_id = ?", (job_id,))
+        return rows[0][0] if rows and rows[0][0] is not None else None
+
+    def complete(self, job_id):
+        self._db("UPDATE report_jobs SET completed = 1, updated_at = ? WHERE job_id = ?", (time.time(), job_id))
+
+    def gc(self, max_age=None):
+        """Удаление задач, не менявшихся дольше `max_age` секунд; возвращает число удалённых."""
+        cutoff = time.time() - (self.ttl if max_age is None else max_age)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "DELETE FROM report_sections WHERE job_id IN (SELECT job_id FROM report_jobs WHERE updated_at < ?)",
+                    (cutoff,)
+                )
+                removed = self._conn.execute("DELETE FROM report_jobs WHERE updated_at < ?", (cutoff,)).rowcount
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if removed:
+            logging.info(f"Report checkpoints: removed {removed} old jobs")
+        return removed
+
+    async def begin_async(self, job_id, user_id):
+        return await self._run(self.begin, job_id, user_id)
+
+    async def pending_async(self, job_id):
+        return await self._run(self.pending, job_id)
+
+    async def save_section_async(self, job_id, title, content):
+        await self._run(self.save_section, job_id, title, content)
+
+    async def save_pdf_async(self, job_id, pdf_bytes):
+        await self._run(self.save_pdf, job_id, pdf_bytes)
+
+    async def pdf_async(self, job_id):
+        return await self._run(self.pdf, job_id)
+
+    async def complete_async(self, job_id):
+        await self._run(self.complete, job_id)
+
+    async def _gc_loop(self):
+        while True:
+            try:
+                await self._run(self.gc)
+            except Exception as e:
+                logging.error(f"Report checkpoints GC error: {e}", exc_info=True)
+            await asyncio.sleep(self.gc_interval)
+
+    def start(self):
+        """Периодическая очистка старых задач."""
+        if self._gc_task is None:
+            self._gc_task = asyncio.ensure_future(self._gc_loop())
+
+    def stats(self):
+        jobs, pending = self._db("SELECT COUNT(*), COALESCE(SUM(completed = 0), 0) FROM report_jobs")[0]
+        return {"jobs": jobs, "pending": pending}
+
+    def close(self):
+        if self._gc_task is not None:
+            self._gc_task.cancel()
+            self._gc_task = None
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,293 @@
+"""Очередь исходящих сообщений Telegram с ограничением скорости по чатам и по боту в целом.
+
+Telegram ограничивает бота примерно 30 сообщениями в секунду, одним сообщением в секунду в личный
+чат и 20 в минуту в группу. Сообщения одного чата уходят строго по порядку; из разных чатов первыми
+отправляются интерактивные ответы, затем массовые (разделы расчёта, документы).
+"""
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+
+from aiogram.utils.exceptions import NetworkError, RetryAfter
+
+import metrics
+
+INTERACTIVE = 0
+BULK = 1
+MAX_MESSAGE_LENGTH = 4096
+# Склеиваются только сообщения не длиннее этого (длинные разделы уходят отдельно)
+SHORT_MESSAGE_LENGTH = 1500
+
+
+class TokenBucket:
+    """Ведро токенов: `rate` в секунду, запас до `capacity`; после RetryAfter блокируется на время ожидания."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Сколько секунд ждать до появления токена."""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds, now):
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = 0
+        self.updated = self.blocked_until
+
+    def idle(self, now):
+        return now >= self.blocked_until and self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class _Outgoing:
+    __slots__ = ("method", "chat_id", "kwargs", "priority", "seq", "futures", "mergeable", "attempts")
+
+    def __init__(self, method, chat_id, kwargs, priority, seq, future, mergeable):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.futures = [future]
+        self.mergeable = mergeable
+        self.attempts = 0
+
+    def merge(self, text, kwargs, future, limit=SHORT_MESSAGE_LENGTH):
+        """Присоединение следующего короткого (не длиннее `limit`) сообщения с теми же параметрами."""
+        if not self.mergeable or self.method != "send_message" or len(text) > limit:
+            return False
+        other = {key: value for key, value in self.kwargs.items() if key != "text"}
+        if other != {key: value for key, value in kwargs.items() if key != "text"}:
+            return False
+        combined = f"{self.kwargs['text']}\n\n{text}"
+        if len(combined) > MAX_MESSAGE_LENGTH:
+            return False
+        self.kwargs["text"] = combined
+        self.futures.append(future)
+        return True
+
+    @property
+    def abandoned(self):
+        return all(future.done() for future in self.futures)
+
+
+class SendScheduler:
+    """Единая точка отправки сообщений бота (send_message / send_document) с ожиданием результата."""
+
+    def __init__(self, bot, global_rate=30.0, chat_rate=1.0, group_rate=20 / 60, burst=3, max_retries=3, max_buckets=10000,
+                 merge_limit=SHORT_MESSAGE_LENGTH):
+        self.bot = bot
+        self.merge_limit = merge_limit
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.max_buckets = max_buckets
+        self._global = TokenBucket(global_rate, max(1.0, global_rate))
+        self._buckets = {}
+        self._chats = {}
+        self._in_flight = set()
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self.sent = 0
+        self.merged = 0
+        self.retries = 0
+        self.flood_waits = 0
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательные id и @имена — группы и каналы с более строгим лимитом
+            rate = self.group_rate if str(chat_id).startswith(("-", "@")) else self.chat_rate
+            bucket = self._buckets[chat_id] = TokenBucket(rate, self.burst)
+        return bucket
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    def _enqueue(self, method, chat_id, kwargs, priority, merge):
+        self._ensure_running()
+        future = asyncio.get_event_loop().create_future()
+        queue = self._chats.setdefault(chat_id, deque())
+        text = kwargs.get("text", "")
+        if merge and queue and queue[-1].merge(text, kwargs, future, self.merge_limit):
+            self.merged += 1
+        else:
+            mergeable = merge and len(text) <= self.merge_limit
+            queue.append(_Outgoing(method, chat_id, kwargs, priority, next(self._seq), future, mergeable))
+        self._wakeup.set()
+        return future
+
+    async def send_message(self, chat_id, text, priority=INTERACTIVE, merge=False, **kwargs):
+        """Отправка текста; `merge=True` разрешает склеить его с соседними короткими сообщениями в этот чат."""
+        return await self.queue_message(chat_id, text, priority, merge, **kwargs)
+
+    def queue_message(self, chat_id, text, priority=INTERACTIVE, merge=False, **kwargs):
+        """Постановка текста в очередь без ожидания отправки; возвращает future с результатом.
+
+        Склеиваются только сообщения, которые ещё ждут в очереди чата, поэтому серию коротких сообщений
+        нужно ставить в очередь сразу, а ждать её целиком (asyncio.gather).
+        """
+        return self._enqueue("send_message", chat_id, dict(kwargs, text=text), priority, merge)
+
+    async def send_document(self, chat_id, document, priority=BULK, **kwargs):
+        return await self._enqueue("send_document", chat_id, dict(kwargs, document=document), priority, False)
+
+    async def answer(self, message, text, **kwargs):
+        """Аналог message.answer через очередь."""
+        return await self.send_message(message.chat.id, text, **kwargs)
+
+    async def answer_document(self, message, document, **kwargs):
+        """Аналог message.answer_document через очередь."""
+        return await self.send_document(message.chat.id, document, **kwargs)
+
+    def _next_ready(self, now):
+        """Следующее сообщение к отправке и (если его нет) время ожидания."""
+        best, wait = None, None
+        for chat_id, queue in list(self._chats.items()):
+            while queue and queue[0].abandoned:
+                queue.popleft()
+            if not queue:
+                del self._chats[chat_id]
+                continue
+            if chat_id in self._in_flight:
+                continue
+            delay = self._bucket(chat_id).wait_time(now)
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            item = queue[0]
+            if best is None or (item.priority, item.seq) < (best.priority, best.seq):
+                best = item
+        if best is not None:
+            delay = self._global.wait_time(now)
+            if delay > 0:
+                return None, delay
+        return best, wait
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            item, wait = self._next_ready(now)
+            if item is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            queue = self._chats[item.chat_id]
+            queue.popleft()
+            if not queue:
+                del self._chats[item.chat_id]
+            self._global.take(now)
+            self._bucket(item.chat_id).take(now)
+            self._in_flight.add(item.chat_id)
+            asyncio.ensure_future(self._deliver(item))
+            if len(self._buckets) > self.max_buckets:
+                self._prune(now)
+
+    def _prune(self, now):
+        for chat_id in [chat_id for chat_id, bucket in self._buckets.items()
+                        if chat_id not in self._chats and chat_id not in self._in_flight and bucket.idle(now)]:
+            del self._buckets[chat_id]
+
+    def _requeue(self, item):
+        # Повтор уходит первым в своём чате, чтобы не нарушить порядок
+        self._chats.setdefault(item.chat_id, deque()).appendleft(item)
+
+    async def _deliver(self, item):
+        started = time.perf_counter()
+        try:
+            document = item.kwargs.get("document")
+            stream = getattr(document, "file", document)
+            if hasattr(stream, "seek"):
+                stream.seek(0)
+            try:
+                result = await getattr(self.bot, item.method)(item.chat_id, **item.kwargs)
+            finally:
+                metrics.TELEGRAM_SECONDS.observe(time.perf_counter() - started, method=item.method)
+        except RetryAfter as e:
+            metrics.TELEGRAM_ERRORS.inc(method=item.method, error="RetryAfter")
+            self.flood_waits += 1
+            logging.warning(f"Flood control for chat {item.chat_id}: retry in {e.timeout}s")
+            self._bucket(item.chat_id).block(e.timeout, time.monotonic())
+            self._requeue(item)
+        except (NetworkError, asyncio.TimeoutError) as e:
+            metrics.TELEGRAM_ERRORS.inc(method=item.method, error=type(e).__name__)
+            item.attempts += 1
+            if item.attempts > self.max_retries:
+                self._resolve(item, error=e)
+            else:
+                self.retries += 1
+                logging.warning(f"Send error for chat {item.chat_id} (attempt {item.attempts}): {e}")
+                self._bucket(item.chat_id).block(min(2 ** item.attempts, 30), time.monotonic())
+                self._requeue(item)
+        except Exception as e:
+            metrics.TELEGRAM_ERRORS.inc(method=item.method, error=type(e).__name__)
+            self._resolve(item, error=e)
+        else:
+            self.sent += 1
+            self._resolve(item, result=result)
+        finally:
+            self._in_flight.discard(item.chat_id)
+            self._wakeup.set()
+
+    @staticmethod
+    def _resolve(item, result=None, error=None):
+        for future in item.futures:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    @property
+    def pending(self):
+        return sum(len(queue) for queue in self._chats.values()) + len(self._in_flight)
+
+    def stats(self):
+        return {
+            "pending": self.pending,
+            "sent": self.sent,
+            "merged": self.merged,
+            "retries": self.retries,
+            "flood_waits": self.flood_waits,
+            "chats": len(self._buckets),
+        }
+
+    async def stop(self, timeout=10):
+        """Досылка очереди (не дольше `timeout` секунд) и остановка."""
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for queue in self._chats.values():
+            for item in queue:
+                for future in item.futures:
+                    if not future.done():
+                        future.cancel()
+        self._chats.clear()
@@ -0,0 +1,88 @@
+"""Замер времени запуска и фоновый прогрев сервисов.
+
+Модуль импортируется первым в main.py и отсчитывает время от этого момента: импорт модулей,
+создание объектов, подготовка сервисов и прогрев (эфемериды, часовые пояса, шрифт, хранилища).
+Бот начинает принимать обновления до окончания прогрева; флаг готовности показывает, что прогрев завершён.
+"""
+import asyncio
+import logging
+import time
+
+STARTED = time.perf_counter()
+
+
+class Startup:
+    """Этапы запуска (название → секунды) и флаг готовности."""
+
+    def __init__(self, started=STARTED):
+        self._last = started
+        self.started = started
+        self.phases = {}
+        self.warm_up = {}
+        self.ready_after = None
+        self._ready = asyncio.Event()
+        self._task = None
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    async def wait_ready(self):
+        await self._ready.wait()
+
+    def mark(self, phase):
+        """Конец этапа `phase`: длительность отсчитывается от конца предыдущего этапа."""
+        now = time.perf_counter()
+        self.phases[phase] = now - self._last
+        self._last = now
+        self._export(phase, self.phases[phase])
+
+    async def _step(self, name, func):
+        started = time.perf_counter()
+        try:
+            await func()
+        except Exception as e:
+            logging.error(f"Warm-up {name} failed: {e}", exc_info=True)
+        finally:
+            self.warm_up[name] = time.perf_counter() - started
+            self._export(f"warm_up:{name}", self.warm_up[name])
+
+    async def _run(self, steps):
+        await asyncio.gather(*[self._step(name, func) for name, func in steps])
+        self.ready_after = time.perf_counter() - self.started
+        self._ready.set()
+        self._export("ready", self.ready_after)
+        import metrics
+        metrics.READY.set(1)
+        logging.info(f"Bot ready: {self.report()}")
+
+    def start_warm_up(self, steps):
+        """Фоновый прогрев: `steps` — пары (название, асинхронная функция), выполняются параллельно."""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run(steps))
+        return self._task
+
+    async def warm_up_now(self, steps):
+        """Прогрев с ожиданием (обновления начнут обрабатываться после него)."""
+        await self.start_warm_up(steps)
+
+    @staticmethod
+    def _export(phase, seconds):
+        # metrics (с aiohttp) импортируется здесь, чтобы отсчёт STARTED начинался до тяжёлых импортов
+        import metrics
+        metrics.STARTUP_SECONDS.set(round(seconds, 4), phase=phase)
+
+    def report(self):
+        """Строка с разбивкой времени запуска в миллисекундах."""
+        parts = [f"{phase} {seconds * 1000:.0f}ms" for phase, seconds in self.phases.items()]
+        if self.warm_up:
+            parts.append("warm-up (" + ", ".join(
+                f"{name} {seconds * 1000:.0f}ms" for name, seconds in self.warm_up.items()
+            ) + ")")
+        if self.ready_after is not None:
+            parts.append(f"ready after {self.ready_after * 1000:.0f}ms")
+        return "; ".join(parts)
+
+    def cancel(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
@@ -0,0 +1,89 @@
+"""Проверка подписки на канал с кэшем и объединением одновременных запросов."""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+SUBSCRIBED_STATUSES = ("member", "creator", "administrator")
+
+
+def is_channel(chat, channel):
+    """Относится ли чат из обновления к каналу, заданному как @username или числовой id."""
+    if str(channel).startswith("@"):
+        return (chat.username or "").lower() == channel[1:].lower()
+    return str(chat.id) == str(channel)
+
+
+class SubscriptionCache:
+    """Статус подписки пользователей: подтверждённая подписка живёт дольше, отсутствие — меньше.
+
+    `fetch(user_id)` — корутина, возвращающая статус участника канала; ошибки не кэшируются.
+    """
+
+    def __init__(self, fetch, positive_ttl=300, negative_ttl=30, max_size=10000):
+        self.fetch = fetch
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _cached(self, user_id, recheck_negative):
+        entry = self._data.get(user_id)
+        if entry is None:
+            return None
+        subscribed, expires_at = entry
+        if time.monotonic() >= expires_at or (recheck_negative and not subscribed):
+            del self._data[user_id]
+            return None
+        self._data.move_to_end(user_id)
+        return subscribed
+
+    def set(self, user_id, subscribed):
+        ttl = self.positive_ttl if subscribed else self.negative_ttl
+        self._data[str(user_id)] = (subscribed, time.monotonic() + ttl)
+        self._data.move_to_end(str(user_id))
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def invalidate(self, user_id):
+        if self._data.pop(str(user_id), None) is not None:
+            self.invalidations += 1
+
+    def update_from_status(self, user_id, status):
+        """Обновление из chat_member: статус известен без запроса к API."""
+        self.invalidate(user_id)
+        self.set(user_id, status in SUBSCRIBED_STATUSES)
+
+    async def is_subscribed(self, user_id, recheck_negative=False):
+        """Подписан ли пользователь; `recheck_negative` — не доверять кэшированному «не подписан»
+        (пользователь только что нажал «Я подписался»)."""
+        user_id = str(user_id)
+        subscribed = self._cached(user_id, recheck_negative)
+        if subscribed is not None:
+            self.hits += 1
+            return subscribed
+        self.misses += 1
+        # Одновременные проверки одного пользователя ждут один запрос
+        pending = self._pending.get(user_id)
+        if pending is None:
+            pending = self._pending[user_id] = asyncio.ensure_future(self._fetch(user_id))
+        return await asyncio.shield(pending)
+
+    async def _fetch(self, user_id):
+        try:
+            status = await self.fetch(user_id)
+        except Exception as e:
+            logging.error(f"Subscription check error for {user_id}: {e}", exc_info=True)
+            return False
+        finally:
+            self._pending.pop(user_id, None)
+        subscribed = status in SUBSCRIBED_STATUSES
+        self.set(user_id, subscribed)
+        return subscribed
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "invalidations": self.invalidations, "size": len(self._data)}
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+class TimezoneService:
+    """Определение часового пояса по координатам с долгоживущим TimezoneFinder и кэшем."""
+
+    def __init__(self, grid=0.01, max_size=10000, in_memory=False):
+        self.grid = grid
+        self.max_size = max_size
+        self.in_memory = in_memory
+        self._finder = None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get_finder(self):
+        with self._lock:
+            if self._finder is None:
+                # Импорт (вместе с numpy) откладывается до первого поиска или прогрева
+                from timezonefinder import TimezoneFinder
+                started = time.perf_counter()
+                self._finder = TimezoneFinder(in_memory=self.in_memory)
+                logging.info(f"TimezoneFinder loaded in {time.perf_counter() - started:.2f}s (in_memory={self.in_memory})")
+            return self._finder
+
+    def _key(self, lat, lon):
+        return round(lat / self.grid), round(lon / self.grid)
+
+    def _cached(self, key):
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return True, self._cache[key]
+            return False, None
+
+    def lookup(self, lat, lon):
+        """Синхронный поиск часового пояса (с кэшем)."""
+        key = self._key(lat, lon)
+        found, timezone_str = self._cached(key)
+        if found:
+            return timezone_str
+        timezone_str = self._get_finder().timezone_at(lat=lat, lng=lon)
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = timezone_str
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return timezone_str
+
+    async def timezone_at(self, lat, lon):
+        """Часовой пояс по координатам; поиск по полигонам выполняется вне event loop."""
+        found, timezone_str = self._cached(self._key(lat, lon))
+        if found:
+            return timezone_str
+        return await asyncio.get_event_loop().run_in_executor(None, self.lookup, lat, lon)
+
+    async def warm_up(self):
+        """Предзагрузка данных полигонов при старте."""
+        await asyncio.get_event_loop().run_in_executor(None, self._get_finder)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._cache)}
@@ -0,0 +1,495 @@
+"""Ежедневная рассылка «Транзиты дня» пользователям с рассчитанной картой.
+
+Небо дня считается один раз. Аспекты транзитных планет к натальным (долготы из поля planets)
+ищутся для всех пользователей сразу: одна матричная операция numpy по пачкам пользователей.
+Пользователи с одинаковым набором аспектов попадают в одну группу, и сообщение собирается один раз
+на группу. Совет от GPT готовится по главному (самому точному) аспекту группы, поэтому запросов в день
+не больше, чем возможных аспектов (10 × 5 × 5), сколько бы ни было пользователей. Рассылка идёт через общую очередь исходящих сообщений с отдельным ограничением
+скорости. План, тексты и статусы доставки хранятся в SQLite, и после перезапуска рассылка
+продолжается с неотправленных сообщений.
+
+    python transits.py preview --users-db users.db
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import flatlib
+import numpy as np
+import swisseph
+from aiogram.utils.exceptions import ChatNotFound, Unauthorized
+from flatlib import const
+from flatlib.ephem import eph, swe
+
+import metrics
+import natal
+from chart_analytics import ASPECTS
+from llm import LLMError
+from send_scheduler import BULK, TokenBucket
+
+TRANSITS_DB = "./transits.db"
+TRANSIT_MODEL = "gpt-4o-mini"
+
+TRANSIT_BODIES = (
+    const.SUN, const.MOON, const.MERCURY, const.VENUS, const.MARS,
+    const.JUPITER, const.SATURN, const.URANUS, const.NEPTUNE, const.PLUTO,
+)
+NATAL_BODIES = tuple(natal.PLANET_NAMES)
+
+# Орбис транзита (градусы): Луна за день проходит около 13°, поэтому её орбис шире
+DEFAULT_ORB = 2.0
+TRANSIT_ORBS = {const.MOON: 6.0}
+
+# В сообщении — не больше MAX_ASPECTS самых точных аспектов
+MAX_ASPECTS = 3
+CHUNK_USERS = 20000
+_ANGLES = np.array([angle for _, angle in ASPECTS])
+
+# Общий прогноз дня (для пользователей без аспектов и при сбое GPT) хранится под этим ключом
+DAY_KEY = "*"
+FALLBACK_ADVICE = "Хорошего дня! ✨"
+
+
+def sky_longitudes(day):
+    """Долготы транзитных тел на полдень UTC дня `day`."""
+    # Путь к файлам эфемерид в Swiss Ephemeris задаётся отдельно для каждого потока
+    swe.setPath(flatlib.PATH_RES + "swefiles")
+    jd = swisseph.julday(day.year, day.month, day.day, 12.0)
+    return np.array([eph.getObject(body, jd, 0.0, 0.0)["lon"] for body in TRANSIT_BODIES])
+
+
+def natal_longitudes(users):
+    """Пользователи с сохранёнными планетами (и не отключившие рассылку): (id, матрица пользователи × NATAL_BODIES).
+
+    Отсутствующая планета — NaN (аспектов с ней не будет).
+    """
+    ids, rows = [], []
+    for user_id, data in users:
+        planets = data.get("planets")
+        if not planets or data.get("transits") is False:
+            continue
+        ids.append(user_id)
+        rows.append([planets.get(body, {}).get("degree", np.nan) for body in NATAL_BODIES])
+    return ids, np.array(rows, dtype=np.float32).reshape(len(rows), len(NATAL_BODIES))
+
+
+def transit_orbs(orbs=None):
+    orbs = TRANSIT_ORBS if orbs is None else orbs
+    return np.array([orbs.get(body, DEFAULT_ORB) for body in TRANSIT_BODIES])
+
+
+def transit_aspects(natal_lons, sky_lons, orbs=None, max_aspects=MAX_ASPECTS, chunk=CHUNK_USERS):
+    """Коды до `max_aspects` самых точных аспектов каждого пользователя (самые точные — первыми, -1 — пусто).
+
+    Код аспекта = (транзитное тело × len(NATAL_BODIES) + натальное тело) × len(ASPECTS) + аспект.
+    Расчёт идёт пачками по `chunk` пользователей, чтобы матрица отклонений занимала десятки мегабайт.
+    """
+    natal_lons = np.asarray(natal_lons, dtype=np.float32)
+    sky_lons = np.asarray(sky_lons, dtype=np.float32)
+    orbs = transit_orbs(orbs).astype(np.float32)
+    bodies = len(sky_lons) * natal_lons.shape[1]
+    k = min(max_aspects, bodies)
+    # Базовые коды пар (транзитное тело, натальное тело)
+    pair_codes = (np.arange(bodies) * len(ASPECTS)).astype(np.int16)
+    result = np.full((len(natal_lons), max_aspects), -1, dtype=np.int16)
+    for start in range(0, len(natal_lons), chunk):
+        block = natal_lons[start:start + chunk]
+        # пользователи × транзитные тела × натальные тела
+        diff = np.abs(block[:, None, :] - sky_lons[None, :, None])
+        distance = np.minimum(diff, 360 - diff)
+        # ... × аспекты
+        deviation = np.abs(distance[..., None] - _ANGLES.astype(np.float32))
+        matches = deviation <= orbs[None, :, None, None]
+        # При попадании в два орбиса выбирается аспект, указанный в ASPECTS раньше (как в chart_analytics)
+        aspect = matches.argmax(axis=3)
+        exactness = np.take_along_axis(deviation, aspect[..., None], axis=3)[..., 0]
+        exactness = np.where(matches.any(axis=3), exactness, np.inf).reshape(len(block), bodies)
+        codes = pair_codes + aspect.reshape(len(block), bodies).astype(np.int16)
+
+        best = np.argpartition(exactness, k - 1, axis=1)[:, :k]
+        best_exactness = np.take_along_axis(exactness, best, axis=1)
+        order = np.argsort(best_exactness, axis=1, kind="stable")
+        best = np.take_along_axis(best, order, axis=1)
+        found = np.isfinite(np.take_along_axis(best_exactness, order, axis=1))
+        result[start:start + len(block), :k] = np.where(found, np.take_along_axis(codes, best, axis=1), -1)
+    return result
+
+
+def group_users(codes):
+    """Различные наборы аспектов и номер набора для каждого пользователя."""
+    if not len(codes):
+        return codes, np.zeros(0, dtype=np.int64)
+    sets, inverse = np.unique(codes, axis=0, return_inverse=True)
+    return sets, inverse.reshape(-1)
+
+
+def group_key(codes):
+    return ",".join(str(int(code)) for code in codes if code >= 0) or "-"
+
+
+def parse_group_key(key):
+    return [] if key == "-" else [int(code) for code in key.split(",")]
+
+
+def aspect_parts(code):
+    """(транзитное тело, натальное тело, аспект) по коду."""
+    pair, aspect = divmod(int(code), len(ASPECTS))
+    transit, body = divmod(pair, len(NATAL_BODIES))
+    return TRANSIT_BODIES[transit], NATAL_BODIES[body], ASPECTS[aspect][0]
+
+
+def aspect_lines(codes):
+    return [f"• транзитный {transit} {aspect} натальный {body}" for transit, body, aspect in map(aspect_parts, codes)]
+
+
+def transit_prompt(day, code):
+    transit, body, aspect = aspect_parts(code)
+    return f"""
+Астролог. Главный транзит дня {day:%d.%m.%Y}: транзитный {transit} {aspect} натальный {body}.
+
+Задача: короткий прогноз на день по этому транзиту (3–4 предложения): настроение, на что обратить внимание, совет.
+"""
+
+
+def day_prompt(day, sky_lons):
+    positions = "\n".join(
+        f"{body}: {const.LIST_SIGNS[int(lon / 30)]} ({lon % 30:.0f}°)" for body, lon in zip(TRANSIT_BODIES, sky_lons)
+    )
+    return f"""
+Астролог. Небо дня {day:%d.%m.%Y}:
+{positions}
+
+Задача: общий прогноз на день для всех знаков (3–4 предложения) и совет.
+"""
+
+
+def transit_message(day, lines, advice):
+    parts = [f"🔭 Транзиты дня {day:%d.%m.%Y}"]
+    if lines:
+        parts.append("\n".join(lines))
+    parts.append(advice)
+    parts.append("Отключить рассылку: /transits")
+    return "\n\n".join(parts)
+
+
+class TransitStore:
+    """План рассылки по дням: группы (набор аспектов → текст) и статус доставки каждому пользователю."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS transit_runs ("
+            "day TEXT PRIMARY KEY, created_at REAL NOT NULL, finished_at REAL, users INTEGER NOT NULL, "
+            "groups INTEGER NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS transit_groups ("
+            "day TEXT NOT NULL, group_key TEXT NOT NULL, users INTEGER NOT NULL, text TEXT, "
+            "PRIMARY KEY (day, group_key)) WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS transit_texts ("
+            "day TEXT NOT NULL, text_key TEXT NOT NULL, text TEXT NOT NULL, PRIMARY KEY (day, text_key)) WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS transit_deliveries ("
+            "day TEXT NOT NULL, user_id TEXT NOT NULL, group_key TEXT NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'pending', updated_at REAL, "
+            "PRIMARY KEY (day, user_id)) WITHOUT ROWID"
+        )
+
+    def _db(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _many(self, sql, rows):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(sql, rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def run(self, day):
+        rows = self._db("SELECT created_at, finished_at, users, groups FROM transit_runs WHERE day = ?", (day,))
+        return dict(zip(("created_at", "finished_at", "users", "groups"), rows[0])) if rows else None
+
+    def create_run(self, day, deliveries, groups):
+        """План дня одной транзакцией: `deliveries` — [(user_id, group_key)], `groups` — {group_key: число пользователей}."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("INSERT INTO transit_runs VALUES (?, ?, NULL, ?, ?)", (day, now, len(deliveries), len(groups)))
+                self._conn.executemany(
+                    "INSERT INTO transit_groups (day, group_key, users) VALUES (?, ?, ?)",
+                    [(day, key, users) for key, users in groups.items()]
+                )
+                self._conn.executemany(
+                    "INSERT INTO transit_deliveries (day, user_id, group_key) VALUES (?, ?, ?)",
+                    [(day, user_id, key) for user_id, key in deliveries]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def groups(self, day):
+        """[(group_key, users, сообщение или None)] по убыванию размера группы."""
+        return self._db(
+            "SELECT group_key, users, text FROM transit_groups WHERE day = ? ORDER BY users DESC, group_key", (day,)
+        )
+
+    def save_messages(self, day, messages):
+        """Готовые сообщения групп: `messages` — [(group_key, text)]."""
+        self._many("UPDATE transit_groups SET text = ? WHERE day = ? AND group_key = ?",
+                   [(text, day, key) for key, text in messages])
+
+    def texts(self, day):
+        """Тексты GPT за день: {ключ: текст}."""
+        return dict(self._db("SELECT text_key, text FROM transit_texts WHERE day = ?", (day,)))
+
+    def save_texts(self, day, texts):
+        self._many("INSERT OR REPLACE INTO transit_texts VALUES (?, ?, ?)", [(day, key, text) for key, text in texts.items()])
+
+    def pending(self, day, after="", limit=100):
+        """Следующие неотправленные: [(user_id, group_key)] с user_id > `after`."""
+        return self._db(
+            "SELECT user_id, group_key FROM transit_deliveries WHERE day = ? AND status = 'pending' AND user_id > ? "
+            "ORDER BY user_id LIMIT ?", (day, after, limit)
+        )
+
+    def mark(self, day, results):
+        """Статусы доставки: `results` — [(user_id, status)]."""
+        now = time.time()
+        self._many("UPDATE transit_deliveries SET status = ?, updated_at = ? WHERE day = ? AND user_id = ?",
+                   [(status, now, day, user_id) for user_id, status in results])
+
+    def finish(self, day):
+        self._db("UPDATE transit_runs SET finished_at = ? WHERE day = ?", (time.time(), day))
+
+    def counts(self, day):
+        return dict(self._db("SELECT status, COUNT(*) FROM transit_deliveries WHERE day = ? GROUP BY status", (day,)))
+
+    def gc(self, keep_days=7):
+        """Удаление планов старше `keep_days` дней."""
+        cutoff = (datetime.now(timezone.utc).date() - timedelta(days=keep_days)).isoformat()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for table in ("transit_deliveries", "transit_groups", "transit_texts", "transit_runs"):
+                    self._conn.execute(f"DELETE FROM {table} WHERE day < ?", (cutoff,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class TransitBroadcast:
+    """Подготовка, генерация текстов и доставка рассылки за день; ежедневный запуск в `hour` часов UTC."""
+
+    def __init__(self, store, user_store, outbox, gateway, rate=20.0, window=50, page=100, max_texts=200,
+                 hour=6, max_aspects=MAX_ASPECTS, keep_days=7):
+        self.store = store
+        self.user_store = user_store
+        self.outbox = outbox
+        self.gateway = gateway
+        self.rate = rate
+        self.window = window
+        self.page = page
+        self.max_texts = max_texts
+        self.hour = hour
+        self.max_aspects = max_aspects
+        self.keep_days = keep_days
+        self._lock = asyncio.Lock()
+        self._task = None
+        self.last_run = None
+
+    async def _run(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    def _plan(self, day, sky):
+        """Аспекты и группы для всех пользователей (в пуле потоков)."""
+        started = time.perf_counter()
+        ids, natal_lons = natal_longitudes(self.user_store.iter_users())
+        loaded = time.perf_counter()
+        sets, inverse = group_users(transit_aspects(natal_lons, sky, max_aspects=self.max_aspects))
+        keys = [group_key(codes) for codes in sets]
+        groups = dict(zip(keys, np.bincount(inverse, minlength=len(keys)).tolist()))
+        self.store.create_run(day, [(user_id, keys[i]) for user_id, i in zip(ids, inverse.tolist())], groups)
+        logging.info(
+            f"Transits {day}: {len(ids)} users, {len(keys)} groups "
+            f"(load {loaded - started:.2f}s, aspects and plan {time.perf_counter() - loaded:.2f}s)"
+        )
+
+    async def prepare(self, day):
+        """План рассылки на день (если его ещё нет)."""
+        if await self._run(self.store.run, day.isoformat()) is None:
+            await self._run(self._plan, day.isoformat(), sky_longitudes(day))
+
+    async def _advice(self, prompt, kind):
+        try:
+            return await self.gateway.complete(prompt, TRANSIT_MODEL, kind, temperature=0.8, max_tokens=300)
+        except Exception as e:
+            logging.error(f"Transit text error: {e}", exc_info=not isinstance(e, LLMError))
+            return None
+
+    async def generate(self, day):
+        """Сообщения групп. Совет от GPT — по главному аспекту группы: для `max_texts` аспектов с наибольшим
+        числом пользователей, остальным группам (и при сбое GPT) — общий прогноз дня."""
+        key = day.isoformat()
+        todo = [(group, users) for group, users, text in await self._run(self.store.groups, key) if text is None]
+        if not todo:
+            return
+        texts = await self._run(self.store.texts, key)
+        new = {}
+        if DAY_KEY not in texts:
+            new[DAY_KEY] = await self._advice(day_prompt(day, sky_longitudes(day)), "transit_day") or FALLBACK_ADVICE
+        leads = {}
+        for group, users in todo:
+            codes = parse_group_key(group)
+            if codes:
+                leads[codes[0]] = leads.get(codes[0], 0) + users
+        missing = [code for code in sorted(leads, key=leads.get, reverse=True) if str(code) not in texts]
+        budget = max(0, self.max_texts - len(texts))
+        advice = await asyncio.gather(*[self._advice(transit_prompt(day, code), "transit") for code in missing[:budget]])
+        new.update({str(code): text for code, text in zip(missing, advice) if text})
+        await self._run(self.store.save_texts, key, new)
+        texts.update(new)
+
+        messages = []
+        for group, _ in todo:
+            codes = parse_group_key(group)
+            advice = texts.get(str(codes[0]), texts[DAY_KEY]) if codes else texts[DAY_KEY]
+            messages.append((group, transit_message(day, aspect_lines(codes), advice)))
+        await self._run(self.store.save_messages, key, messages)
+        logging.info(f"Transits {key}: {len(messages)} messages, {len(new)} texts generated")
+
+    async def _send(self, user_id, text):
+        try:
+            await self.outbox.send_message(user_id, text, priority=BULK)
+            status = "sent"
+        except (Unauthorized, ChatNotFound) as e:
+            # Бот заблокирован или чат недоступен: рассылка пользователю отключается
+            logging.info(f"Transits: user {user_id} unreachable ({type(e).__name__}), disabled")
+            await self._run(self.user_store.update, user_id, {"transits": False})
+            status = "blocked"
+        except Exception as e:
+            logging.error(f"Transit send error for {user_id}: {e}")
+            status = "failed"
+        metrics.TRANSIT_MESSAGES.inc(status=status)
+        return user_id, status
+
+    async def deliver(self, day):
+        """Отправка неотправленных сообщений страницами по `page` со скоростью не выше `rate` в секунду.
+
+        Статусы сохраняются после каждой страницы: после сбоя повторно уйдут не больше `page` сообщений.
+        """
+        key = day.isoformat()
+        texts = {group: text for group, _, text in await self._run(self.store.groups, key)}
+        bucket = TokenBucket(self.rate, 1)
+        window = asyncio.Semaphore(self.window)
+
+        async def send(user_id, group):
+            try:
+                return await self._send(user_id, texts[group])
+            finally:
+                window.release()
+
+        after = ""
+        while True:
+            page = await self._run(self.store.pending, key, after, self.page)
+            if not page:
+                break
+            tasks = []
+            for user_id, group in page:
+                while (wait := bucket.wait_time(time.monotonic())) > 0:
+                    await asyncio.sleep(wait)
+                bucket.take(time.monotonic())
+                await window.acquire()
+                tasks.append(asyncio.ensure_future(send(user_id, group)))
+            await self._run(self.store.mark, key, await asyncio.gather(*tasks))
+            after = page[-1][0]
+
+    async def run(self, day):
+        """Полный цикл за день; повторный вызов продолжает незавершённую рассылку."""
+        async with self._lock:
+            started = time.perf_counter()
+            await self.prepare(day)
+            await self.generate(day)
+            await self.deliver(day)
+            await self._run(self.store.finish, day.isoformat())
+            self.last_run = day.isoformat()
+            logging.info(f"Transits {day}: done in {time.perf_counter() - started:.0f}s, {self.stats(day)}")
+
+    def stats(self, day=None):
+        day = (day or datetime.now(timezone.utc).date()).isoformat()
+        return {"day": day, "run": self.store.run(day), "deliveries": self.store.counts(day)}
+
+    async def _loop(self):
+        while True:
+            now = datetime.now(timezone.utc)
+            today = now.date()
+            try:
+                run = await self._run(self.store.run, today.isoformat())
+                if now.hour >= self.hour and not (run and run["finished_at"]):
+                    await self.run(today)
+                    await self._run(self.store.gc, self.keep_days)
+            except Exception as e:
+                logging.error(f"Transit broadcast error: {e}", exc_info=True)
+                await asyncio.sleep(60)
+                continue
+            next_run = datetime.combine(today, datetime.min.time(), timezone.utc) + timedelta(hours=self.hour)
+            if next_run <= now:
+                next_run += timedelta(days=1)
+            await asyncio.sleep(min((next_run - now).total_seconds(), 3600))
+
+    def start(self):
+        """Ежедневный запуск; незавершённая сегодняшняя рассылка продолжается сразу."""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self.store.close()
+
+
+if __name__ == "__main__":
+    from user_store import UserStore
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Транзиты дня: группы пользователей без отправки")
+    parser.add_argument("command", choices=["preview"])
+    parser.add_argument("--users-db", default="./users.db")
+    parser.add_argument("--day", default=None, help="ГГГГ-ММ-ДД, по умолчанию сегодня (UTC)")
+    parser.add_argument("--top", type=int, default=5)
+    args = parser.parse_args()
+
+    day = datetime.strptime(args.day, "%Y-%m-%d").date() if args.day else datetime.now(timezone.utc).date()
+    user_store = UserStore(args.users_db)
+    ids, natal_lons = natal_longitudes(user_store.iter_users())
+    sets, inverse = group_users(transit_aspects(natal_lons, sky_longitudes(day)))
+    sizes = np.bincount(inverse, minlength=len(sets))
+    print(f"{day}: {len(ids)} users, {len(sets)} groups")
+    for index in np.argsort(-sizes)[:args.top]:
+        print(f"\n{sizes[index]} users:\n" + transit_message(day, aspect_lines([c for c in sets[index] if c >= 0]), "…"))
+    user_store.close()
@@ -0,0 +1,208 @@
+"""Хранилище пользователей в SQLite (WAL) с построчным чтением и upsert.
+
+Однократный перенос из старого users.json:
+    python user_store.py migrate users.json --db users.db
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import metrics
+
+DATETIME_FIELDS = ("dt_utc", "last_calc_time", "last_report_time")
+
+
+def _encode(info):
+    data = info.copy()
+    for field in DATETIME_FIELDS:
+        if isinstance(data.get(field), datetime):
+            data[field] = data[field].isoformat()
+    return data
+
+
+def _decode(data):
+    for field in DATETIME_FIELDS:
+        if isinstance(data.get(field), str):
+            data[field] = datetime.fromisoformat(data[field])
+    return data
+
+
+class UserStore:
+    """Пользователи в таблице SQLite: одна строка на пользователя, JSON-данные и индексируемые времена."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "user_id TEXT PRIMARY KEY, data TEXT NOT NULL, "
+            "last_calc_time TEXT, last_report_time TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_users_last_calc ON users (last_calc_time)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_users_last_report ON users (last_report_time)")
+
+    def _execute(self, sql, params=()):
+        started = time.perf_counter()
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        elapsed = time.perf_counter() - started
+        metrics.STORE_SECONDS.observe(elapsed, store="users", query=sql.split(None, 1)[0].lower())
+        if elapsed > 0.1:
+            logging.warning(f"Slow user store query ({elapsed:.3f}s): {sql[:60]}")
+        return rows
+
+    def get(self, user_id):
+        """Данные пользователя или None."""
+        rows = self._execute("SELECT data FROM users WHERE user_id = ?", (str(user_id),))
+        return _decode(json.loads(rows[0][0])) if rows else None
+
+    def exists(self, user_id):
+        return bool(self._execute("SELECT 1 FROM users WHERE user_id = ?", (str(user_id),)))
+
+    def upsert(self, user_id, info):
+        """Полная запись данных пользователя."""
+        data = _encode(info)
+        self._execute(
+            "INSERT INTO users (user_id, data, last_calc_time, last_report_time) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, "
+            "last_calc_time = excluded.last_calc_time, last_report_time = excluded.last_report_time",
+            (str(user_id), json.dumps(data, ensure_ascii=False),
+             data.get("last_calc_time"), data.get("last_report_time"))
+        )
+
+    def update(self, user_id, fields):
+        """Обновление отдельных полей (остальные данные пользователя сохраняются)."""
+        with metrics.STORE_SECONDS.time(store="users", query="update"), self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT data FROM users WHERE user_id = ?", (str(user_id),)).fetchone()
+                info = _decode(json.loads(row[0])) if row else {}
+                info.update(fields)
+                data = _encode(info)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO users (user_id, data, last_calc_time, last_report_time) VALUES (?, ?, ?, ?)",
+                    (str(user_id), json.dumps(data, ensure_ascii=False),
+                     data.get("last_calc_time"), data.get("last_report_time"))
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return info
+
+    def delete(self, user_id):
+        self._execute("DELETE FROM users WHERE user_id = ?", (str(user_id),))
+
+    def delete_all(self):
+        self._execute("DELETE FROM users")
+
+    def count(self):
+        return self._execute("SELECT COUNT(*) FROM users")[0][0]
+
+    def recent(self, limit=20):
+        """Последние рассчитавшие пользователи: (user_id, last_calc_time, last_report_time)."""
+        return self._execute(
+            "SELECT user_id, last_calc_time, last_report_time FROM users "
+            "ORDER BY last_calc_time DESC LIMIT ?", (limit,)
+        )
+
+    def iter_users(self, batch_size=1000):
+        """Обход всех пользователей пачками: (user_id, data)."""
+        last_id = ""
+        while True:
+            rows = self._execute(
+                "SELECT user_id, data FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                (last_id, batch_size)
+            )
+            if not rows:
+                return
+            for user_id, data in rows:
+                yield user_id, _decode(json.loads(data))
+            last_id = rows[-1][0]
+
+    # Асинхронные варианты для обработчиков: запрос может ждать блокировку записи другого процесса
+    # (busy_timeout до 5 с), поэтому он выполняется в пуле потоков, а не в event loop
+    async def _run(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    async def get_async(self, user_id):
+        return await self._run(self.get, user_id)
+
+    async def exists_async(self, user_id):
+        return await self._run(self.exists, user_id)
+
+    async def update_async(self, user_id, fields):
+        return await self._run(self.update, user_id, fields)
+
+    async def delete_all_async(self):
+        await self._run(self.delete_all)
+
+    async def count_async(self):
+        return await self._run(self.count)
+
+    async def recent_async(self, limit=20):
+        return await self._run(self.recent, limit)
+
+    def migrate_from_json(self, json_path):
+        """Перенос пользователей из users.json; возвращает число перенесённых записей."""
+        with open(json_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for user_id, info in data.items():
+                    # Проверяем формат дат до записи
+                    info = _encode(_decode(info))
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO users (user_id, data, last_calc_time, last_report_time) VALUES (?, ?, ?, ?)",
+                        (str(user_id), json.dumps(info, ensure_ascii=False),
+                         info.get("last_calc_time"), info.get("last_report_time"))
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        logging.info(f"Migrated {len(data)} users from {json_path} to {self.path}")
+        return len(data)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def migrate_if_needed(store, json_path):
+    """Однократная миграция при старте: users.json переносится и переименовывается в *.migrated."""
+    if not os.path.exists(json_path):
+        return 0
+    count = store.migrate_from_json(json_path)
+    os.replace(json_path, f"{json_path}.migrated")
+    return count
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Хранилище пользователей")
+    parser.add_argument("command", choices=["migrate", "stats"])
+    parser.add_argument("json_path", nargs="?", default="./users.json")
+    parser.add_argument("--db", default="./users.db")
+    args = parser.parse_args()
+
+    user_store = UserStore(args.db)
+    if args.command == "migrate":
+        print(f"Migrated {user_store.migrate_from_json(args.json_path)} users")
+    else:
+        print(f"{user_store.count()} users in {args.db}")
+    user_store.close()
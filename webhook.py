@@ -0,0 +1,251 @@
+"""Режим вебхука: aiohttp-сервер принимает обновления и сразу отвечает 200, обработка идёт асинхронно.
+
+Один процесс:            BOT_MODE=webhook python main.py
+Несколько процессов:     python webhook.py --workers 4
+
+Во втором случае этот процесс только принимает обновления и раскладывает их по рабочим
+процессам по user id, поэтому обновления одного пользователя обрабатываются по порядку.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+
+import aiohttp
+from aiohttp import web
+from dotenv import load_dotenv
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+DEFAULT_API_URL = "https://api.telegram.org"
+ALLOWED_UPDATES = ["message", "callback_query", "chat_member"]
+
+
+def route_key(update):
+    """Ключ маршрутизации: id пользователя-отправителя, а если его нет — id обновления."""
+    for field in ("message", "edited_message", "callback_query", "chat_member", "my_chat_member", "inline_query"):
+        sender = (update.get(field) or {}).get("from")
+        if sender and "id" in sender:
+            return int(sender["id"])
+    return int(update.get("update_id", 0))
+
+
+class UpdateRouter:
+    """Последовательная обработка обновлений каждого пользователя; разные пользователи — параллельно."""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self._queues = {}
+        self._tasks = set()
+
+    def submit(self, key, update):
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = asyncio.Queue()
+            task = asyncio.ensure_future(self._consume(key, queue))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        queue.put_nowait(update)
+
+    async def _consume(self, key, queue):
+        while True:
+            try:
+                update = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                del self._queues[key]
+                return
+            try:
+                await self.handler(update)
+            except Exception as e:
+                logging.error(f"Update processing error for {key}: {e}", exc_info=True)
+
+    @property
+    def pending(self):
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    async def drain(self):
+        """Ожидание обработки уже принятых обновлений."""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+
+def create_app(path, secret, on_update, is_ready=None):
+    """aiohttp-приложение с проверкой секретного токена; on_update(update) не должен блокировать.
+
+    /health отвечает сразу после запуска, /ready — 503, пока `is_ready()` ложно (идёт прогрев).
+    """
+
+    async def handle(request):
+        if secret and request.headers.get(SECRET_HEADER) != secret:
+            logging.warning(f"Webhook request with invalid secret from {request.remote}")
+            return web.Response(status=403)
+        try:
+            update = await request.json(loads=json.loads)
+        except ValueError:
+            return web.Response(status=400)
+        on_update(update)
+        return web.Response()
+
+    async def health(_):
+        return web.Response(text="ok")
+
+    async def ready(_):
+        if is_ready is not None and not is_ready():
+            return web.Response(status=503, text="warming up")
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_post(path, handle)
+    app.router.add_get("/health", health)
+    app.router.add_get("/ready", ready)
+    return app
+
+
+async def set_webhook(token, url, secret, api_url=DEFAULT_API_URL, allowed_updates=None):
+    """Регистрация вебхука прямым запросом к Bot API (не требует экземпляра Bot)."""
+    payload = {"url": url, "allowed_updates": allowed_updates or ALLOWED_UPDATES}
+    if secret:
+        payload["secret_token"] = secret
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{api_url.rstrip('/')}/bot{token}/setWebhook", json=payload) as response:
+            result = await response.json()
+            if not result.get("ok"):
+                raise RuntimeError(f"setWebhook failed: {result}")
+    logging.info(f"Webhook set to {url}")
+
+
+async def serve(app, host, port):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Webhook server listening on {host}:{port}")
+    return runner
+
+
+async def _close_bot(dp):
+    await dp.storage.close()
+    await dp.storage.wait_closed()
+    session = await dp.bot.get_session()
+    await session.close()
+
+
+async def _wait_for_stop():
+    """Ожидание SIGINT/SIGTERM (Render останавливает сервис через SIGTERM)."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+
+def run_in_process(dp, init, shutdown, host, port, path, url, secret, api_url=DEFAULT_API_URL, is_ready=None):
+    """Вебхук в одном процессе вместе с обработчиками бота."""
+    from aiogram import Bot, Dispatcher, types
+
+    async def process(update):
+        await dp.process_update(types.Update(**update))
+
+    async def main():
+        Bot.set_current(dp.bot)
+        Dispatcher.set_current(dp)
+        router = UpdateRouter(process)
+        await init()
+        runner = await serve(create_app(path, secret, lambda update: router.submit(route_key(update), update), is_ready), host, port)
+        if url:
+            await set_webhook(dp.bot._token, url, secret, api_url)
+        try:
+            await _wait_for_stop()
+        finally:
+            await runner.cleanup()
+            await router.drain()
+            await shutdown()
+            await _close_bot(dp)
+
+    asyncio.run(main())
+    logging.info("Webhook server stopped")
+
+
+def _worker_main(index, count, queue):
+    """Рабочий процесс: импортирует бота и обрабатывает обновления из своей очереди."""
+    # Остановкой рабочих процессов управляет основной процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.environ["WORKER_INDEX"] = str(index)
+    os.environ["WORKER_COUNT"] = str(count)
+    import main as bot_main
+    from aiogram import Bot, Dispatcher, types
+
+    async def process(update):
+        await bot_main.dp.process_update(types.Update(**update))
+
+    async def run():
+        Bot.set_current(bot_main.bot)
+        Dispatcher.set_current(bot_main.dp)
+        router = UpdateRouter(process)
+        await bot_main.init_services()
+        loop = asyncio.get_running_loop()
+        logging.info(f"Webhook worker {index} started")
+        while True:
+            update = await loop.run_in_executor(None, queue.get)
+            if update is None:
+                break
+            router.submit(route_key(update), update)
+        await router.drain()
+        await bot_main.on_shutdown(bot_main.dp)
+        await _close_bot(bot_main.dp)
+
+    asyncio.run(run())
+    # Дочерний процесс завершается без atexit, поэтому очередь логов дописывается явно
+    bot_main.log_setup.stop_logging()
+
+
+def run_frontend(workers, host, port, path, url, secret, token, api_url=DEFAULT_API_URL):
+    """Приём вебхука в этом процессе и обработка в `workers` рабочих процессах."""
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue() for _ in range(workers)]
+    # Не daemon: рабочим процессам нужен свой пул процессов для PDF
+    processes = [context.Process(target=_worker_main, args=(i, workers, q)) for i, q in enumerate(queues)]
+    for process in processes:
+        process.start()
+
+    def dispatch(update):
+        queues[route_key(update) % workers].put(update)
+
+    async def main():
+        runner = await serve(create_app(path, secret, dispatch), host, port)
+        if url:
+            await set_webhook(token, url, secret, api_url)
+        try:
+            await _wait_for_stop()
+        finally:
+            await runner.cleanup()
+
+    try:
+        asyncio.run(main())
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+        logging.info("Webhook frontend stopped")
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - [%(processName)s] - %(message)s")
+    parser = argparse.ArgumentParser(description="Вебхук с несколькими рабочими процессами")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEBHOOK_WORKERS", "2")))
+    parser.add_argument("--host", default=os.getenv("WEBAPP_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8080")))
+    args = parser.parse_args()
+    run_frontend(
+        args.workers, args.host, args.port,
+        path=os.getenv("WEBHOOK_PATH", "/webhook"),
+        url=os.getenv("WEBHOOK_URL"),
+        secret=os.getenv("WEBHOOK_SECRET"),
+        token=os.getenv("API_TOKEN"),
+        api_url=os.getenv("TELEGRAM_API_URL", DEFAULT_API_URL)
+    )